@@ -0,0 +1 @@
+default_app_config = 'bima_core.apps.BimaCoreConfig'
@@ -5,3 +5,7 @@ from django.apps import AppConfig
 
 class BimaCoreConfig(AppConfig):
     name = 'bima_core'
+
+    def ready(self):
+        # connect the signal receivers, the haystack signal processor only wires the search index
+        from . import signals  # NOQA
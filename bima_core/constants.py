@@ -20,6 +20,12 @@ DEFAULT_CONSTANCE = {
     'BIMA_CORE_CHANGE_PASSWORD_PATH': ('/change-password/', 'Endpoint of bima core to change password'),
     'PAGE_SIZE': (20, 'Number of items of any list. If you clean it, it will be 20 by default.'),
     'LARGE_PAGE_SIZE': (1000, 'Number of items for large custom lists. Used to export logs, for example'),
+    'PAGINATION_COUNT_MODE': ('exact', 'Strategy to count the total items of lists: exact, cached or estimated.'),
+    'PAGINATION_COUNT_CACHE_TIMEOUT': (60, 'Seconds to keep counts of lists with the cached count mode.'),
+    'PAGINATION_COUNT_ESTIMATE_THRESHOLD': (
+        10000, 'With the estimated count mode, lists with more estimated items than it do not count exactly.'),
+    'TAXONOMY_TREE_CACHE_TIMEOUT': (
+        24 * 60 * 60, 'Seconds to keep serialized taxonomy trees. They are built again when any taxonomy changes.'),
 
     'FLICKR_PHOTO_URL': ('https://www.flickr.com/photos/', 'Flickr photos endpoint.')
 }
@@ -29,11 +35,34 @@ EDITOR_GROUP_NAME = 'editor'
 READER_GROUP_NAME = 'reader'
 PHOTOGRAPHER_GROUP_NAME = 'photographer'
 DEFAULT_GROUPS = (ADMIN_GROUP_NAME, EDITOR_GROUP_NAME, READER_GROUP_NAME, PHOTOGRAPHER_GROUP_NAME, )
+GROUP_NAMES_CACHE_ATTR = '_group_names_cache'
+OWNER_IDS_CACHE_ATTR = '_owner_ids_cache'
+RELATED_PHOTO_IDS_ATTR = '_related_photo_ids'
+PHOTO_COUNTS_ATTR = '_photo_counts'
+REMOVED_PHOTO_COUNTS_ATTR = '_removed_photo_counts'
+TAXONOMY_MOVED_ATTR = '_taxonomy_moved'
+TAXONOMY_TREE_CHILDREN_ATTR = '_tree_children'
+TAXONOMY_TREE_ANCESTORS_ATTR = '_tree_ancestors'
+TAGGED_KEYWORDS_RELATION = 'tagged_keywords'
+
+COUNT_MODE_EXACT = 'exact'
+COUNT_MODE_CACHED = 'cached'
+COUNT_MODE_ESTIMATED = 'estimated'
+COUNT_MODES = (COUNT_MODE_EXACT, COUNT_MODE_CACHED, COUNT_MODE_ESTIMATED, )
+COUNT_CACHE_PREFIX = 'bima_core:count'
+TAXONOMY_TREE_CACHE_PREFIX = 'bima_core:taxonomy-tree'
+TAXONOMY_TREE_VERSION_KEY = 'bima_core:taxonomy-tree:version'
 
 RQ_UPLOAD_QUEUE = 'upload'
 RQ_HAYSTACK_PHOTO_INDEX_QUEUE = 'haystack-photo-index'
+INDEX_CHUNK_SIZE = 1000
 
 COMPLETED_UPLOAD = 2
+IMAGE_CHUNK_SIZE = 1024 * 1024
+IMAGE_HASH_ALGORITHM = 'sha256'
+IMAGE_HASH_ATTR = '_image_hash'
+COVER_PHOTO_ATTR = '_cover_photo'
+PHOTO_BULK_MAX_SIZE = 500
 CHAR_REGEX = r'[\w\d]'
 UUID_REGEX = r'{char}{{8}}-{char}{{4}}-{char}{{4}}-{char}{{4}}-{char}{{12}}'.format(**{'char': CHAR_REGEX})
 
@@ -1,10 +1,45 @@
+import csv
+import json
+import time
+from contextlib import contextmanager
+from multiprocessing import Pool
+
 from django.core.management.base import BaseCommand
+from django.db import connections
 
 from ...models import Photo
+from ...utils import id_ranges
 
 DESTINATION_ALL = 'all'
 DESTINATION_SIZE = 'size'
 DESTINATION_OUTPUT = 'output'
+DESTINATION_FORMAT = 'format'
+DESTINATION_WORKERS = 'workers'
+DESTINATION_CHUNK_SIZE = 'chunk_size'
+
+FORMAT_CSV = 'csv'
+FORMAT_JSON_LINES = 'jsonl'
+
+
+def get_queryset(export_all=False):
+    """Photos to export, only with the columns required to build thumbor urls"""
+    queryset = Photo.objects.all() if export_all else Photo.objects.active()
+    return queryset.only('id', 'image', 'orientation').order_by('id')
+
+
+def export_range(params):
+    """
+    Build the thumbor urls of all photos of an id range. It is executed in the worker processes, so it receives and
+    returns plain python objects.
+    :param params: tuple (export all, first id, last id, list of (size, thumbor params))
+    :return: list of rows (photo id followed by an url for each size)
+    """
+    export_all, start, end, sizes = params
+    queryset = get_queryset(export_all).filter(id__gte=start, id__lte=end)
+    return [
+        [photo.id] + [photo.get_image_url(size, thumbor_params) for size, thumbor_params in sizes]
+        for photo in queryset.iterator()
+    ]
 
 
 class Command(BaseCommand):
@@ -18,22 +53,78 @@ class Command(BaseCommand):
                             help='Export for all photos (activated or not). Default only activated photos.')
         parser.add_argument('-o', '--output', action='store', dest=DESTINATION_OUTPUT,
                             default=None, help="Full path name of the output file. Default 'stdout'")
+        parser.add_argument('-f', '--format', action='store', dest=DESTINATION_FORMAT, default=FORMAT_CSV,
+                            choices=[FORMAT_CSV, FORMAT_JSON_LINES],
+                            help='Output format, a row per photo with all sizes. Default: csv.')
+        parser.add_argument('-w', '--workers', action='store', type=int, dest=DESTINATION_WORKERS, default=1,
+                            help='Number of processes to build urls. Default: 1.')
+        parser.add_argument('-c', '--chunk-size', action='store', type=int, dest=DESTINATION_CHUNK_SIZE,
+                            default=1000, help='Number of photo ids processed by each job. Default: 1000.')
 
     def handle(self, *args, **options):
-        self.stdout.write("Starting to export with in sizes {}".format(', '.join(options[DESTINATION_SIZE])))
+        self.stderr.write("Starting to export with in sizes {}".format(', '.join(options[DESTINATION_SIZE])))
         # set object attribute all declared options
-        for field in (DESTINATION_SIZE, DESTINATION_OUTPUT, DESTINATION_ALL):
+        for field in (DESTINATION_SIZE, DESTINATION_OUTPUT, DESTINATION_ALL, DESTINATION_FORMAT, DESTINATION_WORKERS,
+                      DESTINATION_CHUNK_SIZE):
             setattr(self, field, options[field])
         total = self.export_thumbor_urls()
-        self.stdout.write(self.style.SUCCESS("Export has finished successfully (total: {})".format(total)))
+        self.stderr.write(self.style.SUCCESS("Export has finished successfully (total: {})".format(total)))
 
     def export_thumbor_urls(self):
-        """Export thumbor urls according the options"""
-        queryset = Photo.objects.all() if getattr(self, DESTINATION_ALL) else Photo.objects.active()
+        """
+        Export thumbor urls according the options.
+        The id range of photos is partitioned and each part is processed by the pool of workers, while the results are
+        written as soon as they are received.
+        """
+        # constance config is read only once for all photos
+        sizes = [(size, Photo.get_thumbor_params(size)) for size in getattr(self, DESTINATION_SIZE)]
+        ranges = id_ranges(get_queryset(getattr(self, DESTINATION_ALL)), getattr(self, DESTINATION_CHUNK_SIZE))
+        params = ((getattr(self, DESTINATION_ALL), start, end, sizes) for start, end in ranges)
+
+        total, start_time = 0, time.time()
+        with self.open_output() as output:
+            write = self.get_writer(output)
+            for rows in self.map_ranges(params):
+                for row in rows:
+                    write(row)
+                total += len(rows)
+                elapsed = time.time() - start_time
+                self.stderr.write("Exported {} photos ({:.1f} photos/s)".format(total, total / (elapsed or 1)))
+        return total
+
+    def map_ranges(self, params):
+        """
+        Process id ranges in a pool of processes. Database connections are closed before forking to force each worker
+        to open its own connection.
+        """
+        workers = getattr(self, DESTINATION_WORKERS)
+        if workers <= 1:
+            yield from map(export_range, params)
+            return
+
+        connections.close_all()
+        with Pool(workers) as pool:
+            yield from pool.imap(export_range, params)
+
+    @contextmanager
+    def open_output(self):
         output = getattr(self, DESTINATION_OUTPUT)
-        if output:
-            output = open(output, 'w')
-        for photo in queryset:
-            for size in getattr(self, DESTINATION_SIZE):
-                print(getattr(photo, 'image_{}'.format(size)), file=output)
-        return queryset.count()
+        if not output:
+            yield self.stdout
+            return
+        with open(output, 'w', newline='') as f:
+            yield f
+
+    def get_writer(self, output):
+        """
+        Get a callable which writes a photo row in the output with the selected format.
+        """
+        sizes = getattr(self, DESTINATION_SIZE)
+        if getattr(self, DESTINATION_FORMAT) == FORMAT_JSON_LINES:
+            def write(row):
+                output.write("{}\n".format(json.dumps(dict(zip(['id', ] + sizes, row)))))
+            return write
+
+        writer = csv.writer(output)
+        writer.writerow(['id', ] + sizes)
+        return writer.writerow
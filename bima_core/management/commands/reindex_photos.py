@@ -0,0 +1,134 @@
+import time
+from collections import deque
+from multiprocessing import Pool, cpu_count
+
+from django.core.management.base import BaseCommand
+from django.db import connections as db_connections
+from haystack import connections
+
+from ...models import Photo
+from ...utils import id_ranges
+
+
+class PreparedDocumentIndex(object):
+    """
+    Proxy of a search index whose objects are documents already prepared, so backends can update them in bulk
+    without preparing them again.
+    """
+
+    def __init__(self, index):
+        self.index = index
+
+    def full_prepare(self, document):
+        return document
+
+    def __getattr__(self, name):
+        return getattr(self.index, name)
+
+
+def get_index(using):
+    return connections[using].get_unified_index().get_index(Photo)
+
+
+def prepare_range(params):
+    """
+    Prepare the index documents of the photos of an id range. It is executed in the worker processes.
+    :param params: tuple (haystack connection alias, first id, last id, dry run)
+    :return: tuple (last id, number of prepared documents, list of documents or empty list in dry run mode)
+    """
+    using, start, end, dry_run = params
+    index = get_index(using)
+    documents = [
+        index.full_prepare(photo)
+        for photo in index.index_queryset(using=using).filter(id__gte=start, id__lte=end).order_by('id')
+    ]
+    return end, len(documents), [] if dry_run else documents
+
+
+class Command(BaseCommand):
+    help = "Rebuild the photo search index preparing the documents in parallel by ranges of ids"
+
+    def add_arguments(self, parser):
+        parser.add_argument('-u', '--using', action='store', dest='using', default='default',
+                            help='Haystack connection to update. Default: default.')
+        parser.add_argument('-w', '--workers', action='store', type=int, dest='workers', default=cpu_count(),
+                            help='Number of processes to prepare documents. Default: number of CPUs.')
+        parser.add_argument('-c', '--chunk-size', action='store', type=int, dest='chunk_size', default=500,
+                            help='Number of photo ids prepared by each job. Default: 500.')
+        parser.add_argument('-b', '--batch-size', action='store', type=int, dest='batch_size', default=1000,
+                            help='Number of documents sent to the backend in each update. Default: 1000.')
+        parser.add_argument('-r', '--resume-from', action='store', type=int, dest='resume_from', default=None,
+                            help='Last photo id processed by a previous execution, to continue from the next one.')
+        parser.add_argument('-d', '--dry-run', action='store_true', dest='dry_run', default=False,
+                            help='Only prepare documents to measure throughput, without updating the index.')
+
+    def handle(self, *args, **options):
+        # set object attribute all declared options
+        for field in ('using', 'workers', 'chunk_size', 'batch_size', 'resume_from', 'dry_run'):
+            setattr(self, field, options[field])
+
+        index = get_index(self.using)
+        queryset = index.index_queryset(using=self.using)
+        start_id = self.resume_from + 1 if self.resume_from is not None else None
+        total = queryset.filter(id__gte=start_id).count() if start_id is not None else queryset.count()
+        self.stdout.write("Indexing {} photos{}".format(total, ' (dry run)' if self.dry_run else ''))
+
+        backend = connections[self.using].get_backend()
+        prepared_index = PreparedDocumentIndex(index)
+        params = ((self.using, start, end, self.dry_run)
+                  for start, end in id_ranges(queryset, self.chunk_size, start_id=start_id))
+
+        # documents not sent yet of each prepared range, in id order: [last id, documents]
+        done, pending, resume_id, start_time = 0, deque(), self.resume_from, time.time()
+        for last_id, count, documents in self.map_ranges(params):
+            done += count
+            pending.append([last_id, documents])
+            resume_id = self.flush(backend, prepared_index, pending, resume_id)
+            self.report_progress(done, total, start_time, resume_id)
+
+        resume_id = self.flush(backend, prepared_index, pending, resume_id, final=True)
+        self.report_progress(done, total, start_time, resume_id)
+        self.stdout.write(self.style.SUCCESS("Dry run has finished successfully" if self.dry_run else
+                                             "Index has been rebuilt successfully"))
+
+    def flush(self, backend, index, pending, resume_id, final=False):
+        """
+        Send the pending documents to the backend in full batches, or all of them in the final flush.
+        :return: the highest id whose documents have been sent, to resume from it
+        """
+        while True:
+            while pending and not pending[0][1]:
+                resume_id = pending.popleft()[0]
+            available = sum(len(documents) for last_id, documents in pending)
+            if not available or (available < self.batch_size and not final):
+                return resume_id
+            batch = []
+            for chunk in pending:
+                needed = self.batch_size - len(batch)
+                batch.extend(chunk[1][:needed])
+                chunk[1] = chunk[1][needed:]
+                if len(batch) >= self.batch_size:
+                    break
+            backend.update(index, batch)
+
+    def map_ranges(self, params):
+        """
+        Prepare documents of id ranges in a pool of processes. Database connections are closed before forking to
+        force each worker to open its own connection.
+        """
+        if self.workers <= 1:
+            yield from map(prepare_range, params)
+            return
+
+        db_connections.close_all()
+        with Pool(self.workers) as pool:
+            yield from pool.imap(prepare_range, params)
+
+    def report_progress(self, done, total, start_time, last_id=None):
+        elapsed = time.time() - start_time
+        rate = done / elapsed if elapsed else 0
+        eta = (total - done) / rate if rate else 0
+        message = "{}/{} photos ({:.1f} photos/s, ETA {:.0f}s)".format(done, total, rate, eta)
+        if last_id is not None:
+            message = "{}. Resume from: {}".format(message, last_id)
+        self.stdout.write(message)
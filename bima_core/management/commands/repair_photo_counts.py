@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from ...models import DAMTaxonomy, Photo
+
+SUBTREE_FIELDS = ('subtree_photos_count', 'subtree_published_photos_count', )
+COUNT_FIELDS = ('photos_count', 'published_photos_count', )
+
+
+class Command(BaseCommand):
+    help = "Count again the active and published photos of albums, galleries and taxonomies and repair the " \
+           "counters which do not match. It must be run once after migrating to fill the counters."
+
+    def add_arguments(self, parser):
+        parser.add_argument('-c', '--check', action='store_true', dest='check', default=False,
+                            help='Only report the wrong counters, and exit with an error if there is any.')
+
+    def handle(self, *args, **options):
+        wrong = 0
+        with transaction.atomic():
+            for model in Photo.get_photo_count_models():
+                counts = Photo.objects.photo_counts(model.photo_count_lookup)
+                wrong += self.repair(model, COUNT_FIELDS, counts, options['check'])
+                if model is DAMTaxonomy:
+                    subtree_counts = DAMTaxonomy.get_subtree_photo_counts(counts)
+                    wrong += self.repair(model, SUBTREE_FIELDS, subtree_counts, options['check'])
+
+        if options['check'] and wrong:
+            raise CommandError("There are {} wrong photo counters".format(wrong))
+        self.stdout.write(self.style.SUCCESS(
+            "Photo counters are right" if options['check'] else "{} photo counters have been repaired".format(wrong)))
+
+    def repair(self, model, fields, counts, check=False):
+        """
+        Compare the stored counters of all instances of a model with the computed ones and update the wrong ones.
+        :param model: model with photo counters
+        :param fields: tuple with the names of the active and published photo counters
+        :param counts: dict of instance id: (active photos, published photos)
+        :param check: only report the wrong counters
+        :return: number of instances with wrong counters
+        """
+        wrong = {pk: (tuple(stored), counts.get(pk, (0, 0)))
+                 for pk, *stored in model._base_manager.values_list('id', *fields)
+                 if tuple(stored) != counts.get(pk, (0, 0))}
+        for pk, (stored, values) in sorted(wrong.items()):
+            self.stdout.write("{} {}: {} are {} instead of {}".format(
+                model._meta.label, pk, ', '.join(fields), stored, values))
+            if not check:
+                model._base_manager.filter(pk=pk).update(**dict(zip(fields, values)))
+        return len(wrong)
@@ -1,13 +1,63 @@
 # -*- coding: utf-8 -*-
+import threading
+from contextlib import contextmanager
+
 from django.contrib.auth.models import UserManager as _UserManager
 from django.contrib.contenttypes.models import ContentType
-from django.db import models, router, transaction
-from django.db.models import signals
+from django.db import connections, models, router, transaction
+from django.db.models import Case, Count, F, Prefetch, Q, When, signals
 from django.utils.timezone import now
 from taggit.managers import _TaggableManager
 from taggit.utils import require_instance_manager
 
-from .constants import COMPLETED_UPLOAD
+from .constants import COMPLETED_UPLOAD, TAGGED_KEYWORDS_RELATION
+from .utils import count_differences
+
+
+class PhotoCountsState(threading.local):
+    """
+    Thread local state of the photo counters of albums, galleries and taxonomies. While it is paused, signal handlers
+    do not update the counters, because the changes of the paused block are counted together when it finishes (see
+    'PhotoManager.keep_photo_counts').
+    """
+
+    def __init__(self):
+        self.depth = 0
+
+    @property
+    def paused(self):
+        return self.depth > 0
+
+    @contextmanager
+    def pause(self):
+        self.depth += 1
+        try:
+            yield self
+        finally:
+            self.depth -= 1
+
+
+photo_counts_state = PhotoCountsState()
+
+
+def first_related_sql(queryset, field, value_field, ordering):
+    """
+    SQL of a correlated subquery with a value of the first related instance of each instance of the queryset. It is
+    meant for extra selects, which this Django version has instead of subquery expressions and which are not added to
+    count queries.
+    :param queryset: queryset to annotate
+    :param field: foreign key field of the related model to the model of the queryset
+    :param value_field: name of the field of the related model to select
+    :param ordering: names of fields of the related model, prefixed with '-' for descending order
+    :return: SQL string
+    """
+    qn = connections[queryset.db].ops.quote_name
+    opts, related_opts = queryset.model._meta, field.model._meta
+    order_by = ', '.join('U0.{} {}'.format(qn(related_opts.get_field(name.lstrip('-')).column),
+                                           'DESC' if name.startswith('-') else 'ASC') for name in ordering)
+    return 'SELECT U0.{value} FROM {related_table} U0 WHERE U0.{fk} = {table}.{pk} ORDER BY {order_by} LIMIT 1'.format(
+        value=qn(related_opts.get_field(value_field).column), related_table=qn(related_opts.db_table),
+        fk=qn(field.column), table=qn(opts.db_table), pk=qn(opts.pk.column), order_by=order_by)
 
 
 class ActiveManagerMixin(object):
@@ -35,6 +85,22 @@ class ActiveManagerMixin(object):
         self.update(is_active=False, deleted_at=now())
 
 
+class FirstPhotoManagerMixin(object):
+    """
+    Base manager for models represented by a photo (see 'CoverPhotoMixin')
+    """
+
+    def with_first_photo(self):
+        """
+        Annotate the id of the first photo of each instance ('first_photo_id'), so the photos of instances without
+        cover are fetched at once (see 'CoverPhotoMixin.prefetch_photos').
+        """
+        field = getattr(self.model, self.model.first_photo_relation).field
+        value_field = self.model.first_photo_field or field.model._meta.pk.name
+        first_photo = first_related_sql(self, field, value_field, self.model.first_photo_ordering)
+        return self.extra(select={'first_photo_id': first_photo})
+
+
 class ActiveManager(ActiveManagerMixin, models.QuerySet):
     """
     Manager to filter active instances
@@ -74,6 +140,34 @@ class PhotoChunkedManager(models.Manager):
         return self.filter(status=getattr(self.model, 'COMPLETE', COMPLETED_UPLOAD))
 
 
+class PhotoContentManager(models.Manager):
+    """
+    A manager to keep the reference count of the stored contents
+    """
+
+    def add_reference(self, sha256, name, size=0):
+        """
+        Register a new reference to a stored content, creating it the first time.
+        :param sha256: hex digest of the content
+        :param name: key of the content in the storage
+        :param size: size of the content (bytes)
+        :return: content instance
+        """
+        content, created = self.get_or_create(sha256=sha256, defaults={'name': name, 'size': size, 'references': 1})
+        if not created:
+            # the key is updated because the content may have been stored again under a new name
+            self.filter(pk=content.pk).update(references=F('references') + 1, name=name)
+        return content
+
+    def remove_reference(self, name):
+        """
+        Unregister a reference to the stored content with this key. The stored file is kept.
+        :param name: key of the content in the storage
+        :return: number of updated contents
+        """
+        return self.filter(name=name, references__gt=0).update(references=F('references') - 1)
+
+
 class KeywordManager(_TaggableManager):
 
     def _get_tagged_keywords(self, **kwargs):
@@ -87,8 +181,17 @@ class KeywordManager(_TaggableManager):
         return kwargs
 
     def get_queryset(self, extra_filters=None):
+        """
+        Tagged keywords of the instance. If they have been prefetched through the generic relation (see
+        'PhotoManager.for_index'), the cached result is returned.
+        """
+        if not extra_filters:
+            try:
+                return self.instance._prefetched_objects_cache[TAGGED_KEYWORDS_RELATION]
+            except (AttributeError, KeyError):
+                pass
         kwargs = extra_filters if extra_filters else {}
-        return self._get_tagged_keywords(**kwargs)
+        return self._get_tagged_keywords(**kwargs).select_related('tag')
 
     @require_instance_manager
     def add(self, *tags, language=None, cleanup=False):
@@ -125,7 +228,7 @@ class KeywordManager(_TaggableManager):
         )
 
 
-class AlbumManager(ActiveManager):
+class AlbumManager(FirstPhotoManagerMixin, ActiveManager):
     """
     Manager to get active albums.
     """
@@ -141,6 +244,12 @@ class AlbumManager(ActiveManager):
         self.model.photos_album.field.model.objects.filter(album__in=self).soft_delete()
 
 
+class GalleryManager(FirstPhotoManagerMixin, models.QuerySet):
+    """
+    Manager for galleries
+    """
+
+
 class PhotoManager(ActiveManager):
     """
     Manager to get active galleries
@@ -151,8 +260,82 @@ class PhotoManager(ActiveManager):
         """
         Soft delete all elements of queryset. (mark as inactive).
         """
-        # update active status of each photo and mark as private
-        super().soft_delete()
-        self.update(status=self.model.PRIVATE)
-        # delete photo-gallery relation (GalleryMembership)
-        self.model.photo_galleries.field.model.objects.filter(photo__in=self).delete()
+        with self.keep_photo_counts():
+            # update active status of each photo and mark as private
+            super().soft_delete()
+            self.update(status=self.model.PRIVATE)
+            # delete photo-gallery relation (GalleryMembership)
+            self.model.photo_galleries.field.model.objects.filter(photo__in=self).delete()
+
+    def count_photos(self):
+        """
+        :return: tuple with the number of active and published photos of the queryset
+        """
+        counts = self.order_by().aggregate(
+            active=Count(Case(When(is_active=True, then=1))),
+            published=Count(Case(When(is_active=True, status=self.model.PUBLISHED, then=1))),
+        )
+        return counts['active'], counts['published']
+
+    def photo_counts(self, lookup):
+        """
+        Number of active and published photos of the queryset grouped by a related model.
+        :param lookup: lookup of the related instance id from photos
+        :return: dict of related instance id: (active photos, published photos)
+        """
+        # the ordering is added to the group by, and translated querysets set the default ordering again on each
+        # copy without ordering, so it is cleared in the last step
+        rows = self.filter(is_active=True).values_list(lookup).annotate(
+            active=Count('id'), published=Count(Case(When(status=self.model.PUBLISHED, then=1)))).order_by()
+        return {pk: (active, published) for pk, active, published in rows if pk is not None}
+
+    def relation_photo_counts(self):
+        """
+        :return: dict of model with photo counters: photo counts of the queryset by instance id (see 'photo_counts')
+        """
+        return {model: self.photo_counts(model.photo_count_lookup) for model in self.model.get_photo_count_models()}
+
+    def update_photo_counts(self, sign=1):
+        """
+        Add the photos of the queryset to the photo counters of their albums, galleries and taxonomies.
+        :param sign: 1 to add the photos, -1 to subtract them
+        """
+        for model, counts in self.relation_photo_counts().items():
+            model.update_photo_counts(counts, sign)
+
+    @contextmanager
+    def keep_photo_counts(self):
+        """
+        Keep the photo counters updated with set-based changes of the photos of the queryset, which do not send
+        signals. The photos are counted before and after the block and the counters are updated with the
+        differences, while signal handlers are paused.
+        """
+        photos = self.model.objects.filter(id__in=list(self.order_by().values_list('id', flat=True)))
+        before = photos.relation_photo_counts()
+        with photo_counts_state.pause():
+            yield photos
+        for model, counts in photos.relation_photo_counts().items():
+            model.update_photo_counts(count_differences(before[model], counts))
+
+    def visible_for(self, user):
+        """
+        Photos which a non admin user can list: their own photos, photos of the albums they own and published photos.
+        Album ownership is checked with a subquery over the album owners instead of a join, so photo rows are not
+        multiplied and the queryset does not need to be distinct.
+        """
+        album_owners = self.model._meta.get_field('album').related_model.owners.through
+        album_ids = album_owners.objects.filter(user=user).values('album_id')
+        return self.filter(Q(owner=user) | Q(album_id__in=album_ids) | Q(status=self.model.PUBLISHED))
+
+    def for_index(self):
+        """
+        Photos with all related data required to prepare their search index documents, so the number of queries does
+        not depend on the number of photos.
+        """
+        tagged_keywords = self.model._meta.get_field(TAGGED_KEYWORDS_RELATION).related_model
+        return self.select_related(
+            'author', 'album', 'copyright', 'internal_usage_restriction', 'external_usage_restriction',
+        ).prefetch_related(
+            'categories', 'names',
+            Prefetch(TAGGED_KEYWORDS_RELATION, queryset=tagged_keywords.objects.select_related('tag')),
+        )
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bima_core', '0007_auto_20170727_1543'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PhotoContent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True, verbose_name='SHA-256')),
+                ('name', models.CharField(db_index=True, max_length=200, verbose_name='Storage key')),
+                ('size', models.BigIntegerField(default=0, verbose_name='Size (bytes)')),
+                ('references', models.PositiveIntegerField(default=0, verbose_name='References')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Creation date')),
+            ],
+            options={
+                'verbose_name': 'Photo content',
+                'verbose_name_plural': 'Photo contents',
+            },
+        ),
+        migrations.AddField(
+            model_name='photochunked',
+            name='sha256',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=64, verbose_name='SHA-256'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bima_core', '0008_photo_content'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photochunked',
+            name='parallel',
+            field=models.BooleanField(default=False, verbose_name='Parallel upload'),
+        ),
+        migrations.AddField(
+            model_name='photochunked',
+            name='size',
+            field=models.BigIntegerField(blank=True, null=True, verbose_name='Size (bytes)'),
+        ),
+        migrations.AddField(
+            model_name='photochunked',
+            name='received_ranges',
+            field=models.TextField(blank=True, default='', verbose_name='Received ranges'),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bima_core', '0009_photochunked_parallel'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='album',
+            name='photos_count',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Active photos'),
+        ),
+        migrations.AddField(
+            model_name='album',
+            name='published_photos_count',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Published photos'),
+        ),
+        migrations.AddField(
+            model_name='gallery',
+            name='photos_count',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Active photos'),
+        ),
+        migrations.AddField(
+            model_name='gallery',
+            name='published_photos_count',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Published photos'),
+        ),
+        migrations.AddField(
+            model_name='damtaxonomy',
+            name='photos_count',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Active photos'),
+        ),
+        migrations.AddField(
+            model_name='damtaxonomy',
+            name='published_photos_count',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Published photos'),
+        ),
+        migrations.AddField(
+            model_name='damtaxonomy',
+            name='subtree_photos_count',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Active photos of subtree'),
+        ),
+        migrations.AddField(
+            model_name='damtaxonomy',
+            name='subtree_published_photos_count',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Published photos of subtree'),
+        ),
+    ]
@@ -2,25 +2,33 @@
 from categories.models import CategoryBase
 from constance import config
 from django.conf import settings
-from django.db import models
+from django.contrib.contenttypes.fields import GenericRelation
+from django.core.files.images import get_image_dimensions
+from django.db import models, transaction
+from django.db.models import F
 from django.utils.text import slugify
 from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _, ugettext as _i
 from django.contrib.auth.models import AbstractUser, Group as _Group
-from django_thumbor import generate_url
 from drf_chunked_upload.models import ChunkedUpload
 from exifread import process_file
 from geoposition.fields import GeopositionField
 from hashfs import HashFS
 from taggit.managers import TaggableManager
 from taggit.models import GenericTaggedItemBase, Tag
+from .constants import IMAGE_CHUNK_SIZE, IMAGE_HASH_ALGORITHM, IMAGE_HASH_ATTR, COVER_PHOTO_ATTR, \
+    TAXONOMY_TREE_ANCESTORS_ATTR, TAXONOMY_TREE_CHILDREN_ATTR
 from .fields import LanguageField
-from .managers import TaxonomyManager, PhotoChunkedManager, KeywordManager, AlbumManager, PhotoManager, UserManager
+from .managers import TaxonomyManager, PhotoChunkedManager, KeywordManager, AlbumManager, PhotoManager, UserManager, \
+    PhotoContentManager, GalleryManager
 from .permissions import UserPermissionMixin, AlbumPermissionMixin, PhotoPermissionMixin, \
     GalleryPermissionMixin, GalleryMembershipPermissionMixin, TaxonomyPermissionMixin, AccessLogPermissionMixin, \
     GroupPermissionMixin, PhotoChunkPermissionMixin, RightPermissionMixin, ReadPermissionMixin
 from .utils import idpath, get_exif_info, get_exif_datetime, get_exif_longitude, get_exif_latitude, \
-    get_exif_altitude, build_absolute_uri
+    get_exif_altitude, build_absolute_uri, generate_thumbor_url, file_hash, chunk_digests, merge_ranges, missing_ranges
+from collections import OrderedDict, defaultdict
+from operator import attrgetter
+import json
 import logging
 import os
 import six
@@ -115,6 +123,89 @@ class AbstractTitleSlugModel(AbstractSlugModel):
         abstract = True
 
 
+class AbstractPhotoCountModel(models.Model):
+    """
+    Abstract class with denormalized counters of the active and published photos of each instance. The counters are
+    updated with the differences of the photo changes, by signal handlers and by set-based photo updates (see
+    'PhotoManager.keep_photo_counts'), and they can be checked with the 'repair_photo_counts' command.
+    """
+    # lookup of the instance id from photos
+    photo_count_lookup = None
+
+    photos_count = models.IntegerField(default=0, editable=False, verbose_name=_('Active photos'))
+    published_photos_count = models.IntegerField(default=0, editable=False, verbose_name=_('Published photos'))
+
+    @staticmethod
+    def group_photo_counts(counts, sign=1):
+        """
+        :param counts: dict of instance id: (active photos, published photos)
+        :return: dict of (active photos, published photos): list of instance ids
+        """
+        grouped = defaultdict(list)
+        for pk, (active, published) in counts.items():
+            if pk is not None and (active or published):
+                grouped[(sign * active, sign * published)].append(pk)
+        return grouped
+
+    @classmethod
+    def update_photo_counts(cls, counts, sign=1):
+        """
+        Add photo counts to the counters of many instances, with a query for each distinct count.
+        :param counts: dict of instance id: (active photos, published photos)
+        :param sign: 1 to add the counts, -1 to subtract them
+        """
+        for (active, published), ids in cls.group_photo_counts(counts, sign).items():
+            cls._base_manager.filter(pk__in=ids).update(
+                photos_count=F('photos_count') + active, published_photos_count=F('published_photos_count') + published)
+
+    class Meta:
+        abstract = True
+
+
+class CoverPhotoMixin(object):
+    """
+    Mixin for models represented by a photo: their cover or, otherwise, their first photo (see 'get_first_photo').
+    Models define where the first photo comes from:
+        - first_photo_relation: name of the reverse relation to the related instances
+        - first_photo_field: name of the photo foreign key of the related instances, or None if they are photos
+        - first_photo_ordering: ordering of the related instances
+    """
+    first_photo_relation = None
+    first_photo_field = None
+    first_photo_ordering = ('id', )
+
+    @property
+    def photo(self):
+        """
+        :return: cover or the first photo instance or None
+        """
+        if hasattr(self, COVER_PHOTO_ATTR):
+            return getattr(self, COVER_PHOTO_ATTR)
+        return self.cover or self.get_first_photo()
+
+    def get_first_photo(self):
+        """
+        :return: the photo of the first related instance or None
+        """
+        related = getattr(self, self.first_photo_relation).order_by(*self.first_photo_ordering).first()
+        if self.first_photo_field is None:
+            return related
+        return getattr(related, self.first_photo_field, None)
+
+    @classmethod
+    def prefetch_photos(cls, instances):
+        """
+        Fetch the photos of many instances with a single query. Instances without cover must be annotated with the id
+        of their first photo ('first_photo_id', see 'with_first_photo' of their manager) or they will query it later.
+        """
+        photo_ids = [(instance, instance.cover_id or getattr(instance, 'first_photo_id', None))
+                     for instance in instances
+                     if instance.cover_id or hasattr(instance, 'first_photo_id')]
+        photos = Photo.objects.in_bulk([pk for instance, pk in photo_ids if pk])
+        for instance, pk in photo_ids:
+            setattr(instance, COVER_PHOTO_ATTR, photos.get(pk))
+
+
 #
 # Back-office models
 #
@@ -183,10 +274,14 @@ class PhotoType(ReadPermissionMixin, models.Model):
         ordering = ('name', )
 
 
-class Album(AlbumPermissionMixin, SoftDeleteModelMixin, models.Model):
+class Album(AlbumPermissionMixin, SoftDeleteModelMixin, CoverPhotoMixin, AbstractPhotoCountModel):
     """
     Model to represent a physical grouping of photos. Each photo belongs to an album and only to one.
     """
+    photo_count_lookup = 'album'
+    # the first photo is the last modified one
+    first_photo_relation = 'photos_album'
+    first_photo_ordering = ('-modified_at', '-id', )
 
     title = models.CharField(max_length=128, verbose_name=_('Title'))
     description = models.TextField(verbose_name=_('Description'))
@@ -204,13 +299,6 @@ class Album(AlbumPermissionMixin, SoftDeleteModelMixin, models.Model):
     def __str__(self):
         return self.title
 
-    @property
-    def photo(self):
-        """
-        :return: Album cover or the first photo instance of the album or None
-        """
-        return self.cover or self.photos_album.first()
-
     def is_membership(self, user):
         return user in self.owners.all()
 
@@ -332,11 +420,27 @@ class Photo(PhotoPermissionMixin, SoftDeleteModelMixin, models.Model):
         (UPLOADED, _('Uploaded')),
     )
 
+    # size name: (constance width, constance height, thumbor params)
+    THUMBOR_SIZES = {
+        'thumbnail': ('THUMBNAIL_WITH', 'THUMBNAIL_HEIGHT', {'smart': False, 'fit_in': True}),
+        'small_fit': ('IMAGE_SMALL_WITH', 'IMAGE_SMALL_HEIGHT', {'smart': False, 'fit_in': True}),
+        'small': ('IMAGE_SMALL_WITH', 'IMAGE_SMALL_HEIGHT', {'auto_resize': True}),
+        'medium': ('IMAGE_MEDIUM_WITH', 'IMAGE_MEDIUM_HEIGHT', {'auto_resize': True}),
+        'large': ('IMAGE_LARGE_WITH', 'IMAGE_LARGE_HEIGHT', {'auto_resize': True}),
+        'original': (None, None, {}),
+    }
+
     def image_path(instance, filename):
+        """
+        Content addressed path of the image. The image is hashed in chunks, so memory is bounded whatever its size,
+        unless its hash has been already computed and set in the instance.
+        """
         basename, ext = os.path.splitext(filename)
         fs = HashFS('photos', depth=4, width=2, algorithm='sha256')
-        stream = getattr(instance, 'image').chunks()
-        id = fs.computehash(stream)
+        id = getattr(instance, IMAGE_HASH_ATTR, None)
+        if not id:
+            stream = getattr(instance, 'image').chunks(chunk_size=IMAGE_CHUNK_SIZE)
+            id = fs.computehash(stream)
         return idpath(fs, id, extension=ext)
 
     # new fields
@@ -396,6 +500,7 @@ class Photo(PhotoPermissionMixin, SoftDeleteModelMixin, models.Model):
     keywords = TaggableManager(blank=True, through=TaggedKeyword, manager=KeywordManager, verbose_name=_('Keywords'),
                                related_name='keyword_photos')
     names = TaggableManager(blank=True, through=TaggedName, verbose_name=_('Names'), related_name='name_photos')
+    tagged_keywords = GenericRelation(TaggedKeyword)
     album = models.ForeignKey(Album, verbose_name=_('Album'), related_name='photos_album')
 
     # Timestamp meta information
@@ -409,6 +514,38 @@ class Photo(PhotoPermissionMixin, SoftDeleteModelMixin, models.Model):
     def __str__(self):
         return self.title
 
+    @staticmethod
+    def get_photo_count_models():
+        """
+        :return: models with counters of their photos
+        """
+        return Album, Gallery, DAMTaxonomy
+
+    @property
+    def photo_count_state(self):
+        """
+        Album of the photo and how the photo is counted in the photo counters, or None if any required field is
+        deferred, so they are never loaded only to count photos.
+        :return: tuple (album id, (active photos, published photos))
+        """
+        if not {'album_id', 'is_active', 'status'}.issubset(self.__dict__):
+            return None
+        active = 1 if self.is_active else 0
+        return self.album_id, (active, 1 if active and self.status == self.PUBLISHED else 0)
+
+    def get_relation_photo_counts(self, model, counts):
+        """
+        Photo counts of this photo for the related instances of a model with photo counters.
+        :param model: model with photo counters
+        :param counts: tuple (active photos, published photos) of the photo
+        :return: dict of instance id: (active photos, published photos)
+        """
+        related_counts = defaultdict(lambda: (0, 0))
+        for pk in type(self).objects.filter(pk=self.pk).order_by().values_list(model.photo_count_lookup, flat=True):
+            if pk is not None:
+                related_counts[pk] = tuple(total + count for total, count in zip(related_counts[pk], counts))
+        return dict(related_counts)
+
     @property
     def is_horizontal(self):
         """
@@ -426,27 +563,27 @@ class Photo(PhotoPermissionMixin, SoftDeleteModelMixin, models.Model):
 
     @property
     def image_thumbnail(self):
-        return self._generate_url(config.THUMBNAIL_WITH, config.THUMBNAIL_HEIGHT, smart=False, fit_in=True)
+        return self.get_image_url('thumbnail')
 
     @property
     def image_small_fit(self):
-        return self._generate_url(config.IMAGE_SMALL_WITH, config.IMAGE_SMALL_HEIGHT, smart=False, fit_in=True)
+        return self.get_image_url('small_fit')
 
     @property
     def image_small(self):
-        return self._generate_url(config.IMAGE_SMALL_WITH, config.IMAGE_SMALL_HEIGHT, auto_resize=True)
+        return self.get_image_url('small')
 
     @property
     def image_medium(self):
-        return self._generate_url(config.IMAGE_MEDIUM_WITH, config.IMAGE_MEDIUM_HEIGHT, auto_resize=True)
+        return self.get_image_url('medium')
 
     @property
     def image_large(self):
-        return self._generate_url(config.IMAGE_LARGE_WITH, config.IMAGE_LARGE_HEIGHT, auto_resize=True)
+        return self.get_image_url('large')
 
     @property
     def image_original(self):
-        return self._generate_url()
+        return self.get_image_url('original')
 
     @property
     def image_file(self):
@@ -457,6 +594,30 @@ class Photo(PhotoPermissionMixin, SoftDeleteModelMixin, models.Model):
         if self.flickr_id and self.flickr_username:
             return build_absolute_uri(config.FLICKR_PHOTO_URL, '', args=[self.flickr_username, self.flickr_id, ])
 
+    @classmethod
+    def get_thumbor_params(cls, size):
+        """
+        Get the params to generate the thumbor url of a size from the current constance config.
+        :param size: one of 'THUMBOR_SIZES'
+        :return: dict
+        """
+        width, height, params = cls.THUMBOR_SIZES[size]
+        params = dict(params)
+        if width and height:
+            params.update({'width': getattr(config, width), 'height': getattr(config, height)})
+        if params.get('fit_in'):
+            params['fill_colour'] = config.THUMBNAIL_FILL_COLOUR
+        return params
+
+    def get_image_url(self, size, thumbor_params=None):
+        """
+        Generate the thumbor url of the image in the required size.
+        :param size: one of 'THUMBOR_SIZES'
+        :param thumbor_params: params of the size if they have been already got with 'get_thumbor_params'
+        :return: string
+        """
+        return self._generate_url(**(thumbor_params or self.get_thumbor_params(size)))
+
     def _generate_url(self, width=None, height=None, smart=False, fit_in=False, fill_colour=None, auto_resize=False):
         image_url = "{}/{}".format(getattr(settings, 'AWS_LOCATION', ''), self.image.name).strip('/')
 
@@ -467,7 +628,7 @@ class Photo(PhotoPermissionMixin, SoftDeleteModelMixin, models.Model):
         thumbor_params = {key: value for key, value in zip(['width', 'height', ], size) if value}
 
         # set default filter to always generate a jpeg image format
-        thumbor_params['filters'] = ['format(jpeg)', ]
+        filters = ['format(jpeg)', ]
 
         # delete height or width param according photo orientation to auto resize it
         if auto_resize:
@@ -476,48 +637,46 @@ class Photo(PhotoPermissionMixin, SoftDeleteModelMixin, models.Model):
         # set auto-fill filter and default colour
         if fit_in:
             fill_colour = (fill_colour or config.THUMBNAIL_FILL_COLOUR).strip('#')
-            filters = thumbor_params.get('filters', [])
             filters.append('fill({})'.format(fill_colour))
-            thumbor_params.update({'filters': filters})
-
-        url = generate_url(image_url, smart=smart, fit_in=fit_in, **thumbor_params)
 
-        # remove unsave string from thumbor url
-        if getattr(settings, 'THUMBOR_URL_REMOVE_UNSAFE', False):
-            url = url.replace('/unsafe/', '/')
-
-        # add prefix to media url
-        prefix = getattr(settings, 'THUMBOR_MEDIA_URL_PREFIX', '')
-        if prefix:
-            media_url = getattr(settings, 'THUMBOR_MEDIA_URL', '')
-            url = url.replace("/{}/".format(media_url), "/{}/{}/".format(prefix, media_url))
-
-        return url
+        # signed urls are memoized by all params which build them, so any change of the image or size settings
+        # generates a new one
+        return generate_thumbor_url(image_url, thumbor_params.get('width'), thumbor_params.get('height'),
+                                    smart=smart, fit_in=fit_in, filters=tuple(filters))
 
     def is_owner(self, user):
         return user == self.owner
 
     def is_membership(self, user):
-        return self.is_owner(user) or user in self.album.owners.all()
+        return getattr(user, 'id', None) in self.get_owner_ids()
 
-    def get_image_metadata(self, with_exif=True):
+    def get_image_metadata(self, with_exif=True, image_file=None):
         """
         Method to extract metadata from existing image.
         Continue if saving image content although get some error extracting it
+        :param with_exif: extract exif info too
+        :param image_file: local file (django File) with the image content. If it is not specified the image is read
+        from the storage, which is only recommended to fill metadata of already uploaded images.
         """
         # do not extracting metadata while does not image exists
-        if not self.image:
+        if not (image_file or self.image):
             return
+        if image_file is None:
+            image_file = self.image
+            width, height = self.image.width, self.image.height
+        else:
+            width, height = get_image_dimensions(image_file)
         # get image metadata
         metadata = {
-            'width': self.image.width or 0,
-            'height': self.image.height or 0,
-            'size': self.image.size,
+            'width': width or 0,
+            'height': height or 0,
+            'size': image_file.size,
         }
         # get exif of image file
         if with_exif:
             try:
-                exif_info = process_file(self.image.file, details=False)
+                image_file.seek(0)
+                exif_info = process_file(image_file, details=False)
                 if exif_info:
                     metadata.update({
                         'exif_date': get_exif_datetime(exif_info, 'EXIF DateTimeOriginal'),
@@ -531,14 +690,15 @@ class Photo(PhotoPermissionMixin, SoftDeleteModelMixin, models.Model):
                 logger.error("Error processing exif from {} photo\n\n{}".format(self.title, exc), exc_info=True)
         return metadata
 
-    def set_metadata(self, only_readable=True, with_exif=True, commit=True):
+    def set_metadata(self, only_readable=True, with_exif=True, commit=True, image_file=None):
         """
         Assign all only readable metadata to respective fields PhotoExif model.
         The operation of the assignment is that, the values of metadata that come from the API and do not evaluate to
         False prevail over those calculated from the content of the image.
+        :param image_file: local file to extract metadata (see 'get_image_metadata')
         """
         # do not updating metadata while does not image exists
-        if not self.image:
+        if not (image_file or self.image):
             return
 
         # create photo exif if not exist
@@ -546,7 +706,7 @@ class Photo(PhotoPermissionMixin, SoftDeleteModelMixin, models.Model):
             self.exif = PhotoExif.objects.create()
 
         # set values into exif instance
-        for k, v in six.iteritems(self.get_image_metadata(with_exif)):
+        for k, v in six.iteritems(self.get_image_metadata(with_exif, image_file=image_file)):
             # This condition allows assign value to metadata fields without being overwritten by those in the image
             if not only_readable and (not getattr(self, k, None) and v):
                 setattr(self, k, v)
@@ -569,6 +729,13 @@ class PhotoChunked(PhotoChunkPermissionMixin, ChunkedUpload):
     This model permits to upload big images in parts.
     """
 
+    sha256 = models.CharField(max_length=64, blank=True, default='', db_index=True, verbose_name=_('SHA-256'))
+
+    # parallel uploads receive chunks in any order, which are written in their position of a preallocated file
+    parallel = models.BooleanField(default=False, verbose_name=_('Parallel upload'))
+    size = models.BigIntegerField(blank=True, null=True, verbose_name=_('Size (bytes)'))
+    received_ranges = models.TextField(blank=True, default='', verbose_name=_('Received ranges'))
+
     objects = PhotoChunkedManager()
 
     class Meta:
@@ -576,10 +743,28 @@ class PhotoChunked(PhotoChunkPermissionMixin, ChunkedUpload):
         verbose_name_plural = _('Photo chunks')
         ordering = ('-completed_at', '-status', '-created_at', )
 
+    @property
+    def digests(self):
+        """
+        Digests of the uploaded bytes, updated with each chunk, or None if they are not available in this process.
+        """
+        return chunk_digests.hexdigests(self.id, self.offset)
+
+    @property
+    def md5(self):
+        """
+        Returns the md5 of the uploaded bytes, reading the file only if it has not been computed with the chunks.
+        """
+        digests = self.digests
+        if digests and getattr(self, '_md5', None) is None:
+            self._md5 = digests['md5']
+        return super().md5
+
     @property
     def md5_missing_file(self):
         """
-        Returns the md5 of the file or '' if the file does not exist.
+        Returns the md5 of the file or '' if the file does not exist. It is computed with the chunks when all of them
+        have been received by this process (see 'DigestRegistry'), otherwise the file is read again.
         """
         try:
             return self.md5
@@ -587,13 +772,126 @@ class PhotoChunked(PhotoChunkPermissionMixin, ChunkedUpload):
             logger.debug('File not found')
             return ''
 
+    def append_chunk(self, chunk, chunk_size=None, save=True):
+        """
+        Append a chunk to the file and update the digests of the uploaded bytes with it. The chunk is written by parts,
+        so it is not loaded whole in memory.
+        """
+        self.close_file()
+        self.file.open(mode='ab')
+        position = self.offset
+        for data in chunk.chunks():
+            chunk_digests.update(self.id, position, data)
+            self.file.write(data)
+            position += len(data)
+        self.offset = self.offset + chunk_size if chunk_size is not None else position
+        self._md5 = None
+        if save:
+            self.save()
+        self.close_file()
+
+    def get_received_ranges(self):
+        """
+        Byte ranges of the file received by a parallel upload, as a sorted list of [start, end].
+        """
+        return json.loads(self.received_ranges) if self.received_ranges else []
+
+    @property
+    def missing_ranges(self):
+        """
+        Byte ranges of the file not received yet by a parallel upload.
+        """
+        return missing_ranges(self.get_received_ranges(), self.size or 0)
+
+    def preallocate(self):
+        """
+        Allocate the whole size of the file of a parallel upload, so chunks can be written in any position.
+        """
+        self.close_file()
+        with open(self.file.path, 'r+b') as f:
+            f.truncate(self.size)
+
+    def write_chunk(self, chunk, start):
+        """
+        Write a chunk of a parallel upload in its position and register its range. Chunks can be written concurrently,
+        so only the registration of the range is serialized by locking the upload row.
+        :param chunk: django file
+        :param start: position of the chunk in the file
+        """
+        self.close_file()
+        with open(self.file.path, 'r+b') as f:
+            f.seek(start)
+            for data in chunk.chunks():
+                f.write(data)
+
+        with transaction.atomic():
+            self.received_ranges = type(self).objects.select_for_update().values_list(
+                'received_ranges', flat=True).get(pk=self.pk)
+            ranges = merge_ranges(self.get_received_ranges() + [[start, start + chunk.size]])
+            self.received_ranges = json.dumps(ranges)
+            self.offset = sum(end - begin for begin, end in ranges)
+            self.save(update_fields=['received_ranges', 'offset'])
+
+    def register_digests(self):
+        """
+        Read the whole file once to register its digests, when they could not be computed with the chunks.
+        """
+        chunk_digests.discard(self.id)
+        self.file.open('rb')
+        position = 0
+        for data in self.file.chunks(chunk_size=IMAGE_CHUNK_SIZE):
+            chunk_digests.update(self.id, position, data)
+            position += len(data)
+        self.close_file()
+
+    def completed(self, *args, **kwargs):
+        """
+        Mark the upload as completed with the sha256 of the file, which is the content address of the image in the
+        storage.
+        """
+        digests = self.digests
+        if digests:
+            self.sha256 = digests[IMAGE_HASH_ALGORITHM]
+        else:
+            self.file.open('rb')
+            self.sha256 = file_hash(self.file)
+        self.close_file()
+        super().completed(*args, **kwargs)
+        chunk_digests.discard(self.id)
+
+
+class PhotoContent(models.Model):
+    """
+    Index of the image contents saved in the storage by their sha256, with the number of photos which reference
+    each one. It allows to reuse stored contents instead of uploading the same image again.
+    """
+
+    sha256 = models.CharField(max_length=64, unique=True, verbose_name=_('SHA-256'))
+    name = models.CharField(max_length=200, db_index=True, verbose_name=_('Storage key'))
+    size = models.BigIntegerField(default=0, verbose_name=_('Size (bytes)'))
+    references = models.PositiveIntegerField(default=0, verbose_name=_('References'))
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name=_('Creation date'))
+
+    objects = PhotoContentManager()
+
+    def __str__(self):
+        return self.name
+
+    class Meta:
+        verbose_name = _('Photo content')
+        verbose_name_plural = _('Photo contents')
+
 
-class Gallery(GalleryPermissionMixin, AbstractTimestampModel):
+class Gallery(GalleryPermissionMixin, CoverPhotoMixin, AbstractPhotoCountModel, AbstractTimestampModel):
     """
     Model for galleries, which represents a logical set of photos.
     By default, each gallery is private and has not an image cover.
     The attribute 'owners' represents all users who can access to it (according to their privileges).
     """
+    photo_count_lookup = 'photo_galleries__gallery'
+    # the first photo is the first linked one
+    first_photo_relation = 'galleries_membership'
+    first_photo_field = 'photo'
 
     PRIVATE = 0
     PUBLISHED = 1
@@ -612,16 +910,11 @@ class Gallery(GalleryPermissionMixin, AbstractTimestampModel):
 
     owners = models.ManyToManyField(User, related_name='user_galleries')
 
+    objects = GalleryManager.as_manager()
+
     def __str__(self):
         return self.title
 
-    @property
-    def photo(self):
-        """
-        :return: Gallery cover or the first photo instance of the gallery or None
-        """
-        return self.cover or getattr(self.galleries_membership.first(), 'photo', None)
-
     def is_membership(self, user):
         return user in self.owners.all()
 
@@ -643,17 +936,115 @@ class GalleryMembership(GalleryMembershipPermissionMixin, models.Model):
     added_by = models.ForeignKey(User, related_name='user_albums')
 
 
-class DAMTaxonomy(TaxonomyPermissionMixin, CategoryBase):
+class DAMTaxonomy(TaxonomyPermissionMixin, AbstractPhotoCountModel, CategoryBase):
     """
     Model to categorize photos.
     It is a hierarchical structure with unique slug and optional code.
+    Besides its own photo counters, each taxonomy has the counters of its whole subtree, which add up the photos of
+    the taxonomy and all its descendants.
     """
+    photo_count_lookup = 'categories'
+
     code = models.CharField(_('code'), max_length=50, blank=True)
     slug = models.SlugField(verbose_name=_('slug'), max_length=200)
+    subtree_photos_count = models.IntegerField(default=0, editable=False, verbose_name=_('Active photos of subtree'))
+    subtree_published_photos_count = models.IntegerField(default=0, editable=False,
+                                                         verbose_name=_('Published photos of subtree'))
     parents = TaxonomyManager()
 
+    @classmethod
+    def update_photo_counts(cls, counts, sign=1):
+        """
+        Add photo counts to the counters of many taxonomies, and to the subtree counters of them and their ancestors.
+        """
+        super().update_photo_counts(counts, sign)
+        for (active, published), ids in cls.group_photo_counts(counts, sign).items():
+            for tree_id, lft, rght in cls._base_manager.filter(pk__in=ids).values_list('tree_id', 'lft', 'rght'):
+                cls._base_manager.filter(tree_id=tree_id, lft__lte=lft, rght__gte=rght).update(
+                    subtree_photos_count=F('subtree_photos_count') + active,
+                    subtree_published_photos_count=F('subtree_published_photos_count') + published,
+                )
+
+    @classmethod
+    def get_subtree_photo_counts(cls, counts=None):
+        """
+        Subtree counters of all taxonomies, added up from the deepest level to the roots.
+        :param counts: dict of taxonomy id: (active photos, published photos). The stored counters by default
+        :return: dict of taxonomy id: (active photos, published photos)
+        """
+        subtree_counts = defaultdict(lambda: (0, 0))
+        nodes = cls._base_manager.order_by('-level').values_list(
+            'id', 'parent_id', 'photos_count', 'published_photos_count')
+        for pk, parent_id, active, published in nodes:
+            own_counts = (active, published) if counts is None else counts.get(pk, (0, 0))
+            subtree_counts[pk] = tuple(total + count for total, count in zip(subtree_counts[pk], own_counts))
+            if parent_id is not None:
+                subtree_counts[parent_id] = tuple(
+                    total + count for total, count in zip(subtree_counts[parent_id], subtree_counts[pk]))
+        return dict(subtree_counts)
+
+    @classmethod
+    def rollup_photo_counts(cls):
+        """
+        Compute again the subtree counters of all taxonomies from their own counters, when the tree changes.
+        :return: number of updated taxonomies
+        """
+        stored_counts = {pk: (active, published) for pk, active, published in cls._base_manager.values_list(
+            'id', 'subtree_photos_count', 'subtree_published_photos_count')}
+        subtree_counts = {pk: counts for pk, counts in cls.get_subtree_photo_counts().items()
+                          if pk in stored_counts and stored_counts[pk] != counts}
+        for pk, (active, published) in subtree_counts.items():
+            cls._base_manager.filter(pk=pk).update(
+                subtree_photos_count=active, subtree_published_photos_count=published)
+        return len(subtree_counts)
+
+    @classmethod
+    def load_tree(cls, tree_ids=None):
+        """
+        Fetch whole trees with a single query ordered by tree and left value, and link their nodes in memory: the
+        parent, the children (see 'tree_children') and the ancestors of each node are resolved without queries.
+        :param tree_ids: ids of the trees to load. All trees by default
+        :return: ordered dict of taxonomy id: taxonomy instance
+        """
+        queryset = cls._base_manager.order_by('tree_id', 'lft')
+        if tree_ids is not None:
+            queryset = queryset.filter(tree_id__in=tree_ids)
+
+        nodes, path = OrderedDict(), []
+        parent_cache = cls._meta.get_field('parent').get_cache_name()
+        for node in queryset:
+            # leave the nodes of the path which are not ancestors of this one
+            while path and (path[-1].tree_id != node.tree_id or path[-1].rght < node.lft):
+                path.pop()
+            setattr(node, TAXONOMY_TREE_ANCESTORS_ATTR, path[::-1])
+            setattr(node, TAXONOMY_TREE_CHILDREN_ATTR, [])
+            if path:
+                setattr(node, parent_cache, path[-1])
+                getattr(path[-1], TAXONOMY_TREE_CHILDREN_ATTR).append(node)
+            path.append(node)
+            nodes[node.id] = node
+
+        # children are listed in the default ordering, as the related manager does
+        for node in nodes.values():
+            getattr(node, TAXONOMY_TREE_CHILDREN_ATTR).sort(key=attrgetter('slug'))
+        return nodes
+
+    @property
+    def tree_children(self):
+        """
+        :return: children loaded by 'load_tree' or otherwise queried
+        """
+        if hasattr(self, TAXONOMY_TREE_CHILDREN_ATTR):
+            return getattr(self, TAXONOMY_TREE_CHILDREN_ATTR)
+        return self.children.all()
+
     @property
     def ancestors(self):
+        """
+        :return: ancestors from the parent to the root, loaded by 'load_tree' or otherwise queried
+        """
+        if hasattr(self, TAXONOMY_TREE_ANCESTORS_ATTR):
+            return getattr(self, TAXONOMY_TREE_ANCESTORS_ATTR)
         return self.get_ancestors(ascending=True, include_self=False)
 
     @property
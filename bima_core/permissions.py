@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
+from collections import defaultdict
+from functools import reduce
+from operator import or_
+from django.db.models import Q
 from dry_rest_permissions.generics import allow_staff_or_superuser
 
-from .constants import ADMIN_GROUP_NAME, EDITOR_GROUP_NAME, PHOTOGRAPHER_GROUP_NAME
+from .constants import ADMIN_GROUP_NAME, EDITOR_GROUP_NAME, PHOTOGRAPHER_GROUP_NAME, OWNER_IDS_CACHE_ATTR
 
 from .utils import belongs_to_admin_group, belongs_to_some_group, belongs_to_group, belongs_to_system, \
     is_staff_or_superuser
@@ -89,13 +93,58 @@ class PhotoPermissionMixin(object):
     Permission mixin for photo model access
     """
 
+    @classmethod
+    def prefetch_object_permissions(cls, instances):
+        """
+        Precompute the owners of a set of photos with a single query over the album owners, so object permissions
+        of all of them are evaluated without querying the database for each one.
+        """
+        photos = [photo for photo in instances if isinstance(photo, cls) and getattr(photo, 'album_id', None)]
+        if not photos:
+            return
+
+        album_owners = defaultdict(set)
+        through = cls._meta.get_field('album').related_model.owners.through
+        for album_id, user_id in through.objects.filter(album_id__in={photo.album_id for photo in photos}) \
+                .values_list('album_id', 'user_id'):
+            album_owners[album_id].add(user_id)
+
+        for photo in photos:
+            owner_ids = frozenset({photo.owner_id} | album_owners[photo.album_id])
+            setattr(photo, OWNER_IDS_CACHE_ATTR, (photo.album_id, owner_ids))
+
+    @classmethod
+    def filter_write_permission(cls, queryset, user):
+        """
+        Photos of the queryset which the user can write (see '_write_permission'), so the permission of a whole set
+        of photos is evaluated with a single query.
+        """
+        if is_staff_or_superuser(user) or belongs_to_admin_group(user):
+            return queryset
+        conditions = []
+        if belongs_to_group(user, EDITOR_GROUP_NAME):
+            conditions += [Q(owner=user), Q(album__owners=user)]
+        if belongs_to_group(user, PHOTOGRAPHER_GROUP_NAME):
+            conditions.append(Q(owner=user))
+        if not conditions:
+            return queryset.none()
+        return queryset.filter(reduce(or_, conditions))
+
+    def get_owner_ids(self):
+        """
+        Ids of the photo owner and the album owners. They are cached in the instance while the album does not change.
+        """
+        album_id, owner_ids = getattr(self, OWNER_IDS_CACHE_ATTR, (None, None))
+        if owner_ids is None or album_id != self.album_id:
+            owner_ids = frozenset({self.owner_id} | set(self.album.owners.values_list('id', flat=True)))
+            setattr(self, OWNER_IDS_CACHE_ATTR, (self.album_id, owner_ids))
+        return owner_ids
+
     def _read_or_create_permission(self, user):
-        owners = [self.owner.id, ] + list(self.album.owners.values_list('id', flat=True))
-        return belongs_to_admin_group(user) or getattr(user, 'id', -1) in owners
+        return belongs_to_admin_group(user) or getattr(user, 'id', -1) in self.get_owner_ids()
 
     def _editor_and_album_owner_permission(self, user):
-        owners = [self.owner.id, ] + list(self.album.owners.values_list('id', flat=True))
-        return belongs_to_group(user, EDITOR_GROUP_NAME) and getattr(user, 'id', -1) in owners
+        return belongs_to_group(user, EDITOR_GROUP_NAME) and getattr(user, 'id', -1) in self.get_owner_ids()
 
     def _photographer_and_owner(self, user):
         return belongs_to_group(user, PHOTOGRAPHER_GROUP_NAME) and user == self.owner
@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
 from django import forms
 from django.apps import apps
+from django.core.exceptions import ValidationError
 from dry_rest_permissions.generics import DRYPermissionsField
-from rest_framework import fields
+from rest_framework import fields, relations
 import django_filters
 
 
@@ -89,6 +90,44 @@ class PermissionField(DRYPermissionsField):
         return results
 
 
+class PrefetchedPrimaryKeyRelatedField(relations.PrimaryKeyRelatedField):
+    """
+    Primary key related field which looks up its values in a set of instances fetched in bulk (see 'prefetch'). If
+    the instances have not been prefetched it queries the database for each value, as the default field.
+    """
+    instances = None
+
+    def prefetch(self, values, queryset=None):
+        """
+        Fetch with a single query the instances of all values which will be validated by this field.
+        :param values: iterable of primary keys
+        :param queryset: queryset to fetch the instances. Default: queryset of the field
+        """
+        queryset = self.get_queryset() if queryset is None else queryset
+        pks = set()
+        for value in values:
+            try:
+                pk = self.to_pk(value)
+            except (TypeError, ValueError, ValidationError):
+                continue
+            if pk is not None:
+                pks.add(pk)
+        self.instances = queryset.in_bulk(pks)
+
+    def to_pk(self, data):
+        return self.get_queryset().model._meta.pk.to_python(data)
+
+    def to_internal_value(self, data):
+        if self.instances is None:
+            return super().to_internal_value(data)
+        try:
+            return self.instances[self.to_pk(data)]
+        except KeyError:
+            self.fail('does_not_exist', pk_value=data)
+        except (TypeError, ValueError, ValidationError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+
+
 # Django Filter
 
 
@@ -1,12 +1,204 @@
 # -*- coding: utf-8 -*-
+import base64
+import json
 import sys
 from collections import OrderedDict
 from constance import config
+from datetime import date
+from functools import partial
+from hashlib import md5
+from django.core.cache import cache
+from django.core.paginator import EmptyPage, Page, PageNotAnInteger, Paginator as DjangoPaginator
+from django.utils.translation import ugettext_lazy as _
+from rest_framework.exceptions import NotFound
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
 
+from bima_core.constants import COUNT_CACHE_PREFIX, COUNT_MODE_CACHED, COUNT_MODE_ESTIMATED, COUNT_MODE_EXACT
+from bima_core.utils import belongs_to_admin_group, estimate_count, is_staff_or_superuser, keyset_filter
 
-class NumberPagination(PageNumberPagination):
+
+class CountPaginator(DjangoPaginator):
+    """
+    Django paginator with a total number of objects which has been already counted
+    """
+    def __init__(self, object_list, per_page, count=None, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        if count is not None:
+            self.count = count
+
+
+class HintCountPage(Page):
+    """
+    Page which knows if there is a next page without the total number of objects
+    """
+    def __init__(self, object_list, number, paginator, has_next=False):
+        super().__init__(object_list, number, paginator)
+        self._has_next = has_next
+
+    def has_next(self):
+        return self._has_next
+
+
+class HintCountPaginator(CountPaginator):
+    """
+    Paginator for approximate counts, which are only a hint: page numbers are not validated against the count, and
+    one more object than the page size is fetched to know if there is a next page.
+    """
+
+    def validate_number(self, number):
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger(_('That page number is not an integer'))
+        if number < 1:
+            raise EmptyPage(_('That page number is less than 1'))
+        return number
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        object_list = list(self.object_list[bottom:bottom + self.per_page + 1])
+        if not object_list and number > 1:
+            raise EmptyPage(_('That page contains no results'))
+        return HintCountPage(object_list[:self.per_page], number, self, has_next=len(object_list) > self.per_page)
+
+
+class CountStrategyMixin(object):
+    """
+    Count the total items of a list with the strategy defined in 'PAGINATION_COUNT_MODE' constance config:
+        - exact: count query for each page.
+        - cached: exact count stored in cache by view, normalized filters and user visibility, during
+          'PAGINATION_COUNT_CACHE_TIMEOUT' seconds.
+        - estimated: query planner estimation when it is greater than 'PAGINATION_COUNT_ESTIMATE_THRESHOLD', otherwise
+          (or if the database cannot estimate) the exact count.
+    The mode which has produced the count is saved in 'count_mode'. Cached and estimated counts are only a hint of
+    the total items, so pages are not limited by them (see 'HintCountPaginator').
+    """
+    ignored_count_params = ('format', )
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count_mode = COUNT_MODE_EXACT
+        count = self.get_count(queryset, request, view)
+        paginator_class = CountPaginator if self.count_mode == COUNT_MODE_EXACT else HintCountPaginator
+        self.django_paginator_class = partial(paginator_class, count=count)
+        return super().paginate_queryset(queryset, request, view=view)
+
+    def get_count(self, queryset, request, view):
+        mode = config.PAGINATION_COUNT_MODE
+        if mode == COUNT_MODE_CACHED:
+            return self.get_cached_count(queryset, request, view)
+        if mode == COUNT_MODE_ESTIMATED:
+            estimated = estimate_count(queryset)
+            if estimated is not None and estimated > config.PAGINATION_COUNT_ESTIMATE_THRESHOLD:
+                self.count_mode = COUNT_MODE_ESTIMATED
+                return estimated
+        return queryset.count()
+
+    def get_cached_count(self, queryset, request, view):
+        key = self.get_count_cache_key(queryset, request, view)
+        count = cache.get(key)
+        if count is not None:
+            self.count_mode = COUNT_MODE_CACHED
+            return count
+        count = queryset.count()
+        cache.set(key, count, config.PAGINATION_COUNT_CACHE_TIMEOUT)
+        return count
+
+    def get_count_cache_key(self, queryset, request, view):
+        """
+        Key by model, view, filters (without pagination params) and visibility of the user: admin users see the same
+        items, the others depend on their own permissions.
+        """
+        ignored_params = (self.page_query_param, self.page_size_query_param, ) + self.ignored_count_params
+        filters = sorted((key, sorted(values)) for key, values in request.query_params.lists()
+                         if key not in ignored_params)
+        user = request.user
+        visibility = 'all' if belongs_to_admin_group(user) or is_staff_or_superuser(user) else \
+            'user-{}'.format(user.id)
+        return '{}:{}:{}:{}:{}'.format(COUNT_CACHE_PREFIX, queryset.model._meta.label_lower, view.__class__.__name__,
+                                       visibility, md5(json.dumps(filters).encode()).hexdigest())
+
+
+class KeysetPaginationMixin(object):
+    """
+    Opt-in keyset (cursor) pagination. It is enabled when the view defines 'keyset_ordering' (ex: ('-modified_at',
+    '-id'), where the last field must be unique) and the request has the cursor query param ('?cursor=' for the first
+    page). Pages are filtered by the ordering values of the last seen instance instead of an offset, and the total
+    count is not calculated, so the cost of a page does not depend on its depth.
+    Next and previous values are opaque cursors to send in the following request.
+    Paginators can define their own 'ordering', which takes precedence over the view one, and require keyset
+    pagination even without the cursor query param.
+    """
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = _('Invalid cursor')
+    ordering = None
+    keyset_required = False
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset_ordering = self.ordering or getattr(view, 'keyset_ordering', None)
+        self.is_keyset = bool(self.keyset_ordering) and (
+            self.keyset_required or self.cursor_query_param in request.query_params)
+        if not self.is_keyset:
+            return super().paginate_queryset(queryset, request, view=view)
+
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        position, reverse = self.decode_cursor(request.query_params.get(self.cursor_query_param, ''))
+        ordering = [self.invert_ordering(field) for field in self.keyset_ordering] if reverse else \
+            list(self.keyset_ordering)
+
+        queryset = queryset.order_by(*ordering)
+        if position is not None:
+            queryset = queryset.filter(keyset_filter(ordering, position))
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+
+        has_next, has_previous = (True, has_more) if reverse else (has_more, position is not None)
+        self.next_cursor = self.encode_cursor(results[-1], False) if results and has_next else None
+        self.previous_cursor = self.encode_cursor(results[0], True) if results and has_previous else None
+        return results
+
+    def get_paginated_response(self, data):
+        if not self.is_keyset:
+            return super().get_paginated_response(data)
+        return Response(OrderedDict([
+            ('next', self.next_cursor),
+            ('previous', self.previous_cursor),
+            ('per_page', self.page_size),
+            ('results', data)
+        ]))
+
+    @staticmethod
+    def invert_ordering(field):
+        return field[1:] if field.startswith('-') else '-{}'.format(field)
+
+    def encode_cursor(self, instance, reverse):
+        position = [getattr(instance, field.lstrip('-')) for field in self.keyset_ordering]
+        position = [value.isoformat() if isinstance(value, date) else value for value in position]
+        cursor = json.dumps({'p': position, 'r': reverse}, separators=(',', ':'))
+        return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+    def decode_cursor(self, cursor):
+        """
+        :return: tuple (list of ordering values or None for the first page, reverse direction)
+        """
+        if not cursor:
+            return None, False
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+            position, reverse = cursor['p'], bool(cursor['r'])
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(position, list) or len(position) != len(self.keyset_ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return position, reverse
+
+
+class NumberPagination(KeysetPaginationMixin, CountStrategyMixin, PageNumberPagination):
 
     def get_page_size(self, request):
         page_size = super().get_page_size(request)
@@ -25,8 +217,11 @@ class NumberPagination(PageNumberPagination):
         return self.page.previous_page_number()
 
     def get_paginated_response(self, data):
+        if self.is_keyset:
+            return super().get_paginated_response(data)
         return Response(OrderedDict([
             ('count', self.page.paginator.count),
+            ('count_mode', self.count_mode),
             ('next', self.get_next_link()),
             ('previous', self.get_previous_link()),
             ('per_page', self.page.paginator.per_page),
@@ -43,6 +238,14 @@ class LargeNumberPagination(NumberPagination):
         return page_size
 
 
+class PhotoIdsPagination(LargeNumberPagination):
+    """
+    Keyset pagination of photo ids in ascending order, used by photo subresources of albums and galleries
+    """
+    ordering = ('id', )
+    keyset_required = True
+
+
 class MaxPagination(NumberPagination):
 
     def get_page_size(self, request):
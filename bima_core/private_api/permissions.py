@@ -1,5 +1,4 @@
 # -*- coding: utf-8 -*-
-from django.db.models import Q
 from django_filters.rest_framework import DjangoFilterBackend
 from dry_rest_permissions.generics import DRYPermissionFiltersBase
 from rest_framework.exceptions import ValidationError
@@ -61,8 +60,6 @@ class FilterPhotoPermissionBackend(PermissionFiltersBackend):
         """
         # filter by owner
         if not (belongs_to_admin_group(request.user) or is_staff_or_superuser(request.user)):
-            return queryset.filter(
-                Q(owner=request.user) | Q(album__owners=request.user) | Q(status=queryset.model.PUBLISHED)
-            ).distinct()
+            return queryset.visible_for(request.user)
         # admin user
         return queryset
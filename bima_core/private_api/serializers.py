@@ -1,13 +1,21 @@
 # -*- coding: utf-8 -*-
 
+from collections import OrderedDict
+from functools import partial
 from itertools import groupby
 from operator import itemgetter
 
+from constance import config
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.hashers import make_password
-from django.db import transaction
-from django.utils.translation import ugettext_lazy as _
+from django.contrib.contenttypes.models import ContentType
+from django.http import QueryDict
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.db import connections, models, router, transaction
+from django.utils.timezone import now
+from django.utils.translation import get_language, ugettext_lazy as _
 from drf_chunked_upload.serializers import ChunkedUploadSerializer
 from drf_haystack.serializers import HaystackSerializerMixin
 from rest_auth.serializers import PasswordResetSerializer as _PasswordResetSerializer
@@ -15,20 +23,53 @@ from rest_framework import serializers
 from rest_framework.authtoken import serializers as auth_serializers
 from rest_framework.exceptions import ValidationError, PermissionDenied
 from rest_framework.reverse import reverse
+from rest_framework.settings import api_settings
 from rest_framework_recursive.fields import RecursiveField
 from taggit_serializer.serializers import TagListSerializerField
 
 from bima_core.importers import Flickr
 from bima_core.models import AccessLog, Album, DAMTaxonomy, Gallery, GalleryMembership, Group, \
-    Photo, PhotoChunked, Copyright, UsageRight, PhotoAuthor, TaggedKeyword, TaggedName, PhotoType
-from bima_core.tasks import up_image_to_s3
+    Photo, PhotoChunked, PhotoContent, Copyright, UsageRight, PhotoAuthor, TaggedKeyword, TaggedName, PhotoType
+from bima_core.constants import PHOTO_BULK_MAX_SIZE, TAXONOMY_TREE_CACHE_PREFIX
+from bima_core.managers import photo_counts_state
+from bima_core.tasks import INDEX_UPDATE_ACTION, index_queue, queue_photo_index_update, up_image_to_s3, \
+    up_images_to_s3
 from bima_core.translation import TranslationMixin
-from bima_core.utils import belongs_to_admin_group, is_iterable, is_staff_or_superuser
+from bima_core.utils import belongs_to_admin_group, get_taxonomy_tree_version, is_iterable, is_staff_or_superuser
 
-from .fields import UserPermissionsField, PermissionField
+from .fields import UserPermissionsField, PermissionField, PrefetchedPrimaryKeyRelatedField
 from .forms import PasswordResetForm
 
 
+# List serializers
+
+
+class PermissionListSerializer(serializers.ListSerializer):
+    """
+    List serializer which lets the model precompute all required data to evaluate object permissions for the whole
+    list at once. Then, each child serializes its permissions from memory instead of querying for each instance.
+    """
+
+    def to_representation(self, data):
+        iterable = list(data.all() if isinstance(data, models.Manager) else data)
+        prefetch_object_permissions = getattr(self.child.Meta.model, 'prefetch_object_permissions', None)
+        if prefetch_object_permissions is not None:
+            prefetch_object_permissions(iterable)
+        return super().to_representation(iterable)
+
+
+class CoverPhotoListSerializer(PermissionListSerializer):
+    """
+    List serializer which fetches the photos (cover or first photo) of the whole list at once, so the thumbnails of
+    the children do not query a photo for each instance (see 'CoverPhotoMixin.prefetch_photos').
+    """
+
+    def to_representation(self, data):
+        iterable = list(data.all() if isinstance(data, models.Manager) else data)
+        self.child.Meta.model.prefetch_photos(iterable)
+        return super().to_representation(iterable)
+
+
 # Mixin Serializers
 
 
@@ -167,7 +208,7 @@ class ValidatePermissionSerializer(object):
 
     @property
     def is_create_action(self):
-        return self.action == 'create'
+        return self.action in ['create', 'bulk_create', ]
 
     @property
     def view_kwargs(self):
@@ -178,6 +219,76 @@ class ValidatePermissionSerializer(object):
         return self.context['view'].lookup_field
 
 
+class BulkPhotoRelationsMixin(object):
+    """
+    Mixin to add categories, keywords and names to many photos with a few set-based queries. The relations which
+    already exist are skipped, so they are always added.
+    """
+
+    @staticmethod
+    def add_categories(photo_ids, categories):
+        """
+        :param photo_ids: list of photo ids
+        :param categories: list with the categories to add to each photo
+        """
+        field = Photo._meta.get_field('categories')
+        through = field.remote_field.through
+        source = through._meta.get_field(field.m2m_field_name()).attname
+        target = through._meta.get_field(field.m2m_reverse_field_name()).attname
+        rows = {(photo_id, category.id) for photo_id, photo_categories in zip(photo_ids, categories)
+                for category in photo_categories}
+        if not rows:
+            return
+        existing = through.objects.filter(**{
+            '{}__in'.format(source): {photo_id for photo_id, category_id in rows},
+            '{}__in'.format(target): {category_id for photo_id, category_id in rows},
+        }).values_list(source, target)
+        through.objects.bulk_create([
+            through(**{source: photo_id, target: category_id}) for photo_id, category_id in rows - set(existing)
+        ])
+
+    def add_tags(self, photo_ids, keywords, names):
+        """
+        :param photo_ids: list of photo ids
+        :param keywords: list with the keywords (dicts of tag and language) to add to each photo
+        :param names: list with the names to add to each photo
+        """
+        keyword_rows = {(photo_id, keyword['tag'], keyword['language'])
+                        for photo_id, photo_keywords in zip(photo_ids, keywords) for keyword in photo_keywords}
+        name_rows = {(photo_id, name) for photo_id, photo_names in zip(photo_ids, names) for name in photo_names}
+        if not (keyword_rows or name_rows):
+            return
+
+        tags = self.get_tags({tag for photo_id, tag, language in keyword_rows} | {name for photo_id, name in name_rows})
+        content_type = ContentType.objects.get_for_model(Photo)
+        lookups = {'content_type': content_type, 'object_id__in': set(photo_ids), 'tag__in': tags.values()}
+        if keyword_rows:
+            existing = TaggedKeyword.objects.filter(**lookups).values_list('object_id', 'tag__name', 'language')
+            TaggedKeyword.objects.bulk_create([
+                TaggedKeyword(content_type=content_type, object_id=photo_id, tag=tags[tag], language=language)
+                for photo_id, tag, language in keyword_rows - set(existing)
+            ])
+        if name_rows:
+            existing = TaggedName.objects.filter(**lookups).values_list('object_id', 'tag__name')
+            TaggedName.objects.bulk_create([
+                TaggedName(content_type=content_type, object_id=photo_id, tag=tags[name])
+                for photo_id, name in name_rows - set(existing)
+            ])
+
+    @staticmethod
+    def get_tags(names):
+        """
+        Tags by name, creating the missing ones
+        :param names: set of tag names
+        :return: dict
+        """
+        tag_model = TaggedKeyword.tag_model()
+        tags = {tag.name: tag for tag in tag_model.objects.filter(name__in=names)}
+        for name in names - set(tags):
+            tags[name] = tag_model.objects.create(name=name)
+        return tags
+
+
 class ReadPermissionSerializerMixin(object):
     """
     Base right serializer
@@ -405,6 +516,7 @@ class BasePhotoSerializer(ValidatePermissionSerializer, ThumborSerializerMixin,
     class Meta:
         model = Photo
         fields = ('id', 'title', 'description', 'permissions', 'upload_status')
+        list_serializer_class = PermissionListSerializer
 
 
 # Extra info serializers
@@ -500,7 +612,7 @@ class AlbumExtraInfoSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Album
-        fields = ('owners', )
+        fields = ('owners', 'photos_count', 'published_photos_count', )
 
 
 class GalleryExtraInfoSerializer(serializers.ModelSerializer):
@@ -514,7 +626,7 @@ class GalleryExtraInfoSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Gallery
-        fields = ('owners', 'status_display', )
+        fields = ('owners', 'status_display', 'photos_count', 'published_photos_count', )
 
 
 class TaxonomyExtraInfoSerializer(serializers.ModelSerializer):
@@ -528,6 +640,18 @@ class TaxonomyExtraInfoSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = DAMTaxonomy
+        fields = ('parent', 'children', 'photos_count', 'published_photos_count', 'subtree_photos_count',
+                  'subtree_published_photos_count', )
+
+
+class TaxonomyTreeExtraInfoSerializer(TaxonomyExtraInfoSerializer):
+    """
+    TaxonomyExtraInfoSerializer without photo counters, which are not kept in snapshots of taxonomy trees.
+    """
+    counter_fields = ('photos_count', 'published_photos_count', 'subtree_photos_count',
+                      'subtree_published_photos_count', )
+
+    class Meta(TaxonomyExtraInfoSerializer.Meta):
         fields = ('parent', 'children', )
 
 
@@ -653,6 +777,16 @@ class AlbumSerializer(ThumborSerializerMixin, TranslationSerializerMixin, BaseAl
         return value
 
 
+class AlbumListSerializer(AlbumSerializer):
+    """
+    Album serializer for lists, without the ids of all its photos (see the photos subresource of albums).
+    """
+
+    class Meta(AlbumSerializer.Meta):
+        fields = tuple(field for field in AlbumSerializer.Meta.fields if field != 'photos')
+        list_serializer_class = CoverPhotoListSerializer
+
+
 class GallerySerializer(ThumborSerializerMixin, TranslationSerializerMixin, serializers.ModelSerializer):
     """
     Gallery serializer.
@@ -689,6 +823,16 @@ class GallerySerializer(ThumborSerializerMixin, TranslationSerializerMixin, seri
         return value
 
 
+class GalleryListSerializer(GallerySerializer):
+    """
+    Gallery serializer for lists, without its photos (see the photos subresource of galleries).
+    """
+
+    class Meta(GallerySerializer.Meta):
+        fields = tuple(field for field in GallerySerializer.Meta.fields if field != 'photos')
+        list_serializer_class = CoverPhotoListSerializer
+
+
 class GalleryMembershipSerializer(ValidatePermissionSerializer, serializers.ModelSerializer):
     """
     Serializer for links between photos and galleries.
@@ -723,6 +867,63 @@ class GalleryMembershipSerializer(ValidatePermissionSerializer, serializers.Mode
             return super().create(validated_data)
 
 
+class GalleryMembershipBulkSerializer(ValidatePermissionSerializer, serializers.Serializer):
+    """
+    Serializer to link and unlink many photos to a gallery at once.
+    The permission is validated once for the gallery, and only the links which change are created or deleted.
+    """
+
+    gallery = serializers.PrimaryKeyRelatedField(queryset=Gallery.objects.all())
+    link = serializers.ListField(child=serializers.IntegerField(), required=False)
+    unlink = serializers.ListField(child=serializers.IntegerField(), required=False)
+
+    default_error_messages = {
+        'no_photos': _('Photos to link or unlink are required.'),
+        'overlapping': _('Photos {ids} can not be linked and unlinked at the same time.'),
+        'not_found': _('Photos {ids} do not exist.'),
+    }
+
+    class Meta:
+        model = GalleryMembership
+
+    def validate(self, attrs):
+        attrs = super().validate(attrs)
+        link_ids, unlink_ids = set(attrs.get('link', ())), set(attrs.get('unlink', ()))
+        if not (link_ids or unlink_ids):
+            raise ValidationError(self.error_messages['no_photos'])
+        if link_ids & unlink_ids:
+            raise ValidationError(self.error_messages['overlapping'].format(ids=sorted(link_ids & unlink_ids)))
+        missing_ids = link_ids - set(Photo.objects.active().filter(id__in=link_ids).values_list('id', flat=True))
+        if missing_ids:
+            raise ValidationError({'link': [self.error_messages['not_found'].format(ids=sorted(missing_ids))]})
+        # owners and membership validation
+        if not belongs_to_admin_group(self.user) and not attrs['gallery'].is_membership(self.user):
+            raise PermissionDenied
+        attrs['link'], attrs['unlink'] = link_ids, unlink_ids
+        return attrs
+
+    def create(self, validated_data):
+        """
+        Create the links which do not exist yet with a single insert and delete the links to unlink with a single
+        delete.
+        :return: dict with the gallery and the linked and unlinked photo ids
+        """
+        gallery, model = validated_data['gallery'], self.Meta.model
+        memberships = model.objects.filter(gallery=gallery)
+        link_ids = validated_data['link'] - set(
+            memberships.filter(photo_id__in=validated_data['link']).values_list('photo_id', flat=True))
+        unlink_ids = set(
+            memberships.filter(photo_id__in=validated_data['unlink']).values_list('photo_id', flat=True))
+
+        with Photo.objects.filter(id__in=link_ids | unlink_ids).keep_photo_counts():
+            model.objects.bulk_create([
+                model(gallery=gallery, photo_id=photo_id, added_by=self.user) for photo_id in sorted(link_ids)
+            ])
+            if unlink_ids:
+                memberships.filter(photo_id__in=unlink_ids).delete()
+        return {'gallery': gallery.id, 'linked': sorted(link_ids), 'unlinked': sorted(unlink_ids)}
+
+
 class TaxonomyListSerializer(TranslationSerializerMixin, BaseTaxonomySerializer):
     """
     BaseTaxonomySerializer with Translation Mixin.
@@ -733,19 +934,104 @@ class TaxonomyListSerializer(TranslationSerializerMixin, BaseTaxonomySerializer)
         fields = ('id', 'name', )
 
 
+class TaxonomyTreeListSerializer(serializers.ListSerializer):
+    """
+    List serializer which renders taxonomies from snapshots of their whole trees. Each snapshot is built from a
+    single query over the tree (see 'DAMTaxonomy.load_tree') and cached until any taxonomy is saved, moved or deleted
+    (see 'bump_taxonomy_tree_version'). Photo counters change with photos, so they are not kept in snapshots but read
+    with a single query for each list. Taxonomy permissions only depend on the user, so they are serialized once.
+    """
+
+    def to_representation(self, data):
+        iterable = list(data.all() if isinstance(data, models.Manager) else data)
+        if not iterable:
+            return []
+        tree_ids = {instance.tree_id for instance in iterable}
+        nodes = self.get_tree_snapshots(tree_ids)
+        counts = self.get_photo_counts(tree_ids)
+        permissions = self.child.fields['permissions'].to_representation(iterable[0])
+        return [self.complete_node(nodes[instance.id], counts, permissions) if instance.id in nodes
+                else self.child.to_representation(instance) for instance in iterable]
+
+    @staticmethod
+    def get_photo_counts(tree_ids):
+        """
+        Current photo counters of all taxonomies of some trees.
+        :param tree_ids: ids of the trees
+        :return: dict of taxonomy id: ordered dict of counter name: value
+        """
+        fields = TaxonomyTreeExtraInfoSerializer.counter_fields
+        return {pk: OrderedDict(zip(fields, values)) for pk, *values in
+                DAMTaxonomy._base_manager.filter(tree_id__in=tree_ids).values_list('id', *fields)}
+
+    def get_tree_snapshots(self, tree_ids):
+        """
+        Serialized nodes of some trees, from cache or built for the trees which are not cached yet.
+        :param tree_ids: ids of the trees
+        :return: dict of taxonomy id: serialized taxonomy without permissions
+        """
+        version, language = get_taxonomy_tree_version(), get_language()
+        keys = {tree_id: '{}:{}:{}:{}'.format(TAXONOMY_TREE_CACHE_PREFIX, version, language, tree_id)
+                for tree_id in tree_ids}
+        snapshots = cache.get_many(keys.values())
+        missing = [tree_id for tree_id, key in keys.items() if key not in snapshots]
+        if missing:
+            built = {keys[tree_id]: snapshot for tree_id, snapshot in self.build_tree_snapshots(missing).items()}
+            cache.set_many(built, config.TAXONOMY_TREE_CACHE_TIMEOUT)
+            snapshots.update(built)
+
+        nodes = {}
+        for snapshot in snapshots.values():
+            nodes.update(snapshot)
+        return nodes
+
+    def build_tree_snapshots(self, tree_ids):
+        """
+        Serialize whole trees from their roots, indexing the serialized nodes of each tree by id.
+        :param tree_ids: ids of the trees
+        :return: dict of tree id: dict of taxonomy id: serialized taxonomy without permissions
+        """
+        roots = [node for node in DAMTaxonomy.load_tree(tree_ids).values() if node.parent_id is None]
+        data = TaxonomyTreeSerializer(roots, many=True, context=self.context).data
+        snapshots = {}
+        for root, root_data in zip(roots, data):
+            snapshot, pending = {}, [root_data]
+            while pending:
+                node_data = pending.pop()
+                snapshot[node_data['id']] = node_data
+                pending.extend(node_data['children'])
+            snapshots[root.tree_id] = snapshot
+        return snapshots
+
+    @classmethod
+    def complete_node(cls, node_data, counts, permissions):
+        """
+        Copy a serialized node and its serialized children adding them their photo counters and the permissions of
+        the user.
+        """
+        node_data = OrderedDict(node_data, children=[
+            cls.complete_node(child, counts, permissions) for child in node_data['children']])
+        node_data['extra_info'] = OrderedDict(node_data['extra_info'])
+        node_data['extra_info'].update(counts.get(node_data['id'], dict.fromkeys(
+            TaxonomyTreeExtraInfoSerializer.counter_fields, 0)))
+        node_data['permissions'] = permissions
+        return node_data
+
+
 class TaxonomySerializer(TranslationSerializerMixin, BaseTaxonomySerializer):
     """
     Taxonomy serializer extended from BaseTaxonomySerializer.
-    It defines a read only field to list tree children.
+    It defines a read only field to list tree children. Lists are rendered from snapshots of whole trees.
     """
     ancestors = TaxonomyListSerializer(read_only=True, many=True)
     parent = serializers.PrimaryKeyRelatedField(queryset=DAMTaxonomy.objects.all(), required=False, allow_null=True)
-    children = serializers.ListSerializer(child=RecursiveField(), read_only=True)
+    children = serializers.ListSerializer(child=RecursiveField(), read_only=True, source='tree_children')
     extra_info = serializers.SerializerMethodField(read_only=True)
     permissions = PermissionField()
 
     class Meta(BaseTaxonomySerializer.Meta):
         fields = ('id', 'name', 'slug', 'parent', 'ancestors', 'children', 'extra_info', 'permissions', )
+        list_serializer_class = TaxonomyTreeListSerializer
 
     def get_extra_info(self, obj):
         """
@@ -759,6 +1045,17 @@ class TaxonomySerializer(TranslationSerializerMixin, BaseTaxonomySerializer):
         return value
 
 
+class TaxonomyTreeSerializer(TaxonomySerializer):
+    """
+    Like TaxonomySerializer but without permissions nor photo counters, to serialize snapshots of whole trees.
+    """
+    class Meta(BaseTaxonomySerializer.Meta):
+        fields = ('id', 'name', 'slug', 'parent', 'ancestors', 'children', 'extra_info', )
+
+    def get_extra_info(self, obj):
+        return TaxonomyTreeExtraInfoSerializer(obj, read_only=True, context=self.context).data
+
+
 class TaxonomyLevelSerializer(TaxonomySerializer):
     """
     Like TaxonomySerializer but without recursive children.
@@ -798,15 +1095,16 @@ class PhotoSerializer(BasePhotoSerializer):
     It is defined all metadata as read only filed because it is auto-generated from image content, so it is not
     necessary to specify it on the create/update request.
     """
+    serializer_related_field = PrefetchedPrimaryKeyRelatedField
 
-    image = serializers.PrimaryKeyRelatedField(queryset=PhotoChunked.objects.completed(), write_only=True)
-    author = serializers.PrimaryKeyRelatedField(queryset=PhotoAuthor.objects.all(), required=False, allow_null=True)
-    copyright = serializers.PrimaryKeyRelatedField(queryset=Copyright.objects.all(), required=False, allow_null=True)
-    internal_usage_restriction = serializers.PrimaryKeyRelatedField(
+    image = PrefetchedPrimaryKeyRelatedField(queryset=PhotoChunked.objects.completed(), write_only=True)
+    author = PrefetchedPrimaryKeyRelatedField(queryset=PhotoAuthor.objects.all(), required=False, allow_null=True)
+    copyright = PrefetchedPrimaryKeyRelatedField(queryset=Copyright.objects.all(), required=False, allow_null=True)
+    internal_usage_restriction = PrefetchedPrimaryKeyRelatedField(
         queryset=UsageRight.objects.all(), required=False, allow_null=True)
-    external_usage_restriction = serializers.PrimaryKeyRelatedField(
+    external_usage_restriction = PrefetchedPrimaryKeyRelatedField(
         queryset=UsageRight.objects.all(), required=False, allow_null=True)
-    categories = serializers.PrimaryKeyRelatedField(queryset=DAMTaxonomy.objects.active(), required=False, many=True)
+    categories = PrefetchedPrimaryKeyRelatedField(queryset=DAMTaxonomy.objects.active(), required=False, many=True)
     keywords = KeywordSerializer(required=False, many=True)
     names = NameSerializer(required=False)
     extra_info = serializers.SerializerMethodField(read_only=True)
@@ -819,11 +1117,12 @@ class PhotoSerializer(BasePhotoSerializer):
                   'permissions', 'image_flickr', 'names', 'copyright', 'author', 'internal_usage_restriction',
                   'external_usage_restriction', 'identifier', 'original_file_name', 'categorize_date', 'size',
                   'upload_status')
+        list_serializer_class = PermissionListSerializer
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         if settings.PHOTO_TYPES_ENABLED:
-            self.fields['photo_type'] = serializers.PrimaryKeyRelatedField(
+            self.fields['photo_type'] = PrefetchedPrimaryKeyRelatedField(
                 queryset=PhotoType.objects.all(), required=False, allow_null=True)
             self.Meta.fields += ('photo_type',)
 
@@ -877,7 +1176,7 @@ class PhotoSerializer(BasePhotoSerializer):
 
         # will update image content, language tagged keywords and tagged names if has valid data
         if image is not None:
-            up_image_to_s3.delay(photo.id, image.id)
+            transaction.on_commit(partial(up_image_to_s3.delay, photo.id, image.id))
         if keywords is not None:
             self.fields['keywords'].child.update_or_create(photo, keywords, cleanup)
         if names is not None:
@@ -924,6 +1223,177 @@ class PhotoUpdateSerializer(PhotoSerializer):
         return photo
 
 
+class PhotoBulkUpdateSerializer(ValidatePermissionSerializer, BulkPhotoRelationsMixin, serializers.Serializer):
+    """
+    Serializer to apply the same changes to many photos with set-based queries, used for massive photo updates.
+    The photos are selected by their ids or by the parameters of the photo filter, and as 'PhotoUpdateSerializer' it
+    always adds items for each m2m photo field.
+    """
+    update_fields = ('status', 'album', 'author', 'copyright', 'internal_usage_restriction',
+                     'external_usage_restriction', )
+
+    ids = serializers.ListField(child=serializers.IntegerField(), required=False)
+    filter = serializers.DictField(required=False)
+    status = serializers.ChoiceField(choices=Photo.STATUS_CHOICES, required=False)
+    album = serializers.PrimaryKeyRelatedField(queryset=Album.objects.all(), required=False)
+    author = serializers.PrimaryKeyRelatedField(queryset=PhotoAuthor.objects.all(), required=False, allow_null=True)
+    copyright = serializers.PrimaryKeyRelatedField(queryset=Copyright.objects.all(), required=False, allow_null=True)
+    internal_usage_restriction = serializers.PrimaryKeyRelatedField(
+        queryset=UsageRight.objects.all(), required=False, allow_null=True)
+    external_usage_restriction = serializers.PrimaryKeyRelatedField(
+        queryset=UsageRight.objects.all(), required=False, allow_null=True)
+    categories = serializers.PrimaryKeyRelatedField(queryset=DAMTaxonomy.objects.active(), required=False, many=True)
+    keywords = KeywordSerializer(required=False, many=True)
+    names = NameSerializer(required=False)
+
+    default_error_messages = {
+        'no_selection': _('Photos must be selected by their ids or by a filter.'),
+        'not_found': _('Photos {ids} do not exist.'),
+        'max_length': _('Ensure the selection has no more than {max_length} photos.'),
+    }
+
+    class Meta:
+        model = Photo
+
+    def get_queryset(self, attrs):
+        """
+        Photos selected by ids or, otherwise, by the filter of the view
+        """
+        view = self.context['view']
+        queryset = view.get_queryset()
+        if 'ids' in attrs:
+            return queryset.filter(id__in=attrs['ids'])
+        data = QueryDict(mutable=True)
+        for key, value in attrs['filter'].items():
+            data.setlist(key, value if isinstance(value, list) else [value])
+        return view.filter_class(data, queryset=queryset).qs
+
+    def validate(self, attrs):
+        """
+        Validate that the user who requests it can write all selected photos, and that he is a member of the new
+        album if it changes. Permissions are evaluated for the whole set of photos at once.
+        """
+        attrs = super().validate(attrs)
+        if not attrs.get('ids') and not attrs.get('filter'):
+            raise ValidationError(self.error_messages['no_selection'])
+
+        # as bulk creation, the selection is limited to 'PHOTO_BULK_MAX_SIZE' photos
+        max_length_message = self.error_messages['max_length'].format(max_length=PHOTO_BULK_MAX_SIZE)
+        if len(set(attrs.get('ids', ()))) > PHOTO_BULK_MAX_SIZE:
+            raise ValidationError({'ids': [max_length_message]})
+        queryset = self.get_queryset(attrs).order_by()
+        photo_ids = set(queryset.values_list('id', flat=True)[:PHOTO_BULK_MAX_SIZE + 1])
+        if len(photo_ids) > PHOTO_BULK_MAX_SIZE:
+            raise ValidationError({'filter': [max_length_message]})
+        missing_ids = set(attrs.get('ids', ())) - photo_ids
+        if missing_ids:
+            raise ValidationError({'ids': [self.error_messages['not_found'].format(ids=sorted(missing_ids))]})
+
+        if not belongs_to_admin_group(self.user):
+            if 'album' in attrs and not attrs['album'].is_membership(self.user):
+                raise PermissionDenied
+            if photo_ids - set(Photo.filter_write_permission(queryset, self.user).values_list('id', flat=True)):
+                raise PermissionDenied
+        attrs['photo_ids'] = sorted(photo_ids)
+        return attrs
+
+    def create(self, validated_data):
+        """
+        Update the fields of all photos with a single query, add the m2m items in bulk and queue the reindex of the
+        photos in chunks.
+        :return: list of updated photo ids
+        """
+        photo_ids = validated_data['photo_ids']
+        changes = {name: validated_data[name] for name in self.update_fields if name in validated_data}
+        with Photo.objects.filter(id__in=photo_ids).keep_photo_counts() as photos:
+            photos.update(modified_at=now(), **changes)
+            if 'categories' in validated_data:
+                self.add_categories(photo_ids, [validated_data['categories']] * len(photo_ids))
+        self.add_tags(photo_ids, [validated_data.get('keywords') or []] * len(photo_ids),
+                      [validated_data.get('names') or []] * len(photo_ids))
+
+        queue_photo_index_update(photo_ids)
+        return photo_ids
+
+
+class PhotoBulkListSerializer(BulkPhotoRelationsMixin, PermissionListSerializer):
+    """
+    List serializer to create many photos in a single request.
+    The related instances of all items are fetched with a query for each field before validating them, and the
+    photos, their categories, keywords and names are inserted in bulk. The images of all photos are uploaded in a
+    single background job.
+    """
+    prefetch_related_lookups = {
+        'album': ('owners', ),
+    }
+
+    default_error_messages = {
+        'max_length': _('Ensure this list has no more than {max_length} elements.'),
+    }
+
+    def to_internal_value(self, data):
+        if isinstance(data, list):
+            if len(data) > PHOTO_BULK_MAX_SIZE:
+                message = self.error_messages['max_length'].format(max_length=PHOTO_BULK_MAX_SIZE)
+                raise ValidationError({api_settings.NON_FIELD_ERRORS_KEY: [message]})
+            self.prefetch_related_instances(data)
+        return super().to_internal_value(data)
+
+    def prefetch_related_instances(self, data):
+        """
+        Fetch in bulk the related instances of all items for each related field of the child serializer.
+        """
+        for field_name, field in self.child.fields.items():
+            relation = getattr(field, 'child_relation', field)
+            if field.read_only or not isinstance(relation, PrefetchedPrimaryKeyRelatedField):
+                continue
+            values = []
+            for item in data:
+                value = item.get(field_name) if isinstance(item, dict) else None
+                values.extend(value if isinstance(value, list) else [value])
+            queryset = relation.get_queryset().prefetch_related(*self.prefetch_related_lookups.get(field_name, ()))
+            relation.prefetch(values, queryset)
+
+    def create(self, validated_data):
+        model = self.child.Meta.model
+        images = [attrs.pop('image', None) for attrs in validated_data]
+        categories = [attrs.pop('categories', None) or [] for attrs in validated_data]
+        keywords = [attrs.pop('keywords', None) or [] for attrs in validated_data]
+        names = [attrs.pop('names', None) or [] for attrs in validated_data]
+        photos = [model(**attrs) for attrs in validated_data]
+
+        # photo counters are updated once all photos and their categories have been inserted
+        with photo_counts_state.pause():
+            # only backends which return the primary keys of the inserted rows allow to create related data in bulk
+            if connections[router.db_for_write(model)].features.can_return_ids_from_bulk_insert:
+                model.objects.bulk_create(photos)
+                # bulk inserts do not send signals, so the photos are queued to be indexed
+                for photo in photos:
+                    index_queue.add(model, photo.id, INDEX_UPDATE_ACTION)
+            else:
+                for photo in photos:
+                    photo.save()
+
+            photo_ids = [photo.id for photo in photos]
+            self.add_categories(photo_ids, categories)
+        model.objects.filter(id__in=photo_ids).update_photo_counts()
+        self.add_tags(photo_ids, keywords, names)
+
+        uploads = [(photo.id, image.id) for photo, image in zip(photos, images) if image is not None]
+        if uploads:
+            transaction.on_commit(partial(up_images_to_s3.delay, uploads))
+        return photos
+
+
+class PhotoBulkCreateSerializer(PhotoSerializer):
+    """
+    Photo serializer to create many photos in a single request.
+    """
+
+    class Meta(PhotoSerializer.Meta):
+        list_serializer_class = PhotoBulkListSerializer
+
+
 class PhotoSearchSerializer(HaystackSerializerMixin, PhotoSerializer):
     """
     Photo serializer for searches
@@ -938,13 +1408,34 @@ class PhotoChunkedSerializer(ChunkedUploadSerializer):
     permissions = PermissionField()
     md5 = serializers.CharField(source='md5_missing_file', max_length=32, required=False)
     status_display = serializers.CharField(source='get_status_display', read_only=True)
+    duplicates = serializers.SerializerMethodField()
 
     def get_url(self, obj):
-        return reverse('photo-upload-chunk', kwargs={'pk': obj.id}, request=self.context['request'])
+        url_name = 'photo-upload-parallel-chunk' if obj.parallel else 'photo-upload-chunk'
+        return reverse(url_name, kwargs={'pk': obj.id}, request=self.context['request'])
+
+    def create(self, validated_data):
+        """
+        The upload starts with an empty file, so all chunks (the first one too) are appended by the view.
+        """
+        chunk = validated_data.pop('file')
+        validated_data['file'] = ContentFile(b'', name=chunk.name)
+        return super().create(validated_data)
+
+    def get_duplicates(self, obj):
+        """
+        Active photos whose image has the same content of the uploaded file
+        """
+        if not obj.sha256:
+            return []
+        names = PhotoContent.objects.filter(sha256=obj.sha256).values('name')
+        return list(Photo.objects.active().filter(image__in=names).values_list('id', flat=True))
 
     class Meta(ChunkedUploadSerializer.Meta):
         model = PhotoChunked
         exclude = ()
+        read_only_fields = ChunkedUploadSerializer.Meta.read_only_fields + (
+            'sha256', 'parallel', 'size', 'received_ranges', )
 
 
 # Flickr serializer
@@ -6,8 +6,9 @@ from bima_core.constants import UUID_REGEX
 from .routers import CreateDeleteRouter
 from .views import schema_view, ObtainAuthToken, GroupViewSet, UserViewSet, AlbumViewSet, PhotoViewSet, WhoAmI, \
     TaxonomyViewSet, GalleryViewSet, LinkerPhotoViewSet, LoggerViewSet, ImportPhotoFlickr, TaxonomyListViewSet, \
-    UploadChunkedPhoto, LoggerListView, CopyrightViewSet, AuthorViewSet, RestrictionViewSet, PhotoSearchView, \
-    KeywordViewSet, NameViewSet, UpdatePhoto, PhotoTypeViewSet, TaxonomyLevelViewSet
+    UploadChunkedPhoto, UploadParallelChunkedPhoto, LoggerListView, LoggerStreamView, CopyrightViewSet, \
+    AuthorViewSet, RestrictionViewSet, PhotoSearchView, KeywordViewSet, NameViewSet, UpdatePhoto, PhotoTypeViewSet, \
+    TaxonomyLevelViewSet, BulkUpdatePhoto
 
 urlpatterns = [
     url(r'^docs/$', schema_view),
@@ -22,15 +23,20 @@ urlpatterns = [
     url(r'^photos/upload/$', UploadChunkedPhoto.as_view(), name='photo-upload'),
     url(r'^photos/upload/(?P<pk>{})/chunk/$'.format(UUID_REGEX), UploadChunkedPhoto.as_view(),
         name='photo-upload-chunk'),
+    url(r'^photos/upload/parallel/$', UploadParallelChunkedPhoto.as_view(), name='photo-upload-parallel'),
+    url(r'^photos/upload/parallel/(?P<pk>{})/chunk/$'.format(UUID_REGEX), UploadParallelChunkedPhoto.as_view(),
+        name='photo-upload-parallel-chunk'),
     url(r'^photos/import/(?P<flickr>[\w\d]+)/album/(?P<pk>[\w\d]+)/(?P<author>[\w\d]+)/(?P<copyright>[\w\d]+)/$',
         ImportPhotoFlickr.as_view(), name='photo-import'),
     url(r'^photos/(?P<pk>[\d]+)/addition/$', UpdatePhoto.as_view(), name='photo-update-addition'),
+    url(r'^photos/addition/$', BulkUpdatePhoto.as_view(), name='photo-bulk-update-addition'),
 
     # Categories endpoints
     url(r'^categories/flat/$', TaxonomyListViewSet.as_view(), name='category-list'),
 
     # Loggers endpoints
     url(r'^exports/logger/$', LoggerListView.as_view(), name='export-logger'),
+    url(r'^exports/logger/stream/$', LoggerStreamView.as_view(), name='export-logger-stream'),
 
     # Semantic photo search
     url(r'^search/$', PhotoSearchView.as_view(), name='search'),
@@ -1,34 +1,46 @@
 # -*- coding: utf-8 -*-
+import csv
+import json
 
 from django.contrib.auth import get_user_model
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404
 from django.utils.translation import ugettext as _i
+from drf_chunked_upload.exceptions import ChunkedUploadError
 from drf_chunked_upload.views import ChunkedUploadView
 from drf_haystack.generics import HaystackGenericAPIView
 from dry_rest_permissions.generics import DRYPermissions
-from rest_framework import viewsets
+from rest_framework import status, viewsets
 from rest_framework.authtoken import views as auth_views
+from rest_framework.decorators import detail_route, list_route
+from rest_framework.exceptions import ValidationError
 from rest_framework.filters import DjangoFilterBackend
 from rest_framework.generics import ListAPIView as _ListAPIView, RetrieveAPIView as _RetrieveAPIView, \
-    CreateAPIView as _CreateAPIView, UpdateAPIView as _UpdateAPIView
+    CreateAPIView as _CreateAPIView, UpdateAPIView as _UpdateAPIView, GenericAPIView
 from rest_framework.mixins import CreateModelMixin, DestroyModelMixin, ListModelMixin
 from rest_framework.parsers import MultiPartParser
+from rest_framework.response import Response
 from rest_framework.viewsets import GenericViewSet
 from rest_framework_swagger.views import get_swagger_view
 
 from bima_core.models import Album, DAMTaxonomy, Gallery, GalleryMembership, Group, Photo, PhotoChunked, AccessLog, \
     Copyright, UsageRight, PhotoAuthor, TaggedKeyword, TaggedName, PhotoType
+from bima_core.utils import get_group_names, iterate_by_chunks
 
 from .backends import HaystackDjangoFilterBackend
 from .filters import PhotoFilter, UserFilter, AlbumFilter, TaxonomyFilter, GalleryFilter, GroupFilter, \
     AccessLogFilter, CopyrightFilter, UsageRightFilter, PhotoAuthorFilter, PhotoSearchFilter, KeywordFilter, \
     NameFilter, PhotoTypeFilter
-from .paginators import LargeNumberPagination, MaxPagination, TaxonomyNumberPagination
+from .paginators import LargeNumberPagination, MaxPagination, PhotoIdsPagination, TaxonomyNumberPagination
 from .permissions import FilterAlbumPermissionBackend, FilterPhotoPermissionBackend
 from .serializers import GroupSerializer, UserSerializer, AlbumSerializer, PhotoSerializer, TaxonomySerializer, \
     TaxonomyListSerializer, GallerySerializer, GalleryMembershipSerializer, AccessLogSerializer, \
     PhotoFlickrSerializer, PhotoChunkedSerializer, WhoAmISerializer, CopyrightSerializer, UsageRightSerializer, \
     PhotoAuthorSerializer, PhotoSearchSerializer, KeywordTagSerializer, NameTagSerializer, PhotoUpdateSerializer, \
-    BasePhotoSerializer, AuthTokenSerializer, PhotoTypeSerializer, TaxonomyLevelSerializer
+    BasePhotoSerializer, AuthTokenSerializer, PhotoTypeSerializer, TaxonomyLevelSerializer, PhotoBulkCreateSerializer, \
+    PhotoBulkUpdateSerializer, GalleryMembershipBulkSerializer, AlbumListSerializer, GalleryListSerializer
 
 schema_view = get_swagger_view(title=_i('BIMA Core: Private API'))
 
@@ -53,6 +65,28 @@ class ViewSetSerializerMixin(object):
             return super().get_serializer_class()
 
 
+class PhotoIdsViewSetMixin(object):
+    """
+    View set mixin with a 'photos' detail route, which lists the ids of the active photos of an instance that the user
+    can see, paginated by keyset in ascending order, instead of embedding all of them in the instance.
+    """
+
+    def get_photo_queryset(self, instance):
+        """
+        Active photos of the instance, related through the same lookup as its photo counters (see
+        'photo_count_lookup'). They are selected by id, so photos linked more than once are not repeated.
+        """
+        photo_ids = Photo.objects.filter(**{instance.photo_count_lookup: instance}).values('id')
+        return Photo.objects.active().filter(id__in=photo_ids)
+
+    @detail_route(methods=['get'], pagination_class=PhotoIdsPagination)
+    def photos(self, request, *args, **kwargs):
+        queryset = self.get_photo_queryset(self.get_object())
+        queryset = FilterPhotoPermissionBackend().filter_list_queryset(request, queryset, self)
+        page = self.paginate_queryset(queryset.only('id'))
+        return self.get_paginated_response([photo.id for photo in page])
+
+
 class FilterModelViewSet(PermissionMixin, FilterMixin, viewsets.ModelViewSet):
     """
     Base model view set class with default filter backend 'DjangoFilterBackend'
@@ -165,6 +199,27 @@ class UpdatePhoto(UpdateAPIView):
     http_method_names = ('patch', 'put', )
 
 
+class BulkUpdatePhoto(PermissionMixin, GenericAPIView):
+    """
+    API view to update many photos at once, selected by their ids or by the photo filter parameters.
+    It always adds items for each m2m photo field and it responses the number of updated photos.
+
+    partial_update:
+    Partial update of many photo instances with item addition in m2m relations.
+    """
+    serializer_class = PhotoBulkUpdateSerializer
+    queryset = Photo.objects.active()
+    filter_class = PhotoFilter
+    http_method_names = ('patch', )
+
+    def patch(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        with transaction.atomic():
+            photo_ids = serializer.save()
+        return Response({'count': len(photo_ids)})
+
+
 class UploadChunkedPhoto(PermissionMixin, ChunkedUploadView):
     """
     API to upload chunked file.
@@ -179,6 +234,83 @@ class UploadChunkedPhoto(PermissionMixin, ChunkedUploadView):
     serializer_class = PhotoChunkedSerializer
     http_method_names = ('post', 'put', 'get', )
     parser_classes = (MultiPartParser, )
+    parallel = False
+
+    def is_valid_chunked_upload(self, chunked_upload):
+        super().is_valid_chunked_upload(chunked_upload)
+        if chunked_upload.parallel != self.parallel:
+            raise ChunkedUploadError(status=status.HTTP_400_BAD_REQUEST, detail='Upload mode does not match')
+
+
+class UploadParallelChunkedPhoto(UploadChunkedPhoto):
+    """
+    API to upload chunked file with several concurrent requests.
+    Chunks can be sent in any order, each one with its position in the 'Content-Range' header. The first chunk creates
+    the upload with the total size of the file, and the upload can be completed once all the chunks have been received.
+
+    create:
+    End upload file with md5 checksum of file.
+
+    update:
+    Upload chunks file.
+    """
+    parallel = True
+
+    def get_content_range(self, request, chunk, whole=False):
+        """
+        Position of the chunk in the file and total size of the file, from a 'bytes start-end/total' header where the
+        end is included, as in RFC 7233.
+        :return: tuple (start, end, total)
+        """
+        if whole:
+            return 0, chunk.size - 1, chunk.size
+        match = self.content_range_pattern.match(request.META.get('HTTP_CONTENT_RANGE', ''))
+        if not match:
+            raise ChunkedUploadError(status=status.HTTP_400_BAD_REQUEST, detail='Error in request headers')
+        return int(match.group('start')), int(match.group('end')), int(match.group('total'))
+
+    def _put_chunk(self, request, pk=None, whole=False, *args, **kwargs):
+        chunk = request.data.get(self.field_name)
+        if chunk is None:
+            raise ChunkedUploadError(status=status.HTTP_400_BAD_REQUEST, detail='No chunk file was submitted')
+
+        start, end, total = self.get_content_range(request, chunk, whole)
+        max_bytes = self.get_max_bytes(request)
+        if max_bytes is not None and total > max_bytes:
+            raise ChunkedUploadError(status=status.HTTP_400_BAD_REQUEST,
+                                     detail='Size of file exceeds the limit ({} bytes)'.format(max_bytes))
+        if chunk.size != end - start + 1 or end >= total:
+            raise ChunkedUploadError(status=status.HTTP_400_BAD_REQUEST,
+                                     detail="File size doesn't match headers")
+
+        if pk:
+            chunked_upload = get_object_or_404(self.get_queryset(), pk=pk)
+            self.is_valid_chunked_upload(chunked_upload)
+            if chunked_upload.size != total:
+                raise ChunkedUploadError(status=status.HTTP_400_BAD_REQUEST, detail='Sizes do not match',
+                                         size=chunked_upload.size)
+        else:
+            serializer = self.serializer_class(data=request.data)
+            if not serializer.is_valid():
+                raise ChunkedUploadError(status=status.HTTP_400_BAD_REQUEST, detail=serializer.errors)
+            user = request.user if request.user.is_authenticated() else None
+            chunked_upload = serializer.save(user=user, parallel=True, size=total)
+            chunked_upload.preallocate()
+
+        chunked_upload.write_chunk(chunk, start)
+        return chunked_upload
+
+    def _post(self, request, pk=None, *args, **kwargs):
+        if pk:
+            chunked_upload = get_object_or_404(self.get_queryset(), pk=pk)
+            self.is_valid_chunked_upload(chunked_upload)
+            missing_ranges = chunked_upload.missing_ranges
+            if missing_ranges:
+                raise ChunkedUploadError(status=status.HTTP_400_BAD_REQUEST, detail='Missing chunks',
+                                         missing_ranges=missing_ranges)
+            # chunks have been written in any order, so the file is read once to compute all its digests
+            chunked_upload.register_digests()
+        return super()._post(request, pk=pk, *args, **kwargs)
 
 
 class PhotoSearchView(PermissionMixin, FilterMixin, ListModelMixin, HaystackGenericAPIView):
@@ -237,12 +369,12 @@ class UserViewSet(FilterModelViewSet):
     filter_class = UserFilter
 
 
-class AlbumViewSet(FilterModelViewSet):
+class AlbumViewSet(ViewSetSerializerMixin, PhotoIdsViewSetMixin, FilterModelViewSet):
     """
     API to list, create, retrieve, update, delete albums
 
     list:
-    List all album instances.
+    List all album instances, without their photos.
 
     retrieve:
     Return an album instance.
@@ -252,11 +384,24 @@ class AlbumViewSet(FilterModelViewSet):
 
     update:
     Update an album instance.
+
+    photos:
+    List the ids of the photos of an album, paginated by cursor.
     """
     serializer_class = AlbumSerializer
     queryset = Album.objects.active()
     filter_class = AlbumFilter
     filter_backends = (FilterAlbumPermissionBackend, )
+    action_serializer_class = {
+        'list': AlbumListSerializer,
+    }
+
+    def get_queryset(self):
+        """
+        Album owners are required to evaluate object permissions, so prefetch them for all albums at once. The first
+        photos are annotated to fetch the photos of albums without cover at once too.
+        """
+        return super().get_queryset().prefetch_related('owners__groups').with_first_photo()
 
 
 class PhotoViewSet(ViewSetSerializerMixin, FilterModelViewSet):
@@ -277,22 +422,33 @@ class PhotoViewSet(ViewSetSerializerMixin, FilterModelViewSet):
 
     update:
     Complete update a photo instance.
+
+    bulk_create:
+    Create many photo instances at once. All of them are validated together and, if any of them is not valid, none
+    is created.
     """
     serializer_class = PhotoSerializer
     queryset = Photo.objects.active()
     filter_class = PhotoFilter
     filter_backends = (FilterPhotoPermissionBackend, )
     action_serializer_class = {
-        'list': BasePhotoSerializer
+        'list': BasePhotoSerializer,
+        'bulk_create': PhotoBulkCreateSerializer,
     }
+    keyset_ordering = ('-modified_at', '-id', )
 
     def get_queryset(self):
         """Optimize total number of queries and so reduce response time"""
-        return super().get_queryset().select_related(
-            'exif', 'author', 'copyright', 'internal_usage_restriction', 'external_usage_restriction', 'owner', 'album'
-        ).prefetch_related(
-            'categories', 'tagged_items', 'names', 'owner__groups'
-        )
+        return super().get_queryset().for_index().select_related('exif', 'owner').prefetch_related('owner__groups')
+
+    @list_route(methods=['post'], url_path='bulk')
+    def bulk_create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        with transaction.atomic():
+            photos = serializer.save()
+        data = BasePhotoSerializer(photos, many=True, context=self.get_serializer_context()).data
+        return Response(data, status=status.HTTP_201_CREATED)
 
 
 class TaxonomyViewSet(FilterModelViewSet):
@@ -316,6 +472,11 @@ class TaxonomyViewSet(FilterModelViewSet):
     filter_class = TaxonomyFilter
     pagination_class = TaxonomyNumberPagination
 
+    def retrieve(self, request, *args, **kwargs):
+        """Render the category from the snapshot of its tree, as lists do"""
+        serializer = self.get_serializer([self.get_object()], many=True)
+        return Response(serializer.data[0])
+
 
 class TaxonomyLevelViewSet(FilterReadOnlyModelViewSet):
     """
@@ -336,12 +497,12 @@ class TaxonomyListViewSet(FilterMixin, ListAPIView):
     filter_class = TaxonomyFilter
 
 
-class GalleryViewSet(FilterModelViewSet):
+class GalleryViewSet(ViewSetSerializerMixin, PhotoIdsViewSetMixin, FilterModelViewSet):
     """
     API to list, create, retrieve, update, delete galleries
 
     list:
-    List all gallery instances.
+    List all gallery instances, without their photos.
 
     retrieve:
     Return a gallery instance.
@@ -351,13 +512,23 @@ class GalleryViewSet(FilterModelViewSet):
 
     update:
     Update a gallery instance.
+
+    photos:
+    List the ids of the photos of a gallery, paginated by cursor.
     """
     serializer_class = GallerySerializer
     queryset = Gallery.objects.all()
     filter_class = GalleryFilter
+    action_serializer_class = {
+        'list': GalleryListSerializer,
+    }
+
+    def get_queryset(self):
+        """The first photos are annotated to fetch the photos of galleries without cover at once"""
+        return super().get_queryset().with_first_photo()
 
 
-class LinkerPhotoViewSet(CreateDestroyViewSet):
+class LinkerPhotoViewSet(ViewSetSerializerMixin, CreateDestroyViewSet):
     """
     API to create and delete photo links to galleries
 
@@ -366,9 +537,23 @@ class LinkerPhotoViewSet(CreateDestroyViewSet):
 
     destroy:
     Delete a photo link to a gallery.
+
+    bulk:
+    Link and unlink many photos to a gallery at once.
     """
     serializer_class = GalleryMembershipSerializer
     queryset = GalleryMembership.objects.all()
+    action_serializer_class = {
+        'bulk': GalleryMembershipBulkSerializer,
+    }
+
+    @list_route(methods=['post'])
+    def bulk(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        with transaction.atomic():
+            result = serializer.save()
+        return Response(result)
 
 
 class LoggerBaseView(FilterMixin):
@@ -378,6 +563,7 @@ class LoggerBaseView(FilterMixin):
     serializer_class = AccessLogSerializer
     queryset = AccessLog.objects.all()
     filter_class = AccessLogFilter
+    keyset_ordering = ('-added_at', '-id', )
 
 
 class LoggerViewSet(LoggerBaseView, CreateListViewSet):
@@ -400,6 +586,71 @@ class LoggerListView(LoggerBaseView, ListAPIView):
     pagination_class = LargeNumberPagination
 
 
+class Echo(object):
+    """
+    File-like object which returns the written value instead of buffering it, to stream csv rows.
+    """
+    def write(self, value):
+        return value
+
+
+class LoggerStreamView(LoggerBaseView, ListAPIView):
+    """
+    API call to export all filtered logger actions over photos in a single streamed response, in the same order as
+    the list (the last added first).
+    The format is selected with 'export_format' query param: 'csv' (default) or 'ndjson' (a json object per line).
+
+    list:
+    Export access logs to photos.
+    """
+    FORMAT_CSV = 'csv'
+    FORMAT_NDJSON = 'ndjson'
+    CONTENT_TYPES = {
+        FORMAT_CSV: 'text/csv',
+        FORMAT_NDJSON: 'application/x-ndjson',
+    }
+    FIELDS = ('photo', 'title', 'action', 'action_display', 'added_at', 'user', 'username', 'first_name', 'last_name',
+              'email', 'roles', )
+    chunk_size = 1000
+
+    def get_queryset(self):
+        return super().get_queryset().select_related('user', 'photo').prefetch_related('user__groups')
+
+    def list(self, request, *args, **kwargs):
+        export_format = request.query_params.get('export_format', self.FORMAT_CSV)
+        if export_format not in self.CONTENT_TYPES:
+            raise ValidationError({'export_format': _i('Invalid format. Options are: {}').format(
+                ', '.join(self.CONTENT_TYPES))})
+
+        access_logs = iterate_by_chunks(self.filter_queryset(self.get_queryset()), self.chunk_size,
+                                        ordering=self.keyset_ordering)
+        rows = self.get_rows(access_logs)
+        content = self.csv_content(rows) if export_format == self.FORMAT_CSV else self.ndjson_content(rows)
+        response = StreamingHttpResponse(content, content_type=self.CONTENT_TYPES[export_format])
+        response['Content-Disposition'] = 'attachment; filename="access_logs.{}"'.format(export_format)
+        return response
+
+    def get_rows(self, access_logs):
+        """
+        Flat representation of each access log, with the fields defined in 'FIELDS'
+        """
+        for access_log in access_logs:
+            user = access_log.user
+            yield (access_log.photo_id, access_log.photo.title, access_log.action, access_log.get_action_display(),
+                   access_log.added_at, user.id, user.username, user.first_name, user.last_name, user.email,
+                   sorted(get_group_names(user)))
+
+    def csv_content(self, rows):
+        writer = csv.writer(Echo())
+        yield writer.writerow(self.FIELDS)
+        for row in rows:
+            yield writer.writerow(row[:-1] + ('|'.join(row[-1]), ))
+
+    def ndjson_content(self, rows):
+        for row in rows:
+            yield '{}\n'.format(json.dumps(dict(zip(self.FIELDS, row)), cls=DjangoJSONEncoder))
+
+
 class CopyrightViewSet(FilterReadOnlyModelViewSet):
     """
     API to list and retrieve copyrights
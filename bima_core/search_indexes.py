@@ -20,13 +20,19 @@ class PhotoIndex(TranslationMixin, indexes.ModelSearchIndex, indexes.Indexable):
     class Meta:
         model = Photo
 
+    def index_queryset(self, using=None):
+        """
+        All photos with their related data, to prepare each batch of documents with a constant number of queries
+        """
+        return self.get_model().objects.for_index()
+
     def prepare_categories(self, obj):
         """
         Prepare multi-valued field with all category names
         :param obj: photo instance
         :return: list
         """
-        return "\n".join(obj.categories.values_list('name', flat=True))
+        return "\n".join(category.name for category in obj.categories.all())
 
     def prepare_keywords(self, obj):
         """
@@ -34,7 +40,7 @@ class PhotoIndex(TranslationMixin, indexes.ModelSearchIndex, indexes.Indexable):
         :param obj: photo instance
         :return: list
         """
-        return "\n".join(obj.keywords.values_list('tag__name', flat=True))
+        return "\n".join(keyword.tag.name for keyword in obj.keywords.all())
 
     def prepare_names(self, obj):
         """
@@ -42,7 +48,7 @@ class PhotoIndex(TranslationMixin, indexes.ModelSearchIndex, indexes.Indexable):
         :param obj: photo instance
         :return: list
         """
-        return "\n".join(obj.names.values_list('name', flat=True))
+        return "\n".join(name.name for name in obj.names.all())
 
     def prepare_normalized_title(self, obj):
         """
@@ -1,12 +1,17 @@
-from django.apps import apps
 from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.signals import request_finished, request_started
 from django.db import models
-from django.db.models.signals import post_save
-from django.db.models.utils import make_model_tuple
+from django.db.models.signals import post_delete, post_init, post_save, pre_delete, m2m_changed
 from django.dispatch import receiver
 from haystack import signals
+from mptt.signals import node_moved
 from rest_framework.authtoken.models import Token
-from .tasks import rebuild_photo_index
+from .constants import PHOTO_COUNTS_ATTR, RELATED_PHOTO_IDS_ATTR, REMOVED_PHOTO_COUNTS_ATTR, TAXONOMY_MOVED_ATTR
+from .managers import photo_counts_state
+from .models import Album, DAMTaxonomy, Gallery, GalleryMembership, Photo
+from .tasks import INDEX_REMOVE_ACTION, INDEX_UPDATE_ACTION, index_queue, queue_photo_index_update
+from .utils import bump_taxonomy_tree_version, clear_group_names, count_differences
 
 
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
@@ -15,6 +20,140 @@ def create_auth_token(sender, instance=None, created=False, **kwargs):
         Token.objects.create(user=instance)
 
 
+@receiver(m2m_changed, sender=get_user_model().groups.through)
+def clear_user_group_names(sender, instance=None, action=None, reverse=False, **kwargs):
+    """
+    Invalidate the cached group names of the user when his groups change.
+    """
+    if not reverse and action in ('post_add', 'post_remove', 'post_clear', ):
+        clear_group_names(instance)
+
+
+# Photo counters
+
+@receiver(post_init, sender=Photo)
+def keep_photo_count_state(sender, instance, **kwargs):
+    """
+    Keep how the photo is counted when it is loaded, to update the photo counters with the differences when it is saved.
+    """
+    setattr(instance, PHOTO_COUNTS_ATTR, instance.photo_count_state)
+
+
+@receiver(post_save, sender=Photo)
+def update_photo_counts(sender, instance, created=False, raw=False, **kwargs):
+    """
+    Update the photo counters of the albums, taxonomies and galleries of a saved photo if it has been moved to another
+    album or its active or published status has changed.
+    """
+    previous_state = (None, (0, 0)) if created else getattr(instance, PHOTO_COUNTS_ATTR, None)
+    state = instance.photo_count_state
+    setattr(instance, PHOTO_COUNTS_ATTR, state)
+    if raw or photo_counts_state.paused or None in (previous_state, state) or previous_state == state:
+        return
+
+    (previous_album_id, previous_counts), (album_id, counts) = previous_state, state
+    Album.update_photo_counts(count_differences({previous_album_id: previous_counts}, {album_id: counts}))
+    if not created and previous_counts != counts:
+        difference = count_differences({instance.pk: previous_counts}, {instance.pk: counts})[instance.pk]
+        for model in (DAMTaxonomy, Gallery):
+            model.update_photo_counts(instance.get_relation_photo_counts(model, difference))
+
+
+@receiver(pre_delete, sender=Photo)
+def remove_photo_counts(sender, instance, **kwargs):
+    """
+    Subtract a deleted photo from the photo counters of its album and taxonomies. Its galleries are updated when its
+    memberships are deleted.
+    """
+    state = getattr(instance, PHOTO_COUNTS_ATTR, None)
+    if photo_counts_state.paused or state is None:
+        return
+    album_id, counts = state
+    Album.update_photo_counts({album_id: counts}, sign=-1)
+    DAMTaxonomy.update_photo_counts(instance.get_relation_photo_counts(DAMTaxonomy, counts), sign=-1)
+
+
+@receiver(m2m_changed, sender=Photo.categories.through)
+def update_taxonomy_photo_counts(sender, instance, action=None, reverse=False, pk_set=None, **kwargs):
+    """
+    Update the photo counters of taxonomies when photos are categorized or uncategorized, from both sides of the
+    relation. Removed relations are counted before they are deleted, because only the existing ones are subtracted.
+    """
+    if photo_counts_state.paused or action not in ('post_add', 'pre_remove', 'post_remove', 'pre_clear',
+                                                   'post_clear', ):
+        return
+    if action in ('post_remove', 'post_clear', ):
+        DAMTaxonomy.update_photo_counts(getattr(instance, REMOVED_PHOTO_COUNTS_ATTR, {}), sign=-1)
+        setattr(instance, REMOVED_PHOTO_COUNTS_ATTR, {})
+        return
+
+    related = instance.taxonomy_photos.all() if reverse else instance.categories.all()
+    if pk_set is not None:
+        related = related.filter(pk__in=pk_set)
+    if reverse:
+        counts = {instance.pk: related.count_photos()}
+    else:
+        photo_counts = Photo.objects.filter(pk=instance.pk).count_photos()
+        counts = {pk: photo_counts for pk in related.values_list('id', flat=True)}
+
+    if action == 'post_add':
+        DAMTaxonomy.update_photo_counts(counts)
+    else:
+        setattr(instance, REMOVED_PHOTO_COUNTS_ATTR, counts)
+
+
+@receiver(post_save, sender=GalleryMembership)
+def add_gallery_photo_counts(sender, instance, created=False, raw=False, **kwargs):
+    """
+    Add a photo linked to a gallery to its photo counters.
+    """
+    if created and not raw and not photo_counts_state.paused:
+        Gallery.update_photo_counts({instance.gallery_id: Photo.objects.filter(pk=instance.photo_id).count_photos()})
+
+
+@receiver(post_delete, sender=GalleryMembership)
+def remove_gallery_photo_counts(sender, instance, **kwargs):
+    """
+    Subtract a photo unlinked from a gallery from its photo counters.
+    """
+    if not photo_counts_state.paused:
+        Gallery.update_photo_counts(
+            {instance.gallery_id: Photo.objects.filter(pk=instance.photo_id).count_photos()}, sign=-1)
+
+
+@receiver(node_moved, sender=DAMTaxonomy)
+def move_taxonomy_photo_counts(sender, instance, position=None, **kwargs):
+    """
+    Subtree counters are computed again when a taxonomy is moved. When it is moved by saving it with a new parent,
+    the signal is sent before the parent is saved, so they are computed once it has been saved.
+    """
+    if position is None:
+        setattr(instance, TAXONOMY_MOVED_ATTR, True)
+    else:
+        DAMTaxonomy.rollup_photo_counts()
+
+
+@receiver(post_save, sender=DAMTaxonomy)
+@receiver(post_delete, sender=DAMTaxonomy)
+def rollup_taxonomy_photo_counts(sender, instance, **kwargs):
+    """
+    Subtree counters are computed again when a taxonomy has been moved or deleted.
+    """
+    if kwargs['signal'] is post_delete or getattr(instance, TAXONOMY_MOVED_ATTR, False):
+        setattr(instance, TAXONOMY_MOVED_ATTR, False)
+        DAMTaxonomy.rollup_photo_counts()
+
+
+@receiver(post_save, sender=DAMTaxonomy)
+@receiver(post_delete, sender=DAMTaxonomy)
+@receiver(node_moved, sender=DAMTaxonomy)
+def expire_taxonomy_trees(sender, **kwargs):
+    """
+    Serialized taxonomy trees are built again when a taxonomy is saved, moved or deleted.
+    """
+    bump_taxonomy_tree_version()
+
+
 # Haystack signal processor
 
 class PhotoSignalProcessor(signals.BaseSignalProcessor):
@@ -22,7 +161,8 @@ class PhotoSignalProcessor(signals.BaseSignalProcessor):
     Custom signal processor to keep 'Photo' model updated. So, it has defined a list of related models to listen
     their post save/delete signals to keep photo instance updated.
 
-    For a better user experience all object updates/deletes will be queued and processed in background
+    For a better user experience all object updates/deletes will be queued and processed in background. During a
+    request the updates are collected and deduplicated, and they are queued in a single job when it finishes.
     """
     PHOTO_SENDER_MODEL = 'bima_core.Photo'
 
@@ -38,6 +178,10 @@ class PhotoSignalProcessor(signals.BaseSignalProcessor):
         for model in [self.PHOTO_SENDER_MODEL, ] + list(self.SIGNALS_MODELS):
             models.signals.post_save.connect(self.handle_save, sender=model)
             models.signals.post_delete.connect(self.handle_delete, sender=model)
+        for model in self.SIGNALS_MODELS:
+            models.signals.pre_delete.connect(self.handle_pre_delete, sender=model)
+        request_started.connect(index_queue.start)
+        request_finished.connect(index_queue.finish)
 
     def teardown(self):
         """
@@ -46,13 +190,17 @@ class PhotoSignalProcessor(signals.BaseSignalProcessor):
         for model in [self.PHOTO_SENDER_MODEL, ] + list(self.SIGNALS_MODELS):
             models.signals.post_save.disconnect(self.handle_save, sender=model)
             models.signals.post_delete.disconnect(self.handle_delete, sender=model)
+        for model in self.SIGNALS_MODELS:
+            models.signals.pre_delete.disconnect(self.handle_pre_delete, sender=model)
+        request_started.disconnect(index_queue.start)
+        request_finished.disconnect(index_queue.finish)
 
     def handle_save(self, sender, instance, **kwargs):
         """
         To keep the indexes of 'Photos' updated with the changes of related models, this method is in charge of
-        obtaining the photo instances related to the object that notifies the post save signal.
+        obtaining the photo ids related to the object that notifies the post save signal.
         This receives a valid instance. From this instance class, the method gets all ForeignKey and ManyToMany field
-        names to obtain all photo instances involved and update their indexes.
+        names to obtain all photo ids involved and queue their update in chunks.
 
         * valid instance means that his class is included in 'SIGNALS_MODEL' or is 'PHOTO_SENDER_MODEL'
 
@@ -61,35 +209,43 @@ class PhotoSignalProcessor(signals.BaseSignalProcessor):
         :param kwargs:
         :return:
         """
-        for photo_instance in self._get_related_photo_instance(sender, instance):
-            self.handle_save(photo_instance.__class__, photo_instance, **kwargs)
-        rebuild_photo_index.delay(instance.__class__, instance.id, 'update_object')
+        if sender._meta.label == self.PHOTO_SENDER_MODEL:
+            index_queue.add(instance.__class__, instance.id, INDEX_UPDATE_ACTION)
+        else:
+            queue_photo_index_update(self._get_related_photo_ids(sender, instance))
+
+    def handle_pre_delete(self, sender, instance, **kwargs):
+        """
+        Keep the related photo ids of the instance before its relations are deleted.
+        """
+        setattr(instance, RELATED_PHOTO_IDS_ATTR, self._get_related_photo_ids(sender, instance))
 
     def handle_delete(self, sender, instance, **kwargs):
         """
         This method is overridden for the same reason that 'handle_save' with the particularity that is a delete
-        operation.
+        operation. Deleted photos are removed from index and the related photos of other models are updated.
 
         :param sender:
         :param instance:
         :param kwargs:
         :return:
         """
-        for photo_instance in self._get_related_photo_instance(sender, instance):
-            self.handle_delete(photo_instance.__class__, photo_instance.id, **kwargs)
-        rebuild_photo_index.delay(instance.__class__, instance.id, 'remove_object')
+        if sender._meta.label == self.PHOTO_SENDER_MODEL:
+            index_queue.add(instance.__class__, instance.id, INDEX_REMOVE_ACTION)
+        else:
+            queue_photo_index_update(getattr(instance, RELATED_PHOTO_IDS_ATTR, []))
 
-    def _get_related_photo_instance(self, sender, instance):
+    def _get_related_photo_ids(self, sender, instance):
         """
-        Gets all related photo instances from signal of instance change.
+        Gets all related photo ids from signal of instance change, without loading photo instances.
         """
         if sender._meta.label not in self.SIGNALS_MODELS:
             return []
 
-        ids, model = [], apps.get_model(*make_model_tuple(self.PHOTO_SENDER_MODEL))
+        ids = []
         for field_name in self._get_m2m_field_names(sender) + self._get_related_field_names(sender):
             ids.extend(getattr(instance, field_name).values_list('id', flat=True))
-        return model.objects.filter(id__in=ids)
+        return ids
 
     def _get_related_field_names(self, model):
         """
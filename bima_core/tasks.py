@@ -1,37 +1,137 @@
 # -*- coding: utf-8 -*-
 import logging
-import time
+import threading
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from functools import partial
 
 from django.apps import apps
-from django.core.files.base import ContentFile
+from django.core.files.base import File
+from django.db import transaction
 from django.db.models.utils import make_model_tuple
 from django_rq import job
+from haystack import connection_router, connections
 from haystack.exceptions import NotHandled
+from haystack.utils import get_model_ct
 
-from .constants import RQ_UPLOAD_QUEUE, RQ_HAYSTACK_PHOTO_INDEX_QUEUE
-from .models import Photo, PhotoChunked
-from .utils import get_filename
+from .constants import IMAGE_HASH_ATTR, INDEX_CHUNK_SIZE, RQ_UPLOAD_QUEUE, RQ_HAYSTACK_PHOTO_INDEX_QUEUE
+from .models import Photo, PhotoChunked, PhotoContent
+from .utils import file_hash, get_filename
 
 
 logger = logging.getLogger(__name__)
 
+INDEX_UPDATE_ACTION = 'update_object'
+INDEX_REMOVE_ACTION = 'remove_object'
+INDEX_ACTIONS = (INDEX_UPDATE_ACTION, INDEX_REMOVE_ACTION, )
+
+
+class IndexQueue(threading.local):
+    """
+    Thread local queue of pending index actions. While it is collecting (during a request or a job), the actions are
+    deduplicated by model and id, where the last action wins, and they are dispatched together in a single batch job
+    when the outermost collecting block finishes. Out of a collecting block actions are dispatched immediately.
+    Jobs are always enqueued when the current transaction is committed, so they never read uncommitted rows.
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.pending = OrderedDict()
+
+    def add(self, model, instance_id, action):
+        key = (make_model_tuple(model), instance_id)
+        self.pending.pop(key, None)
+        self.pending[key] = action
+        if not self.depth:
+            self.flush()
+
+    def start(self, **kwargs):
+        self.depth += 1
+
+    def finish(self, **kwargs):
+        self.depth = max(self.depth - 1, 0)
+        if not self.depth:
+            self.flush()
+
+    def flush(self):
+        pending, self.pending = self.pending, OrderedDict()
+        if pending:
+            actions = [(model, instance_id, action) for (model, instance_id), action in pending.items()]
+            transaction.on_commit(partial(update_index.delay, actions))
+
+    @contextmanager
+    def collect(self):
+        self.start()
+        try:
+            yield self
+        finally:
+            self.finish()
+
+
+index_queue = IndexQueue()
+
+
+def queue_photo_index_update(photo_ids, chunk_size=INDEX_CHUNK_SIZE):
+    """
+    Queue the index update of many photos in jobs of 'chunk_size' ids, when the current transaction is committed.
+    :param photo_ids: iterable of photo ids
+    :param chunk_size: number of photos of each job
+    """
+    photo_ids = sorted(set(photo_ids))
+    for start in range(0, len(photo_ids), chunk_size):
+        transaction.on_commit(partial(update_photo_index.delay, photo_ids[start:start + chunk_size]))
+
 
 @job(RQ_UPLOAD_QUEUE)
 def up_image_to_s3(photo_id, image_id):
+    with index_queue.collect():
+        return _up_image_to_s3(photo_id, image_id)
+
+
+@job(RQ_UPLOAD_QUEUE)
+def up_images_to_s3(uploads):
+    """
+    Upload the images of many photos in a single job, collecting their index updates in a single batch.
+    :param uploads: list of tuples (photo id, image chunk id)
+    """
+    with index_queue.collect():
+        return [_up_image_to_s3(photo_id, image_id) for photo_id, image_id in uploads]
+
+
+def _up_image_to_s3(photo_id, image_id):
     try:
         photo = Photo.objects.get(id=photo_id)
         image = PhotoChunked.objects.get(id=image_id)
-        photo.image = ContentFile(image.file.read(), name=image.filename)
-        photo.set_metadata(only_readable=False, commit=False)
-        if not photo.original_file_name:
-            photo.original_file_name = get_filename(image.file.name)
-
-        # upload new image
-        photo.save()
-
-        # update upload status after upload has been really done
-        photo.upload_status = Photo.UPLOADED
-        photo.save()
+        # the local chunked file is never loaded in memory. It is read in chunks to compute its content address and
+        # streamed to the storage
+        image.file.open('rb')
+        try:
+            image_file = File(image.file.file, name=image.filename)
+            sha256, size = image.sha256 or file_hash(image_file), image_file.size
+            previous_name = photo.image.name if photo.image else None
+            # metadata is extracted from the local file, before uploading it
+            photo.set_metadata(only_readable=False, commit=False, image_file=image_file)
+
+            content = PhotoContent.objects.filter(sha256=sha256).first()
+            if content and photo.image.storage.exists(content.name):
+                # the same image is already stored, so the photo references it and nothing is uploaded
+                photo.image = content.name
+            else:
+                setattr(photo, IMAGE_HASH_ATTR, sha256)
+                photo.image = image_file
+            if not photo.original_file_name:
+                photo.original_file_name = get_filename(image.file.name)
+
+            # upload new image and save it with its metadata. The upload is done before the row is updated, so the
+            # uploaded status is only saved when the upload has been really done
+            photo.upload_status = Photo.UPLOADED
+            photo.save()
+        finally:
+            image.file.close()
+
+        PhotoContent.objects.add_reference(sha256, photo.image.name, size=size)
+        if previous_name and previous_name != photo.image.name:
+            PhotoContent.objects.remove_reference(previous_name)
 
         return photo
     except Photo.DoesNotExist:
@@ -61,7 +161,7 @@ def rebuild_photo_index(sender_class, instance_id, action_name):
     try:
         haystack_signal_processor = apps.get_app_config('haystack').signal_processor
         model = apps.get_model(*make_model_tuple(sender_class))
-        instance = _get_instance(model, instance_id)
+        instance = model.objects.get(id=instance_id)
     except Exception:
         logger.error("An error occurred updating photo index id '{}' with the current haystack application "
                      "configuration".format(instance_id), extra={'sender': sender_class, 'instance': instance_id},
@@ -77,20 +177,49 @@ def rebuild_photo_index(sender_class, instance_id, action_name):
             logger.info("There is not index defined for the sender '{}' class".format(sender_class._meta.label))
 
 
-def _get_instance(model, instance_id):
+@job(RQ_HAYSTACK_PHOTO_INDEX_QUEUE)
+def update_index(actions):
     """
-    Post save signals are fired after the INSERT SQL have been done but the transaction may not
-    have been commited yet. In that case, the instance is not in the database and we have to do a
-    busy wait.
+    Apply a batch of index actions, grouped by model.
+    :param actions: list of tuples (model tuple or label, instance id, action name)
     """
-    max_attempts = 3
-    wait_between_attempts = 0.5  # in seconds
+    grouped_ids = defaultdict(lambda: {action: set() for action in INDEX_ACTIONS})
+    for model, instance_id, action_name in actions:
+        if action_name not in INDEX_ACTIONS:
+            logger.error("Action '{}' is not valid operation for haystack index.".format(action_name))
+            continue
+        grouped_ids[make_model_tuple(model)][action_name].add(instance_id)
+
+    for model_tuple, ids in grouped_ids.items():
+        _update_model_index(apps.get_model(*model_tuple), ids[INDEX_UPDATE_ACTION], ids[INDEX_REMOVE_ACTION])
 
-    for attempt in range(max_attempts):
-        try:
-            return model.objects.get(id=instance_id)
-        except model.DoesNotExist:
-            logger.debug('Waitting for transaction...')
-            time.sleep(wait_between_attempts)
 
-    raise model.DoesNotExist('{} with id {} does not exist'.format(model.__name__, instance_id))
+@job(RQ_HAYSTACK_PHOTO_INDEX_QUEUE)
+def update_photo_index(photo_ids):
+    """
+    Prepare again the index documents of a chunk of photos and update them in bulk.
+    :param photo_ids: list of photo ids
+    """
+    _update_model_index(Photo, set(photo_ids))
+
+
+def _update_model_index(model, update_ids, remove_ids=()):
+    """
+    Update the index of the instances of a model with a single query (through the index queryset, with its related
+    data) and a bulk update for each backend, and remove the others by their identifier. Instances to update which are
+    not in the index queryset any more are removed too.
+    """
+    for using in connection_router.for_write(models=[model]):
+        try:
+            index = connections[using].get_unified_index().get_index(model)
+        except NotHandled:
+            logger.info("There is not index defined for the sender '{}' class".format(model._meta.label))
+            return
+        instances = list(index.index_queryset(using=using).filter(id__in=update_ids))
+        removed_ids = set(remove_ids) | (set(update_ids) - {instance.id for instance in instances})
+
+        backend = connections[using].get_backend()
+        if instances:
+            backend.update(index, instances)
+        for instance_id in removed_ids:
+            backend.remove('{}.{}'.format(get_model_ct(model), instance_id))
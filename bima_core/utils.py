@@ -2,15 +2,27 @@
 import re
 from LatLon23 import Latitude, Longitude
 from dateutil import parser
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.db import connections, transaction
+from django.db.models import Min, Max, Q
 from django.http import HttpRequest, QueryDict
+from django_thumbor import generate_url
 from exifread import Ratio
+from collections import OrderedDict
+from functools import lru_cache
+import hashlib
+import json
 import os
 import six
+import threading
 import unicodedata
+import uuid
 
-from .constants import ADMIN_GROUP_NAME
+from .constants import ADMIN_GROUP_NAME, GROUP_NAMES_CACHE_ATTR, IMAGE_CHUNK_SIZE, IMAGE_HASH_ALGORITHM, \
+    TAXONOMY_TREE_VERSION_KEY
 
 
 def idpath(fs, id, extension=''):
@@ -27,6 +39,250 @@ def idpath(fs, id, extension=''):
     return os.path.join('photos/', *paths) + extension
 
 
+def file_hash(file, algorithm=IMAGE_HASH_ALGORITHM, chunk_size=IMAGE_CHUNK_SIZE):
+    """
+    Hex digest of the content of a django file, read in chunks so memory is bounded whatever its size.
+    :param file: django file (or field file)
+    :param algorithm: name of a hashlib algorithm
+    :param chunk_size: number of bytes read each time
+    :return: string
+    """
+    digest = hashlib.new(algorithm)
+    for chunk in file.chunks(chunk_size=chunk_size):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DigestRegistry(object):
+    """
+    Process local registry of the digests of files which are written sequentially in parts (like chunked uploads).
+    The digests are updated with each part, so they are available when the last part is written without reading the
+    file again. The state of a file is only valid while its parts are received in order by the same process, otherwise
+    it is discarded and the digests have to be computed from the file.
+    The number of files is bounded, discarding the least recently updated ones.
+    """
+
+    def __init__(self, algorithms, maxsize=256):
+        self.algorithms = tuple(algorithms)
+        self.maxsize = maxsize
+        self.states = OrderedDict()
+        self.lock = threading.Lock()
+
+    def update(self, key, offset, data):
+        """
+        Update the digests of a file with a part written at the given offset.
+        :param key: identifier of the file
+        :param offset: position of the part in the file
+        :param data: bytes of the part
+        """
+        with self.lock:
+            state = self.states.pop(key, None)
+            if state is None and offset == 0:
+                state = (0, [hashlib.new(algorithm) for algorithm in self.algorithms])
+            if state is None or state[0] != offset:
+                return
+            for digest in state[1]:
+                digest.update(data)
+            self.states[key] = (offset + len(data), state[1])
+            while len(self.states) > self.maxsize:
+                self.states.popitem(last=False)
+
+    def hexdigests(self, key, size):
+        """
+        Digests of a file, only if all its bytes have been registered.
+        :param key: identifier of the file
+        :param size: size of the file
+        :return: dict of hex digests by algorithm or None
+        """
+        with self.lock:
+            state = self.states.get(key)
+            if state is None or state[0] != size:
+                return None
+            return {algorithm: digest.hexdigest() for algorithm, digest in zip(self.algorithms, state[1])}
+
+    def discard(self, key):
+        with self.lock:
+            self.states.pop(key, None)
+
+
+chunk_digests = DigestRegistry(('md5', IMAGE_HASH_ALGORITHM), maxsize=getattr(settings, 'CHUNK_DIGESTS_SIZE', 256))
+
+
+@lru_cache(maxsize=getattr(settings, 'THUMBOR_URL_CACHE_SIZE', 4096))
+def generate_thumbor_url(image_url, width=None, height=None, smart=False, fit_in=False, filters=()):
+    """
+    Build the signed thumbor url of an image. The result is memoized in a bounded LRU cache by all params, so any change
+    of the image name, size or filters (which come from constance config) generates a new url.
+    Use 'generate_thumbor_url.cache_info()' to get hits and misses of the cache.
+    :param image_url: path of the image in the storage
+    :param width: width (in pixels)
+    :param height: height (in pixels)
+    :param smart: smart crop
+    :param fit_in: fit in image into the size
+    :param filters: tuple of thumbor filters
+    :return: string
+    """
+    thumbor_params = {key: value for key, value in (('width', width), ('height', height)) if value}
+    url = generate_url(image_url, smart=smart, fit_in=fit_in, filters=list(filters), **thumbor_params)
+
+    # remove unsave string from thumbor url
+    if getattr(settings, 'THUMBOR_URL_REMOVE_UNSAFE', False):
+        url = url.replace('/unsafe/', '/')
+
+    # add prefix to media url
+    prefix = getattr(settings, 'THUMBOR_MEDIA_URL_PREFIX', '')
+    if prefix:
+        media_url = getattr(settings, 'THUMBOR_MEDIA_URL', '')
+        url = url.replace("/{}/".format(media_url), "/{}/{}/".format(prefix, media_url))
+
+    return url
+
+
+def id_ranges(queryset, chunk_size, start_id=None):
+    """
+    Split the primary keys of the queryset in consecutive ranges of 'chunk_size' ids. It only runs an aggregation,
+    so it is useful to partition big tables to process them in parallel.
+    :param queryset: queryset with an integer primary key
+    :param chunk_size: number of ids of each range
+    :param start_id: first id to process (optional)
+    :return: generator of tuples (first id, last id), both included
+    """
+    bounds = queryset.aggregate(first=Min('pk'), last=Max('pk'))
+    first, last = bounds['first'], bounds['last']
+    if first is None:
+        return
+    if start_id is not None:
+        first = max(first, start_id)
+    for start in range(first, last + 1, chunk_size):
+        yield start, min(start + chunk_size - 1, last)
+
+
+def keyset_filter(ordering, position):
+    """
+    Filter of the instances after a position in an ordering: (a > x) OR (a = x AND b > y) OR ...
+    :param ordering: field names, prefixed with '-' for descending order
+    :param position: values of the fields of the ordering
+    :return: Q object
+    """
+    condition_filter = Q()
+    for index, field in enumerate(ordering):
+        lookup = '{}__lt' if field.startswith('-') else '{}__gt'
+        condition = Q(**{lookup.format(field.lstrip('-')): position[index]})
+        for previous_field, value in zip(ordering[:index], position):
+            condition &= Q(**{previous_field.lstrip('-'): value})
+        condition_filter |= condition
+    return condition_filter
+
+
+def iterate_by_chunks(queryset, chunk_size=1000, ordering=('pk', )):
+    """
+    Iterate over a queryset fetching consecutive chunks of instances in the given ordering. Each chunk is a new query
+    filtered by the ordering values of the last instance seen, so memory is bounded by the chunk size and related
+    lookups (select_related/prefetch_related) are resolved once per chunk.
+    :param queryset: queryset to iterate
+    :param chunk_size: number of instances fetched by query
+    :param ordering: field names, prefixed with '-' for descending order, where the last one must be unique
+    :return: generator of instances
+    """
+    queryset = queryset.order_by(*ordering)
+    position = None
+    while True:
+        chunk = queryset if position is None else queryset.filter(keyset_filter(ordering, position))
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            return
+        yield from chunk
+        position = [getattr(chunk[-1], field.lstrip('-')) for field in ordering]
+
+
+def merge_ranges(ranges):
+    """
+    Merge overlapping or contiguous ranges of positions.
+    :param ranges: iterable of (start, end) with the end excluded
+    :return: sorted list of [start, end] not overlapping
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def missing_ranges(ranges, size):
+    """
+    Gaps of a set of merged ranges in the positions from 0 to size.
+    :param ranges: sorted list of [start, end] not overlapping, with the end excluded
+    :param size: number of positions
+    :return: list of [start, end]
+    """
+    missing, position = [], 0
+    for start, end in ranges:
+        if start > position:
+            missing.append([position, start])
+        position = max(position, end)
+    if position < size:
+        missing.append([position, size])
+    return missing
+
+
+def count_differences(before, after):
+    """
+    Differences between the photo counts of many instances
+    :param before: dict of instance id: (active photos, published photos)
+    :param after: dict of instance id: (active photos, published photos)
+    :return: dict of instance id: differences, only of the instances whose counts have changed
+    """
+    differences = {}
+    for key in set(before) | set(after):
+        difference = tuple(new - old for old, new in zip(before.get(key, (0, 0)), after.get(key, (0, 0))))
+        if any(difference):
+            differences[key] = difference
+    return differences
+
+
+def get_taxonomy_tree_version():
+    """
+    Current version of the serialized taxonomy trees, which are cached by version.
+    :return: version string
+    """
+    return cache.get(TAXONOMY_TREE_VERSION_KEY) or _set_taxonomy_tree_version()
+
+
+def bump_taxonomy_tree_version():
+    """
+    Expire the serialized taxonomy trees when any taxonomy changes. The version is bumped again once the current
+    transaction is committed, so trees serialized meanwhile from data which was not committed yet are not used.
+    """
+    _set_taxonomy_tree_version()
+    transaction.on_commit(_set_taxonomy_tree_version)
+
+
+def _set_taxonomy_tree_version():
+    version = uuid.uuid4().hex
+    cache.set(TAXONOMY_TREE_VERSION_KEY, version, None)
+    return version
+
+
+def estimate_count(queryset):
+    """
+    Number of rows of the queryset estimated by the query planner, without executing it. Only available for PostgreSQL.
+    :param queryset: queryset to estimate
+    :return: estimated number of rows or None if the database does not support it
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) {}'.format(sql), params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
 def get_filename(path):
     return os.path.basename(path)
 
@@ -177,6 +433,37 @@ def get_exif_altitude(exif, key):
     return get_exif_info(exif, key, default=0)
 
 
+def get_group_names(user):
+    """
+    Get the names of all groups of the user.
+    They are resolved once and kept in the user instance, so all permission checks done over the same user (the
+    request one) are served from memory. If groups have been prefetched, they are used instead of querying them.
+    :param user: user
+    :return: frozenset of group names
+    """
+    if not (user and isinstance(user, get_user_model())):
+        return frozenset()
+
+    group_names = getattr(user, GROUP_NAMES_CACHE_ATTR, None)
+    if group_names is None:
+        prefetched_groups = getattr(user, '_prefetched_objects_cache', {}).get('groups', None)
+        if prefetched_groups is not None:
+            group_names = frozenset(group.name for group in prefetched_groups)
+        else:
+            group_names = frozenset(user.groups.values_list('name', flat=True))
+        setattr(user, GROUP_NAMES_CACHE_ATTR, group_names)
+    return group_names
+
+
+def clear_group_names(user):
+    """
+    Clean the cached group names of the user. Next permission check will resolve them again.
+    :param user: user
+    """
+    if hasattr(user, GROUP_NAMES_CACHE_ATTR):
+        delattr(user, GROUP_NAMES_CACHE_ATTR)
+
+
 def belongs_to_some_group(user, groups):
     """
     Check if the user belongs to some group.
@@ -186,7 +473,7 @@ def belongs_to_some_group(user, groups):
     """
     if not (user and isinstance(user, get_user_model()) and groups and is_iterable(groups)):
         return False
-    return user.groups.filter(name__in=groups).exists()
+    return not get_group_names(user).isdisjoint(groups)
 
 
 def belongs_to_group(user, group):
@@ -1,12 +1,15 @@
 # -*- encoding: utf-8 -*-
+from contextlib import contextmanager
 from uuid import UUID
 from django.conf import settings
+from django.db import connection
 from django.db.models import QuerySet
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
 from django.core.files.base import ContentFile
 from django.forms import model_to_dict
 from django.test.client import MULTIPART_CONTENT, BOUNDARY, encode_multipart
+from django.test.utils import CaptureQueriesContext
 from faker import Factory
 from hashlib import md5
 from model_mommy import mommy
@@ -16,7 +19,7 @@ import pytest
 import random
 
 from bima_core.constants import ADMIN_GROUP_NAME, EDITOR_GROUP_NAME, READER_GROUP_NAME, PHOTOGRAPHER_GROUP_NAME
-from bima_core.models import Album, Photo, DAMTaxonomy, Gallery, GalleryMembership, PhotoChunked
+from bima_core.models import AccessLog, Album, Photo, DAMTaxonomy, Gallery, GalleryMembership, PhotoChunked
 
 
 CHUNK_SIZE = 1000
@@ -117,9 +120,14 @@ def update_multipart_headers(headers):
     return headers
 
 
-def update_chunk_range_headers(headers, offset, chunk, file):
+def update_chunk_range_headers(headers, offset, chunk, file, inclusive=False):
+    """
+    :param inclusive: the end of the range is the last byte of the chunk (RFC 7233), as parallel uploads expect,
+    instead of the next position, as sequential uploads of drf-chunked-upload expect
+    """
     if isinstance(headers, dict):
-        headers.update({'HTTP_CONTENT_RANGE': 'bytes {}-{}/{}'.format(offset, offset + len(chunk), file.size)})
+        end = offset + len(chunk) - (1 if inclusive else 0)
+        headers.update({'HTTP_CONTENT_RANGE': 'bytes {}-{}/{}'.format(offset, end, file.size)})
     return headers
 
 
@@ -332,6 +340,13 @@ def extended_photo(photo):
     yield _extend_photo(photo)
 
 
+@pytest.fixture()
+def extended_photo_set(image_file):
+    """ Prepare a list of extended photo data to create many instances via API. """
+    owners = [mommy.make(get_user_model(), username='photo_set_owner'), ]
+    yield [_extend_photo(_new_photo(owners, image_file)) for _ in range(3)]
+
+
 @pytest.fixture()
 def photo_of_photographer(photographer_token, image_file):
     owners = [photographer_token.user, ]
@@ -384,3 +399,22 @@ def public_photo_set(publish_status, image_file):
 def private_photo_set(image_file):
     owners = [mommy.make(get_user_model(), username=faker.user_name()), ]
     yield _new_photo_instance(owners, image_file, quantity=3)
+
+
+@pytest.fixture()
+def access_log_set(reader_token, public_photo_set):
+    yield [AccessLog.objects.create(photo=photo, user=reader_token.user, action=AccessLog.VIEWED)
+           for photo in public_photo_set]
+
+
+@pytest.fixture()
+def assert_num_queries():
+    """
+    Context manager to check the number of queries executed in its block
+    """
+    @contextmanager
+    def _assert_num_queries(num):
+        with CaptureQueriesContext(connection) as context:
+            yield context
+        assert len(context) == num, '{} queries executed, {} expected'.format(len(context), num)
+    return _assert_num_queries
@@ -1,8 +1,23 @@
 # -*- encoding: utf-8 -*-
+from io import StringIO
+from unittest import mock
+
 from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db.models import Q
+from django.utils.timezone import now
+from hashlib import md5, sha256
+from model_mommy import mommy
 import pytest
 
-from bima_core.models import Album, Photo
+from bima_core.constants import ADMIN_GROUP_NAME, EDITOR_GROUP_NAME
+from bima_core.models import Album, DAMTaxonomy, Gallery, GalleryMembership, Photo, PhotoChunked, PhotoContent
+from bima_core.search_indexes import PhotoIndex
+from bima_core.tasks import INDEX_REMOVE_ACTION, INDEX_UPDATE_ACTION, IndexQueue, queue_photo_index_update, \
+    up_image_to_s3
+from bima_core.utils import belongs_to_admin_group, belongs_to_group, belongs_to_some_group, clear_group_names, \
+    generate_thumbor_url, get_taxonomy_tree_version, id_ranges, DigestRegistry
 
 
 class TestMixin(object):
@@ -111,6 +126,49 @@ class TestAlbum(TestMixin):
         assert self.validate_deleted_instance(Album, set(pks))
         assert self.validate_inactive_nested_instance(Album, set(pks), 'photos_album')
 
+    def test_prefetch_photos(self, assert_num_queries, public_photo_set, photo_instance):
+        """
+        Photos of a set of albums (their covers or their first photos) are fetched at once
+        """
+        cover_album = photo_instance.album
+        cover_album.cover = photo_instance
+        cover_album.save()
+        pks = [cover_album.id, public_photo_set[0].album_id, mommy.make(Album).id]
+        expected = {pk: Album.objects.get(pk=pk).photo for pk in pks}
+        assert expected[cover_album.id] == photo_instance
+        assert expected[public_photo_set[0].album_id] in public_photo_set
+
+        albums = list(Album.objects.filter(pk__in=pks).with_first_photo())
+        with assert_num_queries(1):
+            Album.prefetch_photos(albums)
+        with assert_num_queries(0):
+            assert {album.id: album.photo for album in albums} == expected
+
+    def test_prefetch_gallery_photos(self, assert_num_queries, public_photo_set):
+        """
+        Galleries without cover are represented by their first linked photo
+        """
+        gallery = mommy.make(Gallery)
+        for photo in reversed(public_photo_set):
+            mommy.make(GalleryMembership, photo=photo, gallery=gallery)
+        empty_gallery = mommy.make(Gallery)
+        galleries = list(Gallery.objects.filter(pk__in=[gallery.id, empty_gallery.id]).with_first_photo())
+        with assert_num_queries(1):
+            Gallery.prefetch_photos(galleries)
+        with assert_num_queries(0):
+            photos = {instance.id: instance.photo for instance in galleries}
+        assert photos == {gallery.id: public_photo_set[-1], empty_gallery.id: None}
+
+    def test_first_photo_ties(self, public_photo_set):
+        """
+        The first photo of an album is the last modified one and, with the same modification date, the last created
+        """
+        album = public_photo_set[0].album
+        Photo.objects.filter(album=album).update(modified_at=now())
+        last_photo = max(public_photo_set, key=lambda photo: photo.id)
+        assert album.get_first_photo() == last_photo
+        assert Album.objects.with_first_photo().get(pk=album.pk).first_photo_id == last_photo.id
+
 
 @pytest.mark.django_db
 @pytest.mark.unit_test
@@ -132,6 +190,71 @@ class TestPhoto(TestMixin):
         Photo.objects.filter(pk__in=pks).soft_delete()
         assert self.validate_inactive_instance(Photo, set(pks))
 
+    def test_prefetch_object_permissions(self, assert_num_queries, public_photo_set, private_photo_set):
+        """
+        Owners of a set of photos are resolved at once to evaluate object permissions
+        """
+        photos = list(Photo.objects.filter(pk__in=[photo.pk for photo in public_photo_set + private_photo_set]))
+        with assert_num_queries(1):
+            Photo.prefetch_object_permissions(photos)
+        with assert_num_queries(0):
+            for photo in photos:
+                assert photo.is_membership(get_user_model()(id=photo.owner_id))
+
+    def test_prefetch_for_index(self, assert_num_queries, public_photo_set):
+        """
+        Photo index documents are prepared without extra queries once related data has been prefetched
+        """
+        public_photo_set[0].keywords.add('bridge', language='en')
+        public_photo_set[0].names.add('Gaudi')
+        photos = list(Photo.objects.filter(id__in=[photo.id for photo in public_photo_set]).for_index())
+        index = PhotoIndex()
+        with assert_num_queries(0):
+            prepared = [(index.prepare_keywords(photo), index.prepare_names(photo), index.prepare_categories(photo))
+                        for photo in photos]
+        assert ('bridge', 'Gaudi', '') in prepared
+
+    def test_up_image_to_s3(self, photo_instance, image_file):
+        """
+        The chunked file is uploaded to its content addressed path with its metadata
+        """
+        image_chunk = mommy.make(PhotoChunked, file=image_file, user=photo_instance.owner, status=PhotoChunked.COMPLETE)
+        photo = up_image_to_s3(photo_instance.id, image_chunk.id)
+        image_file.seek(0)
+        digest = sha256(image_file.read()).hexdigest()
+        assert photo.upload_status == Photo.UPLOADED
+        assert photo.image.name.replace('/', '').startswith('photos{}'.format(digest[:8]))
+        assert photo.width and photo.height
+
+    def test_up_image_to_s3_reuses_stored_content(self, public_photo_set, image_file):
+        """
+        An image already stored is referenced again without uploading it
+        """
+        first, second = public_photo_set[:2]
+        storage = Photo._meta.get_field('image').storage
+        chunks = [mommy.make(PhotoChunked, file=image_file, user=photo.owner, status=PhotoChunked.COMPLETE)
+                  for photo in (first, second)]
+        first = up_image_to_s3(first.id, chunks[0].id)
+        with mock.patch.object(storage, 'save', wraps=storage.save) as save:
+            second = up_image_to_s3(second.id, chunks[1].id)
+        assert not save.called
+        assert second.image.name == first.image.name
+        assert second.upload_status == Photo.UPLOADED
+        content = PhotoContent.objects.get(name=first.image.name)
+        assert content.references == 2
+
+    def test_visible_photos_for_user(self, public_photo_set, photo_instance):
+        """
+        Photos visible by a user are the same than joining the album owners, without duplicates nor distinct
+        """
+        user = photo_instance.album.owners.first()
+        photo_instance.album.owners.add(mommy.make(get_user_model()))
+        expected = Photo.objects.filter(
+            Q(owner=user) | Q(album__owners=user) | Q(status=Photo.PUBLISHED)).distinct().values_list('id', flat=True)
+        visible = Photo.objects.visible_for(user)
+        assert not visible.query.distinct
+        assert sorted(visible.values_list('id', flat=True)) == sorted(expected)
+
     def test_permanently_delete_photo(self, photo_instance):
         """
         Delete photo permanently
@@ -147,3 +270,291 @@ class TestPhoto(TestMixin):
         pks = [photo.id for photo in public_photo_set]
         Photo.objects.filter(pk__in=pks).delete()
         assert self.validate_deleted_instance(Photo, set(pks))
+
+
+@pytest.mark.django_db
+@pytest.mark.unit_test
+class TestUserGroups(object):
+
+    def test_group_names_are_cached(self, assert_num_queries, editor_token):
+        """
+        Group membership is resolved once per user instance
+        """
+        user = get_user_model().objects.get(pk=editor_token.user.pk)
+        with assert_num_queries(1):
+            assert belongs_to_group(user, EDITOR_GROUP_NAME)
+            assert not belongs_to_admin_group(user)
+            assert belongs_to_some_group(user, [ADMIN_GROUP_NAME, EDITOR_GROUP_NAME])
+
+    def test_clear_group_names(self, editor_token, admin_group):
+        """
+        Cleaning cached group names resolves them again
+        """
+        user = get_user_model().objects.get(pk=editor_token.user.pk)
+        assert not belongs_to_admin_group(user)
+        user.groups.add(admin_group)
+        clear_group_names(user)
+        assert belongs_to_admin_group(user)
+
+
+@pytest.mark.django_db
+@pytest.mark.unit_test
+class TestThumborUrl(object):
+
+    def test_thumbor_url_is_memoized(self, photo_instance):
+        """
+        The same image and size returns the memoized url
+        """
+        generate_thumbor_url.cache_clear()
+        url = photo_instance.image_thumbnail
+        assert photo_instance.image_thumbnail == url
+        cache_info = generate_thumbor_url.cache_info()
+        assert cache_info.hits == 1 and cache_info.misses == 1
+
+    def test_thumbor_url_changes_with_size(self, photo_instance):
+        """
+        Different sizes generate different urls
+        """
+        generate_thumbor_url.cache_clear()
+        assert photo_instance.image_small != photo_instance.image_large
+        assert generate_thumbor_url.cache_info().misses == 2
+
+
+@pytest.mark.unit_test
+class TestDigestRegistry(object):
+
+    def test_digests_are_updated_by_parts(self):
+        """
+        Digests of the parts written in order are the digests of the whole content
+        """
+        registry = DigestRegistry(('md5', 'sha256'))
+        registry.update('file', 0, b'first')
+        assert registry.hexdigests('file', 5) == {'md5': md5(b'first').hexdigest(),
+                                                  'sha256': sha256(b'first').hexdigest()}
+        registry.update('file', 5, b'second')
+        assert registry.hexdigests('file', 5) is None
+        assert registry.hexdigests('file', 11)['md5'] == md5(b'firstsecond').hexdigest()
+
+    def test_unordered_parts_discard_digests(self):
+        """
+        A part out of order invalidates the digests of the file
+        """
+        registry = DigestRegistry(('md5', ))
+        registry.update('file', 0, b'first')
+        registry.update('file', 10, b'second')
+        registry.update('other', 3, b'third')
+        assert registry.hexdigests('file', 16) is None
+        assert registry.hexdigests('other', 8) is None
+
+    def test_registry_is_bounded(self):
+        registry = DigestRegistry(('md5', ), maxsize=1)
+        registry.update('file', 0, b'first')
+        registry.update('other', 0, b'second')
+        assert registry.hexdigests('file', 5) is None
+        assert registry.hexdigests('other', 6) is not None
+
+
+@pytest.mark.django_db
+@pytest.mark.unit_test
+class TestExportThumbnails(object):
+
+    def test_id_ranges(self, public_photo_set):
+        """
+        Id ranges cover all photos without overlapping
+        """
+        ids = sorted(Photo.objects.values_list('id', flat=True))
+        ranges = list(id_ranges(Photo.objects.all(), 2))
+        assert ranges[0][0] == ids[0] and ranges[-1][1] == ids[-1]
+        assert all(end + 1 == start for (_, end), (start, _) in zip(ranges, ranges[1:]))
+
+    def test_export_thumbnails(self, public_photo_set):
+        """
+        Export writes a header and a row for each active photo
+        """
+        output = StringIO()
+        call_command('export_thumbnails', size=['thumbnail', 'small'], chunk_size=2, stdout=output, stderr=StringIO())
+        lines = output.getvalue().splitlines()
+        assert lines[0] == 'id,thumbnail,small'
+        assert len(lines) == Photo.objects.active().count() + 1
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.unit_test
+class TestIndexQueue(object):
+
+    def test_collect_deduplicates_actions(self):
+        """
+        Actions collected in a block are deduplicated and dispatched in a single job
+        """
+        queue = IndexQueue()
+        with mock.patch('bima_core.tasks.update_index.delay') as delay:
+            with queue.collect():
+                queue.add(Photo, 1, INDEX_UPDATE_ACTION)
+                queue.add(Photo, 2, INDEX_UPDATE_ACTION)
+                queue.add(Photo, 1, INDEX_UPDATE_ACTION)
+                queue.add(Photo, 2, INDEX_REMOVE_ACTION)
+                assert not delay.called
+        delay.assert_called_once_with([(('bima_core', 'photo'), 1, INDEX_UPDATE_ACTION),
+                                       (('bima_core', 'photo'), 2, INDEX_REMOVE_ACTION)])
+
+    def test_dispatch_out_of_block(self):
+        """
+        Actions out of a collecting block are dispatched immediately
+        """
+        queue = IndexQueue()
+        with mock.patch('bima_core.tasks.update_index.delay') as delay:
+            queue.add(Photo, 1, INDEX_UPDATE_ACTION)
+        delay.assert_called_once_with([(('bima_core', 'photo'), 1, INDEX_UPDATE_ACTION)])
+
+    def test_queue_photo_index_update_in_chunks(self):
+        """
+        Many photo ids are queued in chunks without duplicates
+        """
+        with mock.patch('bima_core.tasks.update_photo_index.delay') as delay:
+            queue_photo_index_update([3, 1, 2, 3, 5, 4], chunk_size=2)
+        assert [call[0][0] for call in delay.call_args_list] == [[1, 2], [3, 4], [5]]
+
+
+@pytest.mark.django_db
+@pytest.mark.unit_test
+class TestReindexPhotos(object):
+
+    def test_dry_run(self, public_photo_set):
+        """
+        Dry run prepares all documents without updating the index
+        """
+        output = StringIO()
+        with mock.patch('haystack.backends.whoosh_backend.WhooshSearchBackend.update') as update:
+            call_command('reindex_photos', workers=1, chunk_size=2, dry_run=True, stdout=output)
+        assert not update.called
+        assert '{0}/{0} photos'.format(len(public_photo_set)) in output.getvalue()
+
+    def test_resume_id(self, public_photo_set):
+        """
+        The last progress line reports the last photo id sent to the backend, including the documents of the final
+        flush
+        """
+        output = StringIO()
+        with mock.patch('haystack.backends.whoosh_backend.WhooshSearchBackend.update') as update:
+            call_command('reindex_photos', workers=1, chunk_size=2, batch_size=2, stdout=output)
+        assert sum(len(call[0][1]) for call in update.call_args_list) == len(public_photo_set)
+        progress = output.getvalue().splitlines()[-2]
+        assert progress.endswith('Resume from: {}'.format(max(photo.id for photo in public_photo_set)))
+
+
+@pytest.mark.unit_test
+@pytest.mark.django_db
+class TestPhotoCounts(object):
+
+    @staticmethod
+    def get_counts(instance, *fields):
+        instance.refresh_from_db()
+        return tuple(getattr(instance, field) for field in fields or ('photos_count', 'published_photos_count'))
+
+    def test_album_photo_counts(self, public_photo_set, photo_instance):
+        """
+        Album counters follow the status, album and soft deletion of its photos
+        """
+        album = public_photo_set[0].album
+        assert self.get_counts(album) == (3, 3)
+        photo = public_photo_set[0]
+        photo.status = Photo.PRIVATE
+        photo.save()
+        assert self.get_counts(album) == (3, 2)
+        photo.album = photo_instance.album
+        photo.save()
+        assert self.get_counts(album) == (2, 2)
+        assert self.get_counts(photo_instance.album) == (2, 0)
+        Photo.objects.filter(id=public_photo_set[1].id).soft_delete()
+        assert self.get_counts(album) == (1, 1)
+
+    def test_photo_counts_by_relation(self, public_photo_set, photo_instance):
+        """
+        Photos are counted by each related instance, whatever the number of photos of each one
+        """
+        photos = Photo.objects.filter(pk__in=[photo.pk for photo in public_photo_set + [photo_instance]])
+        assert photos.photo_counts('album') == {public_photo_set[0].album_id: (3, 3), photo_instance.album_id: (1, 0)}
+
+    def test_taxonomy_photo_counts(self, public_photo_set, photo_instance):
+        """
+        Taxonomy counters follow the categories of photos from both sides, and subtree counters add up descendants
+        """
+        root = DAMTaxonomy.objects.create(name='root', slug='root')
+        child = DAMTaxonomy.objects.create(name='child', slug='child', parent=root)
+        public_photo_set[0].categories.add(root, child)
+        public_photo_set[1].categories.add(child)
+        child.taxonomy_photos.add(photo_instance)
+        assert self.get_counts(child) == (3, 2)
+        assert self.get_counts(root, 'subtree_photos_count', 'subtree_published_photos_count') == (4, 3)
+
+        child.taxonomy_photos.remove(public_photo_set[1], public_photo_set[2])
+        public_photo_set[0].categories.clear()
+        assert self.get_counts(child) == (1, 0)
+        assert self.get_counts(root) == (0, 0)
+        assert self.get_counts(root, 'subtree_photos_count', 'subtree_published_photos_count') == (1, 0)
+
+        child.parent = None
+        child.save()
+        assert self.get_counts(root, 'subtree_photos_count', 'subtree_published_photos_count') == (0, 0)
+        assert self.get_counts(child, 'subtree_photos_count', 'subtree_published_photos_count') == (1, 0)
+
+    def test_gallery_photo_counts(self, public_photo_set, photo_instance):
+        """
+        Gallery counters follow the links of photos and the soft deletion of the linked ones
+        """
+        gallery = mommy.make(Gallery)
+        for photo in public_photo_set + [photo_instance]:
+            mommy.make(GalleryMembership, photo=photo, gallery=gallery)
+        assert self.get_counts(gallery) == (4, 3)
+        GalleryMembership.objects.filter(photo=photo_instance).delete()
+        assert self.get_counts(gallery) == (3, 3)
+        public_photo_set[0].album.soft_delete()
+        assert self.get_counts(gallery) == (0, 0)
+
+    def test_repair_photo_counts(self, public_photo_set):
+        """
+        Wrong counters are reported in check mode and repaired otherwise
+        """
+        album = public_photo_set[0].album
+        Album.objects.filter(id=album.id).update(photos_count=0)
+        with pytest.raises(CommandError):
+            call_command('repair_photo_counts', check=True, stdout=StringIO())
+        call_command('repair_photo_counts', stdout=StringIO())
+        assert self.get_counts(album) == (3, 3)
+        call_command('repair_photo_counts', check=True, stdout=StringIO())
+
+
+@pytest.mark.unit_test
+@pytest.mark.django_db
+class TestTaxonomyTree(object):
+
+    def test_load_tree(self, assert_num_queries):
+        """
+        A whole tree is loaded with a single query and its nodes are linked in memory
+        """
+        root = DAMTaxonomy.objects.create(name='root', slug='root')
+        second = DAMTaxonomy.objects.create(name='second', slug='second', parent=root)
+        first = DAMTaxonomy.objects.create(name='first', slug='first', parent=root)
+        leaf = DAMTaxonomy.objects.create(name='leaf', slug='leaf', parent=second)
+        other_root = DAMTaxonomy.objects.create(name='other', slug='other')
+        # roots are ordered by name, so inserting another root can change the tree id
+        root.refresh_from_db()
+        with assert_num_queries(1):
+            nodes = DAMTaxonomy.load_tree([root.tree_id])
+        assert set(nodes) == {root.id, first.id, second.id, leaf.id}
+        assert other_root.id not in nodes
+        with assert_num_queries(0):
+            assert [node.id for node in nodes[root.id].tree_children] == [first.id, second.id]
+            assert [node.id for node in nodes[leaf.id].ancestors] == [second.id, root.id]
+            assert nodes[leaf.id].parent.id == second.id
+            assert nodes[root.id].ancestors == []
+
+    def test_tree_version_expires(self, taxonomy_instance, photo_instance):
+        """
+        Snapshots of taxonomy trees expire when any taxonomy changes, but not when their photo counters change
+        """
+        version = get_taxonomy_tree_version()
+        photo_instance.categories.add(taxonomy_instance)
+        assert get_taxonomy_tree_version() == version
+        taxonomy_instance.save()
+        assert get_taxonomy_tree_version() != version
@@ -1,14 +1,23 @@
 # -*- encoding: utf-8 -*-
 import json
+from datetime import timedelta
+from hashlib import md5, sha256
 from unittest import mock
 
+from constance.test import override_config
 from django.conf import settings
+from django.core.cache import cache
 from django.core.files.base import ContentFile
 from django.core.urlresolvers import reverse
+from django.utils.timezone import now
 import pytest
 
+from bima_core.models import AccessLog, DAMTaxonomy, GalleryMembership, Photo, PhotoChunked
+from bima_core.private_api.views import LoggerStreamView
+from bima_core.utils import chunk_digests, get_taxonomy_tree_version
+
 from .conftest import CHUNK_SIZE, encode_multipart_data, update_multipart_headers, update_chunk_range_headers, \
-    checksum_file
+    checksum_file, _new_photo_instance
 
 
 class TestMixin(object):
@@ -132,6 +141,29 @@ class TestAlbumApi(TestMixin):
         response = client.get(reverse('album-detail', args=[album_instance.id]), **reader_headers)
         assert self.validate_status_response(response, 200)
 
+    def test_list_album_photo_ids(self, client, admin_headers, public_photo_set):
+        """
+        Photo ids of an album are paginated by cursor in ascending order, and they are not embedded in album lists
+        """
+        album, photo_ids = public_photo_set[0].album, sorted(photo.id for photo in public_photo_set)
+        url = reverse('album-photos', args=[album.id])
+        with override_config(LARGE_PAGE_SIZE=2):
+            response = client.get(url, **admin_headers)
+            assert self.validate_status_response(response, 200)
+            assert response.data['results'] == photo_ids[:2]
+            response = client.get(url, {'cursor': response.data['next']}, **admin_headers)
+        assert response.data['results'] == photo_ids[2:] and response.data['next'] is None
+
+        response = client.get(reverse('album-list'), **admin_headers)
+        assert response.data['results'] and all('photos' not in item for item in response.data['results'])
+
+    def test_no_permitted_list_album_photo_ids(self, client, random_reader_headers, album_instance):
+        """
+        Photo ids of an album can not be listed by a reader who is not a member of it
+        """
+        response = client.get(reverse('album-photos', args=[album_instance.id]), **random_reader_headers)
+        assert self.validate_status_response(response, 403)
+
     def test_delete_album(self, client, admin_headers, album_instance):
         """
         Admin user can delete albums
@@ -190,6 +222,31 @@ class TestPhotoApi(TestMixin):
             response = client.post(reverse('photo-list'), data=photo_of_photographer, **photographer_headers)
         assert self.validate_status_response(response, 201)
 
+    def test_bulk_create_photos(self, client, admin_headers, extended_photo_set):
+        """
+        Create many photos with their keywords and names in a single request and a single upload job
+        """
+        with mock.patch('bima_core.tasks.up_images_to_s3.delay', return_value=None):
+            response = client.post(reverse('photo-bulk'), data=json.dumps(extended_photo_set),
+                                   content_type='application/json', **admin_headers)
+        assert self.validate_status_response(response, 201)
+        assert len(response.data) == len(extended_photo_set)
+        photos = Photo.objects.filter(id__in=[item['id'] for item in response.data])
+        assert photos.count() == len(extended_photo_set)
+        assert all(photo.keywords.exists() and photo.names.exists() for photo in photos)
+        assert all(photo.album.photos_count == 1 for photo in photos.select_related('album'))
+
+    def test_bulk_create_photos_with_invalid_item(self, client, admin_headers, extended_photo_set):
+        """
+        If any photo is not valid none is created, and the errors are returned for each item
+        """
+        extended_photo_set[-1]['album'] = 0
+        response = client.post(reverse('photo-bulk'), data=json.dumps(extended_photo_set),
+                               content_type='application/json', **admin_headers)
+        assert self.validate_status_response(response, 400)
+        assert 'album' in response.data[-1] and not response.data[0]
+        assert not Photo.objects.filter(title__in=[item['title'] for item in extended_photo_set]).exists()
+
     def test_update_photo(self, client, admin_headers, photo_instance, photo):
         """
         Is not necessary mock 'up_image_to_s3' task because the image is already in filesystem so update call
@@ -199,6 +256,54 @@ class TestPhotoApi(TestMixin):
                                 content_type='application/x-www-form-urlencoded', **admin_headers)
         assert self.validate_status_response(response, 200)
 
+    def test_bulk_update_photos(self, client, admin_headers, public_photo_set, taxonomy_instance):
+        """
+        Add the same categories and keywords and set the status of many photos in a single request
+        """
+        data = {'ids': [photo.id for photo in public_photo_set], 'status': Photo.PRIVATE,
+                'categories': [taxonomy_instance.id], 'keywords': [{'language': settings.LANGUAGE_CODE, 'tag': 'bulk'}]}
+        with mock.patch('bima_core.tasks.update_photo_index.delay', return_value=None):
+            response = client.patch(reverse('photo-bulk-update-addition'), data=json.dumps(data),
+                                    content_type='application/json', **admin_headers)
+        assert self.validate_status_response(response, 200)
+        assert response.data['count'] == len(public_photo_set)
+        photos = Photo.objects.filter(id__in=data['ids'])
+        assert all(photo.status == Photo.PRIVATE for photo in photos)
+        assert all(taxonomy_instance in photo.categories.all() for photo in photos)
+        assert all('bulk' in {keyword.tag.name for keyword in photo.keywords.all()} for photo in photos)
+        album = public_photo_set[0].album
+        album.refresh_from_db()
+        taxonomy_instance.refresh_from_db()
+        assert (album.photos_count, album.published_photos_count) == (len(public_photo_set), 0)
+        assert taxonomy_instance.photos_count == taxonomy_instance.subtree_photos_count == len(public_photo_set)
+
+    def test_bulk_update_photos_selection(self, client, admin_headers, public_photo_set):
+        """
+        Soft deleted photos can not be selected, and the selection is limited as bulk creation
+        """
+        public_photo_set[0].delete()
+        data = {'ids': [photo.id for photo in public_photo_set], 'status': Photo.PRIVATE}
+        response = client.patch(reverse('photo-bulk-update-addition'), data=json.dumps(data),
+                                content_type='application/json', **admin_headers)
+        assert self.validate_status_response(response, 400)
+        assert str(public_photo_set[0].id) in response.data['ids'][0]
+
+        data = {'filter': {'status': Photo.PUBLISHED}, 'status': Photo.PRIVATE}
+        with mock.patch('bima_core.private_api.serializers.PHOTO_BULK_MAX_SIZE', 1):
+            response = client.patch(reverse('photo-bulk-update-addition'), data=json.dumps(data),
+                                    content_type='application/json', **admin_headers)
+        assert self.validate_status_response(response, 400)
+        assert 'filter' in response.data
+
+    def test_no_permitted_bulk_update_photos(self, client, photographer_headers, public_photo_set):
+        """
+        A photographer can not update photos of other owners
+        """
+        data = {'ids': [photo.id for photo in public_photo_set], 'status': Photo.PRIVATE}
+        response = client.patch(reverse('photo-bulk-update-addition'), data=json.dumps(data),
+                                content_type='application/json', **photographer_headers)
+        assert self.validate_status_response(response, 403)
+
     def test_update_photo_as_photograph(self, client, photographer_headers, photo_instance_of_photographer,
                                         photo_of_photographer):
         """
@@ -217,6 +322,58 @@ class TestPhotoApi(TestMixin):
         assert self.validate_status_response(response, 200)
         assert self.validate_elements_response(response, len(public_photo_set))
 
+    @override_config(PAGINATION_COUNT_MODE='cached')
+    def test_list_public_photos_with_cached_count(self, client, reader_headers, public_photo_set):
+        """
+        List public photos twice with cached count mode, so the second count is read from cache
+        """
+        cache.clear()
+        response = client.get(reverse('photo-list'), **reader_headers)
+        assert self.validate_elements_response(response, len(public_photo_set))
+        assert response.data['count_mode'] == 'exact'
+
+        response = client.get(reverse('photo-list'), **reader_headers)
+        assert self.validate_elements_response(response, len(public_photo_set))
+        assert response.data['count_mode'] == 'cached'
+
+    @override_config(PAGINATION_COUNT_MODE='cached')
+    def test_list_public_photos_beyond_cached_count(self, client, reader_headers, publish_status, image_file,
+                                                    public_photo_set):
+        """
+        A cached count is only a hint, so pages beyond it are listed while there are photos
+        """
+        cache.clear()
+        with mock.patch('bima_core.private_api.paginators.NumberPagination.get_page_size', return_value=2):
+            client.get(reverse('photo-list'), **reader_headers)
+            _new_photo_instance([public_photo_set[0].owner], image_file, status=publish_status, quantity=3)
+
+            response = client.get(reverse('photo-list'), {'page': 2}, **reader_headers)
+            assert response.data['count_mode'] == 'cached' and response.data['count'] == len(public_photo_set)
+            assert response.data['next'] == 3
+            response = client.get(reverse('photo-list'), {'page': 3}, **reader_headers)
+            assert self.validate_status_response(response, 200)
+            assert len(response.data['results']) == 2 and response.data['next'] is None
+            response = client.get(reverse('photo-list'), {'page': 4}, **reader_headers)
+            assert self.validate_status_response(response, 404)
+
+    def test_list_public_photos_by_cursor(self, client, reader_headers, public_photo_set):
+        """
+        List public photos with keyset pagination, following next and previous cursors
+        """
+        with mock.patch('bima_core.private_api.paginators.NumberPagination.get_page_size', return_value=2):
+            response = client.get(reverse('photo-list'), {'cursor': ''}, **reader_headers)
+            assert self.validate_status_response(response, 200)
+            assert 'count' not in response.data and response.data['previous'] is None
+            first_page = [photo['id'] for photo in response.data['results']]
+
+            response = client.get(reverse('photo-list'), {'cursor': response.data['next']}, **reader_headers)
+            second_page = [photo['id'] for photo in response.data['results']]
+            assert response.data['next'] is None
+            assert sorted(first_page + second_page) == sorted(photo.id for photo in public_photo_set)
+
+            response = client.get(reverse('photo-list'), {'cursor': response.data['previous']}, **reader_headers)
+            assert [photo['id'] for photo in response.data['results']] == first_page
+
     def test_list_private_photos(self, client, photographer_headers, photo_instance_of_photographer, private_photo_set):
         """
         List private photos and check number of elements
@@ -349,6 +506,16 @@ class TestGalleryApi(TestMixin):
         response = client.get(reverse('gallery-list'), **reader_headers)
         assert self.validate_status_response(response, 200)
 
+    def test_list_gallery_photo_ids(self, client, reader_headers, link_instance, public_photo_set):
+        """
+        Photo ids of a gallery only include the linked photos that the user can see
+        """
+        for photo in public_photo_set:
+            GalleryMembership.objects.create(photo=photo, gallery=link_instance.gallery, added_by=photo.owner)
+        response = client.get(reverse('gallery-photos', args=[link_instance.gallery_id]), **reader_headers)
+        assert self.validate_status_response(response, 200)
+        assert response.data['results'] == sorted(photo.id for photo in public_photo_set)
+
     def test_detail_galleries(self, client, reader_headers, gallery_instance):
         """
         Reader user can get gallery detail (anyone can do it).
@@ -402,6 +569,42 @@ class TestGalleryApi(TestMixin):
         response = client.delete(reverse('gallery-unlink', args=[link_instance.id]), **editor_headers)
         assert self.validate_status_response(response, 204)
 
+    def test_bulk_link_photos_to_gallery(self, client, editor_headers, link_instance, public_photo_set):
+        """
+        Link many photos and unlink the linked one in a single request
+        """
+        gallery = link_instance.gallery
+        data = {'gallery': gallery.id, 'link': [photo.id for photo in public_photo_set],
+                'unlink': [link_instance.photo_id]}
+        response = client.post(reverse('gallery-bulk'), data=json.dumps(data), content_type='application/json',
+                               **editor_headers)
+        assert self.validate_status_response(response, 200)
+        assert response.data['unlinked'] == [link_instance.photo_id]
+        assert set(gallery.galleries_membership.values_list('photo_id', flat=True)) == set(data['link'])
+        gallery.refresh_from_db()
+        assert (gallery.photos_count, gallery.published_photos_count) == (len(data['link']), len(data['link']))
+
+    def test_bulk_link_deleted_photos_to_gallery(self, client, editor_headers, link_instance, public_photo_set):
+        """
+        Soft deleted photos can not be linked to galleries
+        """
+        public_photo_set[0].delete()
+        data = {'gallery': link_instance.gallery_id, 'link': [photo.id for photo in public_photo_set]}
+        response = client.post(reverse('gallery-bulk'), data=json.dumps(data), content_type='application/json',
+                               **editor_headers)
+        assert self.validate_status_response(response, 400)
+        assert str(public_photo_set[0].id) in response.data['link'][0]
+
+    def test_no_permitted_bulk_link_photos_to_gallery(self, client, random_editor_headers, gallery_instance,
+                                                      public_photo_set):
+        """
+        An editor who is not owner of the gallery can not link photos to it
+        """
+        data = {'gallery': gallery_instance.id, 'link': [photo.id for photo in public_photo_set]}
+        response = client.post(reverse('gallery-bulk'), data=json.dumps(data), content_type='application/json',
+                               **random_editor_headers)
+        assert self.validate_status_response(response, 403)
+
     def test_no_permitted_link_photos_to_gallery(self, client, random_editor_headers, gallery_instance, photo_instance):
         """
         Admin user can create new gallery
@@ -458,6 +661,39 @@ class TestTaxonomyApi(TestMixin):
         response = client.get(reverse('damtaxonomy-detail', args=[taxonomy_instance.id]), **admin_headers)
         assert self.validate_status_response(response, 200)
 
+    def test_detail_taxonomy_tree(self, client, reader_headers, public_photo_instance):
+        """
+        Taxonomies are rendered from a snapshot of their tree, which is built again when any taxonomy changes, with
+        their current photo counters
+        """
+        root = DAMTaxonomy.objects.create(name='root', slug='root')
+        child = DAMTaxonomy.objects.create(name='child', slug='child', parent=root)
+        leaf = DAMTaxonomy.objects.create(name='leaf', slug='leaf', parent=child)
+        url = reverse('damtaxonomy-detail', args=[root.id])
+        response = client.get(url, **reader_headers)
+        assert self.validate_status_response(response, 200)
+        assert [node['id'] for node in response.data['children']] == [child.id]
+        leaf_data = response.data['children'][0]['children'][0]
+        assert leaf_data['id'] == leaf.id
+        assert [node['id'] for node in leaf_data['ancestors']] == [child.id, root.id]
+        assert leaf_data['extra_info']['parent']['id'] == child.id
+        assert leaf_data['permissions'] == response.data['permissions']
+        assert response.data['extra_info']['children'] == 2
+        assert response.data['extra_info']['subtree_photos_count'] == 0
+
+        version = get_taxonomy_tree_version()
+        public_photo_instance.categories.add(leaf)
+        response = client.get(url, **reader_headers)
+        assert get_taxonomy_tree_version() == version
+        assert response.data['extra_info']['subtree_published_photos_count'] == 1
+        assert response.data['children'][0]['children'][0]['extra_info']['photos_count'] == 1
+
+        leaf.parent = root
+        leaf.save()
+        response = client.get(url, **reader_headers)
+        assert [node['id'] for node in response.data['children']] == [child.id, leaf.id]
+        assert response.data['children'][1]['ancestors'][0]['id'] == root.id
+
     def test_delete_taxonomy(self, client, admin_headers, taxonomy_instance):
         """
         Delete taxonomies as an admin
@@ -488,6 +724,48 @@ class TestTaxonomyApi(TestMixin):
         assert self.validate_status_response(response, 403)
 
 
+@pytest.mark.django_db
+@pytest.mark.integration_test
+class TestLoggerApi(TestMixin):
+
+    def test_stream_csv_access_logs(self, client, admin_headers, access_log_set):
+        """
+        Admin user can export all access logs as a csv stream
+        """
+        response = client.get(reverse('export-logger-stream'), **admin_headers)
+        assert self.validate_status_response(response, 200)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        assert lines[0].startswith('photo,title,action')
+        assert len(lines) == len(access_log_set) + 1
+
+    def test_stream_ndjson_access_logs(self, client, admin_headers, access_log_set):
+        """
+        Admin user can export all access logs as a json object per line
+        """
+        response = client.get(reverse('export-logger-stream'), {'export_format': 'ndjson'}, **admin_headers)
+        assert self.validate_status_response(response, 200)
+        logs = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        assert {log['photo'] for log in logs} == {log.photo_id for log in access_log_set}
+
+    def test_stream_access_logs_order(self, client, admin_headers, access_log_set):
+        """
+        Access logs are exported in the order of the list, the last added first, through several chunks
+        """
+        first_log, second_log, third_log = access_log_set
+        AccessLog.objects.filter(pk=first_log.pk).update(added_at=now() + timedelta(days=1))
+        with mock.patch.object(LoggerStreamView, 'chunk_size', 2):
+            response = client.get(reverse('export-logger-stream'), {'export_format': 'ndjson'}, **admin_headers)
+            logs = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        assert [log['photo'] for log in logs] == [first_log.photo_id, third_log.photo_id, second_log.photo_id]
+
+    def test_no_permitted_stream_access_logs(self, client, reader_headers, access_log_set):
+        """
+        Try to export access logs as a reader with no permissions
+        """
+        response = client.get(reverse('export-logger-stream'), **reader_headers)
+        assert self.validate_status_response(response, 403)
+
+
 @pytest.mark.django_db
 @pytest.mark.integration_test
 class TestUploadChunkedApi(TestMixin):
@@ -518,3 +796,101 @@ class TestUploadChunkedApi(TestMixin):
 
         assert response.status_code == 200
         assert response.data.get('status', 1) == 2
+
+    def test_upload_photo_digests_by_chunks(self, client, admin_headers, image_file):
+        """
+        Digests are computed with the chunks, so the file is not read again to complete the upload
+        """
+        headers = update_multipart_headers(admin_headers)
+        data = {'filename': image_file.name}
+        offset, url = 0, reverse('photo-upload')
+        for chunk_file in image_file.chunks(CHUNK_SIZE):
+            headers = update_chunk_range_headers(headers, offset, chunk_file, image_file)
+            data.update({'file': ContentFile(chunk_file, name=image_file.name)})
+            response = client.put(url, data=encode_multipart_data(data), **headers)
+            offset, url = response.data.get('offset'), response.data.get('url')
+
+        checksum = checksum_file(image_file)
+        assert response.data.get('md5') == checksum
+        with mock.patch('bima_core.models.file_hash') as file_hash:
+            response = client.post(url, data={'md5': checksum}, **headers)
+
+        assert response.status_code == 200
+        assert not file_hash.called
+        image_file.seek(0)
+        assert PhotoChunked.objects.get(id=response.data['id']).sha256 == sha256(image_file.read()).hexdigest()
+
+    def test_upload_photo_digests_fallback(self, client, admin_headers, image_file):
+        """
+        Digests of chunks received by other processes are not registered in this one, so they are computed reading
+        the file
+        """
+        headers = update_multipart_headers(admin_headers)
+        data = {'filename': image_file.name}
+        offset, url, uploaded = 0, reverse('photo-upload'), b''
+        with mock.patch.object(chunk_digests, 'update'):
+            for chunk_file in image_file.chunks(CHUNK_SIZE):
+                headers = update_chunk_range_headers(headers, offset, chunk_file, image_file)
+                data.update({'file': ContentFile(chunk_file, name=image_file.name)})
+                response = client.put(url, data=encode_multipart_data(data), **headers)
+                uploaded += chunk_file
+                assert response.data.get('md5') == md5(uploaded).hexdigest()
+                offset, url = response.data.get('offset'), response.data.get('url')
+
+        response = client.post(url, data={'md5': checksum_file(image_file)}, **headers)
+        assert response.status_code == 200
+        image_file.seek(0)
+        assert PhotoChunked.objects.get(id=response.data['id']).sha256 == sha256(image_file.read()).hexdigest()
+
+    def test_upload_photo_parallel(self, client, admin_headers, image_file):
+        """
+        Upload the chunks in reverse order, completing the upload when all of them have been received
+        """
+        headers = update_multipart_headers(admin_headers)
+        data = {'filename': image_file.name}
+        chunks, offset = [], 0
+        for chunk_file in image_file.chunks(CHUNK_SIZE):
+            chunks.append((offset, chunk_file))
+            offset += len(chunk_file)
+
+        url = reverse('photo-upload-parallel')
+        for offset, chunk_file in reversed(chunks):
+            headers = update_chunk_range_headers(headers, offset, chunk_file, image_file, inclusive=True)
+            data.update({'file': ContentFile(chunk_file, name=image_file.name)})
+            response = client.put(url, data=encode_multipart_data(data), **headers)
+            assert response.status_code == 200
+            url = response.data.get('url')
+
+        response = client.post(url, data={'md5': checksum_file(image_file)}, **headers)
+        assert response.status_code == 200
+        assert response.data.get('status', 1) == 2
+        image_file.seek(0)
+        with open(PhotoChunked.objects.get(id=response.data['id']).file.path, 'rb') as f:
+            assert f.read() == image_file.read()
+
+    def test_upload_photo_parallel_range_end(self, client, admin_headers, image_file):
+        """
+        The end of the content range is the last byte of the chunk, so a range ending in the next position is invalid
+        """
+        headers = update_multipart_headers(admin_headers)
+        chunk_file = next(image_file.chunks(CHUNK_SIZE))
+        headers = update_chunk_range_headers(headers, 0, chunk_file, image_file)
+        data = {'filename': image_file.name, 'file': ContentFile(chunk_file, name=image_file.name)}
+        response = client.put(reverse('photo-upload-parallel'), data=encode_multipart_data(data), **headers)
+        assert self.validate_status_response(response, 400)
+
+    def test_upload_photo_parallel_missing_chunks(self, client, admin_headers, image_file):
+        """
+        An upload can not be completed until all chunks have been received
+        """
+        headers = update_multipart_headers(admin_headers)
+        chunk_file = next(image_file.chunks(CHUNK_SIZE))
+        offset = image_file.size - len(chunk_file)
+        headers = update_chunk_range_headers(headers, offset, chunk_file, image_file, inclusive=True)
+        data = {'filename': image_file.name, 'file': ContentFile(chunk_file, name=image_file.name)}
+        response = client.put(reverse('photo-upload-parallel'), data=encode_multipart_data(data), **headers)
+        assert response.status_code == 200
+
+        response = client.post(response.data.get('url'), data={'md5': checksum_file(image_file)}, **headers)
+        assert self.validate_status_response(response, 400)
+        assert response.data['missing_ranges'] == [[0, offset]]